@@ -1,27 +1,39 @@
 from fastapi import FastAPI, HTTPException, Request, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, FileResponse, JSONResponse,RedirectResponse
+from fastapi.responses import HTMLResponse, FileResponse, JSONResponse,RedirectResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 import uvicorn
 import os
 import logging
 import asyncio
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import threading
 import subprocess
 import sys
+import time
+import random
 import uuid
 import httpx
 import firebase_admin
 from firebase_admin import credentials, firestore
+from google.api_core import exceptions as google_exceptions
 from pydantic import BaseModel
 import re
 import json
+import math
+import functools
+import heapq
+import hmac
+import ipaddress
+import importlib.util
 import urllib.parse
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Optional
 from PIL import Image, ImageDraw, ImageFont
+from yookassa_client import yookassa
 import io
-from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.interval import IntervalTrigger
 
 logging.basicConfig(
@@ -69,6 +81,29 @@ XRAY_SERVERS = {
     }
 }
 
+# Пул HTTP соединений к нодам Xray
+XRAY_NODE_MAX_CONNECTIONS = int(os.getenv("XRAY_NODE_MAX_CONNECTIONS", "20"))
+XRAY_NODE_MAX_KEEPALIVE = int(os.getenv("XRAY_NODE_MAX_KEEPALIVE", "10"))
+XRAY_NODE_KEEPALIVE_EXPIRY = float(os.getenv("XRAY_NODE_KEEPALIVE_EXPIRY", "60"))
+
+# Дедлайны параллельного добавления пользователя на ноды (секунды)
+FAST_ADD_NODE_TIMEOUT = 5.0
+FAST_ADD_DEADLINE = float(os.getenv("FAST_ADD_DEADLINE", "5"))
+EMERGENCY_ADD_NODE_TIMEOUT = 30.0
+EMERGENCY_ADD_DEADLINE = float(os.getenv("EMERGENCY_ADD_DEADLINE", "10"))
+
+# Окно накопления и максимальный размер пачки для массового добавления на ноды
+PROVISION_BATCH_WINDOW = float(os.getenv("PROVISION_BATCH_WINDOW", "0.05"))
+PROVISION_MAX_BATCH = int(os.getenv("PROVISION_MAX_BATCH", "500"))
+
+# Circuit breaker для нод: после N ошибок подряд вызовы отклоняются сразу,
+# через RESET_TIMEOUT секунд нода проверяется запросом к /health
+NODE_BREAKER_FAILURE_THRESHOLD = int(os.getenv("NODE_BREAKER_FAILURE_THRESHOLD", "3"))
+NODE_BREAKER_RESET_TIMEOUT = float(os.getenv("NODE_BREAKER_RESET_TIMEOUT", "30"))
+
+# HTTP/2 включается только для нод с "http2": True и при установленном пакете h2
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
 VLESS_SERVERS = [
     {
         "id": "London", 
@@ -146,6 +181,136 @@ except Exception as e:
     logger.error(f"❌ Firebase initialization failed: {str(e)}")
     db = None
 
+# Размер пула потоков для блокирующих вызовов Firestore
+FIRESTORE_MAX_WORKERS = int(os.getenv("FIRESTORE_MAX_WORKERS", "16"))
+
+# Максимум операций в одном batch commit Firestore
+FIRESTORE_BATCH_LIMIT = 500
+# Максимум значений в запросе where(..., 'in', ...)
+FIRESTORE_IN_LIMIT = 10
+
+# Проверка подписок
+SUBSCRIPTION_CHECK_INTERVAL_HOURS = 6
+SUBSCRIPTION_CHECK_JITTER = 300  # секунды
+SUBSCRIPTION_CHECK_MISFIRE_GRACE = 3600  # пропущенный запуск выполняется, если опоздал не более чем на час
+SUBSCRIPTION_CHECK_CONCURRENCY = int(os.getenv("SUBSCRIPTION_CHECK_CONCURRENCY", "10"))
+
+# Максимум UUID в одном запросе /check-user-access/batch
+CHECK_ACCESS_BATCH_LIMIT = 1000
+
+# Журнал изменений доступа для синхронизации нод
+ENTITLEMENT_CHANGE_LOG_SIZE = int(os.getenv("ENTITLEMENT_CHANGE_LOG_SIZE", "10000"))
+ENTITLEMENT_MAX_WAIT = 30.0  # максимальное время long-poll, секунды
+
+# Сверка клиентов нод с оплаченными подписками
+RECONCILE_INTERVAL_MINUTES = int(os.getenv("RECONCILE_INTERVAL_MINUTES", "10"))
+RECONCILE_BATCH_SIZE = int(os.getenv("RECONCILE_BATCH_SIZE", "100"))
+RECONCILE_BATCH_INTERVAL = float(os.getenv("RECONCILE_BATCH_INTERVAL", "1.0"))  # пауза между пачками на одной ноде
+RECONCILE_MAX_OPS_PER_NODE = int(os.getenv("RECONCILE_MAX_OPS_PER_NODE", "2000"))
+# Если лишних клиентов на ноде больше порога, удаление не выполняется: такое расхождение
+# говорит о клиентах, добавленных в обход приложения, или о неполном индексе
+RECONCILE_MAX_REMOVALS_PER_NODE = int(os.getenv("RECONCILE_MAX_REMOVALS_PER_NODE", "100"))
+# Режим проверки: расхождение считается и логируется, но клиенты не удаляются
+RECONCILE_DRY_RUN = os.getenv("RECONCILE_DRY_RUN", "false").lower() == "true"
+
+# Периодический опрос статистики нод
+NODE_STATS_INTERVAL = int(os.getenv("NODE_STATS_INTERVAL", "60"))  # секунды
+NODE_STATS_STALE_AFTER = NODE_STATS_INTERVAL * 3
+
+# Учет трафика пользователей
+TRAFFIC_COLLECT_INTERVAL = int(os.getenv("TRAFFIC_COLLECT_INTERVAL", "300"))  # секунды
+TRAFFIC_BUCKET_SECONDS = 3600  # размер временного окна для агрегатов
+TRAFFIC_HEAVY_USER_BYTES = int(os.getenv("TRAFFIC_HEAVY_USER_BYTES", str(5 * 1024 ** 3)))  # за один интервал
+# Сколько незаписанных агрегатов хранится в памяти, пока Firestore недоступен
+TRAFFIC_MAX_PENDING_BUCKETS = int(os.getenv("TRAFFIC_MAX_PENDING_BUCKETS", "50000"))
+
+# Ключ для служебных данных в /health (заголовок X-Admin-Key). Пустое значение скрывает их
+ADMIN_API_KEY = os.getenv("ADMIN_API_KEY", "")
+
+# Емкость ноды по умолчанию (клиентов) для расчета загрузки, переопределяется ключом "capacity"
+NODE_DEFAULT_CAPACITY = int(os.getenv("NODE_DEFAULT_CAPACITY", "1000"))
+
+# ЮKassa
+# Адреса, с которых ЮKassa отправляет уведомления. Пустое значение отключает проверку
+YOOKASSA_WEBHOOK_NETWORKS = [
+    ipaddress.ip_network(network.strip())
+    for network in os.getenv(
+        "YOOKASSA_WEBHOOK_IPS",
+        "185.71.76.0/27,185.71.77.0/27,77.75.153.0/25,77.75.156.11/32,77.75.156.35/32,77.75.154.128/25,2a02:5180::/32"
+    ).split(",")
+    if network.strip()
+]
+# Число доверенных прокси перед приложением. Адрес клиента берется из
+# X-Forwarded-For на столько позиций справа; 0 - заголовок игнорируется
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "1"))
+PAYMENT_FINAL_STATUSES = ('succeeded', 'canceled')
+PAYMENT_STREAM_TIMEOUT = 600  # секунды, столько же ждет веб-приложение
+PAYMENT_STREAM_KEEPALIVE = 15
+PAYMENT_SWEEP_INTERVAL_MINUTES = int(os.getenv("PAYMENT_SWEEP_INTERVAL_MINUTES", "5"))
+PAYMENT_SWEEP_PAGE_SIZE = 100
+PAYMENT_SWEEP_CONCURRENCY = int(os.getenv("PAYMENT_SWEEP_CONCURRENCY", "8"))
+# Свежие платежи оставляем уведомлениям ЮKassa
+PAYMENT_SWEEP_MIN_AGE = timedelta(minutes=2)
+
+# Очередь повторных операций на нодах (коллекция provisioning_outbox)
+OUTBOX_INTERVAL = int(os.getenv("OUTBOX_INTERVAL", "15"))  # секунды
+OUTBOX_BATCH_SIZE = 200
+OUTBOX_BASE_DELAY = 5.0  # секунды, удваивается с каждой попыткой
+OUTBOX_MAX_DELAY = 3600.0
+# После стольких неудачных попыток операция переносится в provisioning_dead_letter
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "12"))
+
+# Кэш документов пользователей
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "30"))
+
+# Основной event loop приложения (устанавливается при старте)
+main_loop: Optional[asyncio.AbstractEventLoop] = None
+
+# Планировщик фоновых задач, работает в event loop приложения
+scheduler = AsyncIOScheduler()
+
+async def gather_bounded(coros, limit: int) -> list:
+    """asyncio.gather с ограничением числа одновременно выполняемых корутин"""
+    semaphore = asyncio.Semaphore(limit)
+    
+    async def run(coro):
+        async with semaphore:
+            return await coro
+    
+    return await asyncio.gather(*[run(coro) for coro in coros], return_exceptions=True)
+
+# Сильные ссылки на фоновые задачи: event loop хранит только слабые
+_background_tasks = set()
+
+def _background_task_done(task):
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"❌ Background task failed: {task.exception()!r}")
+
+def spawn_background(coro):
+    """Запускает корутину в фоне из любого контекста: из event loop или из рабочего потока.
+    
+    Задача хранится до завершения, а ее исключение попадает в лог.
+    """
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+    
+    if loop:
+        task = loop.create_task(coro)
+    elif main_loop and main_loop.is_running():
+        task = asyncio.run_coroutine_threadsafe(coro, main_loop)
+    else:
+        logger.warning("⚠️ No running event loop, background task dropped")
+        coro.close()
+        return None
+    
+    _background_tasks.add(task)
+    task.add_done_callback(_background_task_done)
+    return task
+
 # Модели данных
 class PaymentRequest(BaseModel):
     user_id: str
@@ -158,6 +323,7 @@ class ActivateTariffRequest(BaseModel):
     tariff: str
     payment_method: str = "yookassa"
     selected_server: str = None
+    preferred_server: str = None  # "auto" - выбрать наименее загруженный сервер
 
 class AddBalanceRequest(BaseModel):
     user_id: str
@@ -188,6 +354,9 @@ class SaveVlessKeyRequest(BaseModel):
     vless_key: str
     config_data: dict
 
+class CheckAccessBatchRequest(BaseModel):
+    uuids: List[str]
+
 def ensure_logo_exists():
     """Обеспечивает что логотип доступен в статической директории"""
     try:
@@ -237,6 +406,159 @@ def create_placeholder_logo():
     except Exception as e:
         logger.error(f"❌ Error creating placeholder logo: {e}")
 
+class NodeUnavailableError(httpx.TransportError):
+    """Вызов ноды отклонен без сетевого запроса: circuit breaker разомкнут"""
+
+class CircuitBreaker:
+    """Circuit breaker одной ноды: closed -> open -> half_open -> closed.
+    
+    В состоянии open вызовы сразу отклоняются. По истечении reset_timeout breaker
+    переходит в half_open и проверяет ноду запросом к /health; успех замыкает его,
+    и очередь повторных операций (provisioning_outbox) обрабатывается сразу.
+    """
+    
+    def __init__(self, server_id: str, failure_threshold: int, reset_timeout: float):
+        self.server_id = server_id
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = None
+        self._probe_task = None
+        self._recovery_task = None
+    
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = "half_open"
+            self._probe_task = spawn_background(probe_node_health(self.server_id))
+        return False
+    
+    def record_success(self):
+        recovered = self.state != "closed"
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = None
+        if recovered:
+            logger.info(f"✅ Circuit closed for {self.server_id}")
+            if self._recovery_task is None or self._recovery_task.done():
+                self._recovery_task = spawn_background(provisioning_outbox.process())
+    
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+            if self.state == "closed":
+                logger.warning(f"⚠️ Circuit opened for {self.server_id} after {self.failures} failures")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+    
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "failures": self.failures
+        }
+
+class BreakerTransport(httpx.AsyncBaseTransport):
+    """Транспорт httpx, который учитывает результаты запросов в circuit breaker ноды"""
+    
+    def __init__(self, transport: httpx.AsyncBaseTransport, breaker: CircuitBreaker):
+        self.transport = transport
+        self.breaker = breaker
+    
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        # Пробный запрос к /health проходит и при разомкнутом breaker
+        if not request.extensions.get("breaker_probe") and not self.breaker.allow():
+            raise NodeUnavailableError(f"Circuit open for {self.breaker.server_id}", request=request)
+        
+        try:
+            response = await self.transport.handle_async_request(request)
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return response
+    
+    async def aclose(self):
+        await self.transport.aclose()
+
+class XrayNodeClients:
+    """Долгоживущие httpx клиенты с keep-alive пулом - по одному на каждую ноду из XRAY_SERVERS"""
+    
+    def __init__(self, servers: dict):
+        self.servers = servers
+        self._clients = {}
+        self.breakers = {
+            server_id: CircuitBreaker(server_id, NODE_BREAKER_FAILURE_THRESHOLD, NODE_BREAKER_RESET_TIMEOUT)
+            for server_id in servers
+        }
+    
+    def _create_client(self, server_id: str) -> httpx.AsyncClient:
+        server_config = self.servers[server_id]
+        # Ноды работают по http://, поэтому HTTP/2 возможен только с prior knowledge
+        use_http2 = HTTP2_AVAILABLE and server_config.get("http2", False)
+        
+        transport = httpx.AsyncHTTPTransport(
+            limits=httpx.Limits(
+                max_connections=server_config.get("max_connections", XRAY_NODE_MAX_CONNECTIONS),
+                max_keepalive_connections=server_config.get("max_keepalive_connections", XRAY_NODE_MAX_KEEPALIVE),
+                keepalive_expiry=XRAY_NODE_KEEPALIVE_EXPIRY
+            ),
+            http1=not use_http2,
+            http2=use_http2
+        )
+        
+        return httpx.AsyncClient(
+            transport=BreakerTransport(transport, self.breakers[server_id]),
+            timeout=httpx.Timeout(30.0, connect=5.0)
+        )
+    
+    def is_available(self, server_id: str) -> bool:
+        breaker = self.breakers.get(server_id)
+        return breaker is None or breaker.state == "closed"
+    
+    def breaker_stats(self) -> dict:
+        return {server_id: breaker.stats() for server_id, breaker in self.breakers.items()}
+    
+    async def startup(self):
+        for server_id in self.servers:
+            self.get(server_id)
+        logger.info(f"✅ Xray node clients ready: {', '.join(self._clients)}")
+    
+    def get(self, server_id: str) -> httpx.AsyncClient:
+        client = self._clients.get(server_id)
+        if client is None or client.is_closed:
+            client = self._create_client(server_id)
+            self._clients[server_id] = client
+        return client
+    
+    async def shutdown(self):
+        clients = list(self._clients.values())
+        self._clients.clear()
+        for client in clients:
+            try:
+                await client.aclose()
+            except Exception as e:
+                logger.warning(f"⚠️ Error closing Xray node client: {e}")
+        logger.info("✅ Xray node clients closed")
+
+xray_nodes = XrayNodeClients(XRAY_SERVERS)
+
+async def probe_node_health(server_id: str):
+    """Пробный запрос half-open breaker к /health ноды (тот же URL, что в /debug-servers)"""
+    try:
+        await xray_nodes.get(server_id).get(
+            f"{XRAY_SERVERS[server_id]['url']}/health",
+            timeout=5.0,
+            extensions={"breaker_probe": True}
+        )
+    except Exception as e:
+        logger.warning(f"⚠️ Health probe failed for {server_id}: {e}")
+
 # Функции работы с Xray через API - ОПТИМИЗИРОВАННЫЕ ВЕРСИИ
 async def check_user_in_xray(user_uuid: str, server_id: str = None) -> bool:
     """Проверить есть ли пользователь в Xray - БЫСТРАЯ ВЕРСИЯ"""
@@ -248,17 +570,16 @@ async def check_user_in_xray(user_uuid: str, server_id: str = None) -> bool:
         
         for server_name, server_config in servers_to_check:
             try:
-                async with httpx.AsyncClient() as client:
-                    response = await client.get(
-                        f"{server_config['url']}/user/{user_uuid}",
-                        headers={"X-API-Key": server_config["api_key"]},
-                        timeout=3.0  # Уменьшили таймаут
-                    )
-                    
-                    if response.status_code == 200:
-                        data = response.json()
-                        if data.get('exists'):
-                            return True
+                response = await xray_nodes.get(server_name).get(
+                    f"{server_config['url']}/user/{user_uuid}",
+                    headers={"X-API-Key": server_config["api_key"]},
+                    timeout=3.0  # Уменьшили таймаут
+                )
+                
+                if response.status_code == 200:
+                    data = response.json()
+                    if data.get('exists'):
+                        return True
             except Exception:
                 continue
         
@@ -290,74 +611,183 @@ async def add_user_to_xray_server(server_id: str, user_id: str, user_uuid: str)
         
         logger.info(f"🚀 Sending user {user_id} to {server_id} via API: {api_url}")
         
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(api_url, json=payload, headers=headers)
-            
-            if response.status_code == 200:
-                result = response.json()
-                if result.get("success"):
-                    logger.info(f"✅ User {user_id} successfully added to {server_id}")
-                    return True
-                else:
-                    logger.error(f"❌ API returned error for {server_id}: {result.get('error')}")
-                    return False
+        response = await xray_nodes.get(server_id).post(api_url, json=payload, headers=headers, timeout=30.0)
+        
+        if response.status_code == 200:
+            result = response.json()
+            if result.get("success"):
+                logger.info(f"✅ User {user_id} successfully added to {server_id}")
+                return True
             else:
-                logger.error(f"❌ API call failed for {server_id}: {response.status_code} - {response.text}")
+                logger.error(f"❌ API returned error for {server_id}: {result.get('error')}")
                 return False
+        else:
+            logger.error(f"❌ API call failed for {server_id}: {response.status_code} - {response.text}")
+            return False
                 
     except Exception as e:
         logger.error(f"❌ Error calling Xray API for {server_id}: {e}")
         return False
 
+async def remove_from_node(server_id: str, user_uuid: str) -> bool:
+    """Удаляет UUID с ноды. Отсутствие пользователя на ноде считается успехом"""
+    server_config = XRAY_SERVERS[server_id]
+    response = await xray_nodes.get(server_id).delete(
+        f"{server_config['url']}/user/{user_uuid}",
+        headers={"X-API-Key": server_config["api_key"]},
+        timeout=FAST_ADD_NODE_TIMEOUT
+    )
+    return response.is_success or response.status_code == 404
+
 async def remove_user_from_xray(user_uuid: str, server_id: str = None) -> bool:
     """Удалить пользователя из Xray сервер(ы)"""
     try:
         logger.info(f"🗑️ [XRAY REMOVE] Removing user: {user_uuid} from server: {server_id}")
-        return True
+        
+        server_ids = [server_id] if server_id in XRAY_SERVERS else list(XRAY_SERVERS.keys())
+        results = await provision_on_nodes(
+            server_ids,
+            lambda node_id: remove_from_node(node_id, user_uuid),
+            FAST_ADD_NODE_TIMEOUT,
+            FAST_ADD_DEADLINE
+        )
+        
+        failed = [node_id for node_id, result in results.items() if not result["success"]]
+        for node_id in failed:
+            await provisioning_outbox.enqueue("remove", node_id, user_uuid)
+        if failed:
+            logger.warning(f"⚠️ [XRAY REMOVE] Failed for {user_uuid} on: {', '.join(failed)}")
+        return not failed
     except Exception as e:
         logger.error(f"❌ [XRAY REMOVE] Exception: {str(e)}")
         return False
 
 async def get_xray_users_count(server_id: str = None) -> int:
-    """Получить количество пользователей в Xray"""
+    """Получить количество пользователей в Xray из кэша статистики нод"""
     try:
-        return 0
+        return node_stats.users_count(server_id)
     except Exception as e:
         logger.error(f"❌ Error getting Xray users count: {e}")
         return 0
 
+class TTLCache:
+    """Потокобезопасный LRU кэш с TTL и счетчиками попаданий/промахов.
+    
+    Загрузка ключа обрамляется begin_load/end_load. Инвалидация во время загрузки
+    увеличивает версию ключа: значение, прочитанное до записи в базу, не попадет
+    в кэш после нее. Версии хранятся только для ключей, которые сейчас загружаются.
+    """
+    
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._versions = {}
+        self._loading = {}
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+    
+    def begin_load(self, key) -> int:
+        """Отмечает начало загрузки ключа и возвращает версию для set()"""
+        with self._lock:
+            self._loading[key] = self._loading.get(key, 0) + 1
+            return self._versions.setdefault(key, 0)
+    
+    def end_load(self, key):
+        with self._lock:
+            remaining = self._loading.get(key, 0) - 1
+            if remaining > 0:
+                self._loading[key] = remaining
+            else:
+                self._loading.pop(key, None)
+                self._versions.pop(key, None)
+    
+    def set(self, key, value, version: int = None):
+        with self._lock:
+            if version is not None and self._versions.get(key, 0) != version:
+                return
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+    
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+            if key in self._loading:
+                self._versions[key] += 1
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            for key in self._loading:
+                self._versions[key] += 1
+    
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0
+            }
+
+user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
 # Функции работы с Firebase
 def get_user(user_id: str):
     if not db: 
         return None
+    
+    cached = user_cache.get(user_id)
+    if cached is not None:
+        return dict(cached)
+    
+    version = user_cache.begin_load(user_id)
     try:
         doc = db.collection('users').document(user_id).get()
-        return doc.to_dict() if doc.exists else None
+        if not doc.exists:
+            return None
+        user_data = doc.to_dict()
+        user_cache.set(user_id, user_data, version)
+        return dict(user_data)
     except Exception as e:
         logger.error(f"❌ Error getting user: {e}")
         return None
+    finally:
+        user_cache.end_load(user_id)
 
 def update_user_balance(user_id: str, amount: float):
     if not db: 
         return False
     try:
-        user_ref = db.collection('users').document(user_id)
-        user = user_ref.get()
+        # Increment выполняется на стороне Firestore: параллельные изменения не теряются
+        db.collection('users').document(user_id).update({
+            'balance': firestore.Increment(amount),
+            'updated_at': firestore.SERVER_TIMESTAMP
+        })
+        user_cache.invalidate(user_id)
         
-        if user.exists:
-            user_data = user.to_dict()
-            current_balance = user_data.get('balance', 0.0)
-            new_balance = current_balance + amount
-            
-            user_ref.update({
-                'balance': new_balance,
-                'updated_at': firestore.SERVER_TIMESTAMP
-            })
-            
-            logger.info(f"💰 Balance updated for user {user_id}: {current_balance} -> {new_balance}")
-            return True
-        else:
-            return False
+        logger.info(f"💰 Balance updated for user {user_id}: {amount:+}")
+        return True
+    except google_exceptions.NotFound:
+        return False
     except Exception as e:
         logger.error(f"❌ Error updating balance: {e}")
         return False
@@ -373,22 +803,37 @@ async def ensure_user_uuid(user_id: str, server_id: str = None) -> str:
     
     try:
         user_ref = db.collection('users').document(user_id)
-        user = user_ref.get()
+        user = await db_repo.run(user_ref.get)
         
         if not user.exists:
             raise Exception("User not found")
         
         user_data = user.to_dict()
         vless_uuid = user_data.get('vless_uuid')
+        servers_to_add = [server_id] if server_id else list(XRAY_SERVERS.keys())
+        
+        # Ноды пользователя хранятся в xray_servers - по ним сверяются клиенты нод.
+        # Действующая подписка без этого поля (старый формат) была на всех нодах
+        assigned = user_data.get('xray_servers')
+        if assigned is None and vless_uuid and is_subscription_active(user_data):
+            assigned, new_servers = [], list(XRAY_SERVERS.keys())
+        else:
+            assigned = assigned or []
+            new_servers = [node_id for node_id in servers_to_add if node_id in XRAY_SERVERS and node_id not in assigned]
         
         if vless_uuid:
             logger.info(f"🔍 User {user_id} has existing UUID: {vless_uuid}")
             
-            # БЫСТРОЕ ДОБАВЛЕНИЕ: не проверяем, просто добавляем
-            servers_to_add = [server_id] if server_id else list(XRAY_SERVERS.keys())
+            if new_servers:
+                await db_repo.run(user_ref.update, {
+                    'xray_servers': firestore.ArrayUnion(new_servers),
+                    'updated_at': firestore.SERVER_TIMESTAMP
+                })
+                user_cache.invalidate(user_id)
+            entitlement_index.assign(vless_uuid, assigned + new_servers)
             
             # Запускаем добавление асинхронно без ожидания
-            asyncio.create_task(fast_add_to_xray(vless_uuid, servers_to_add))
+            spawn_background(fast_add_to_xray(vless_uuid, servers_to_add))
             
             return vless_uuid
         
@@ -397,14 +842,18 @@ async def ensure_user_uuid(user_id: str, server_id: str = None) -> str:
         logger.info(f"🆕 Generating new UUID for user {user_id}: {new_uuid}")
         
         # Обновляем пользователя
-        user_ref.update({
+        update_data = {
             'vless_uuid': new_uuid,
             'updated_at': firestore.SERVER_TIMESTAMP
-        })
+        }
+        if new_servers:
+            update_data['xray_servers'] = firestore.ArrayUnion(new_servers)
+        await db_repo.run(user_ref.update, update_data)
+        user_cache.invalidate(user_id)
+        entitlement_index.assign(new_uuid, assigned + new_servers)
         
         # Быстро добавляем на серверы
-        servers_to_add = [server_id] if server_id else list(XRAY_SERVERS.keys())
-        asyncio.create_task(fast_add_to_xray(new_uuid, servers_to_add))
+        spawn_background(fast_add_to_xray(new_uuid, servers_to_add))
         
         return new_uuid
         
@@ -412,27 +861,166 @@ async def ensure_user_uuid(user_id: str, server_id: str = None) -> str:
         logger.error(f"❌ Error ensuring user UUID: {e}")
         raise
 
-async def fast_add_to_xray(user_uuid: str, servers_to_add):
-    """Быстрое добавление в Xray без блокировки основного потока"""
+async def provision_on_nodes(server_ids, node_call, node_timeout: float, deadline: float) -> dict:
+    """Параллельно выполняет node_call(server_id) на всех нодах.
+    
+    Каждая нода ограничена node_timeout, весь вызов - deadline. Ноды, не успевшие
+    к дедлайну, помечаются pending и продолжают работу в фоне до своего таймаута.
+    """
+    async def run_on_node(server_id: str) -> dict:
+        started = time.monotonic()
+        try:
+            success = await asyncio.wait_for(node_call(server_id), timeout=node_timeout)
+            result = {"success": bool(success)}
+        except asyncio.TimeoutError:
+            result = {"success": False, "error": "timeout"}
+        except Exception as e:
+            result = {"success": False, "error": str(e)}
+        result["elapsed_ms"] = round((time.monotonic() - started) * 1000, 1)
+        return result
+    
+    tasks = {server_id: asyncio.create_task(run_on_node(server_id)) for server_id in server_ids}
+    if not tasks:
+        return {}
+    
+    done, _ = await asyncio.wait(tasks.values(), timeout=deadline)
+    
+    results = {}
+    for server_id, task in tasks.items():
+        if task in done:
+            results[server_id] = task.result()
+        else:
+            results[server_id] = {"success": False, "error": "deadline exceeded", "pending": True}
+    return results
+
+async def fast_add_to_node(server_id: str, user_uuid: str) -> bool:
+    """Отправляет UUID на ноду через быстрый эндпоинт /user"""
+    server_config = XRAY_SERVERS[server_id]
+    response = await xray_nodes.get(server_id).post(
+        f"{server_config['url']}/user",
+        headers={
+            "X-API-Key": server_config["api_key"],
+            "Content-Type": "application/json"
+        },
+        json={"uuid": user_uuid},
+        timeout=FAST_ADD_NODE_TIMEOUT
+    )
+    return response.is_success
+
+async def bulk_add_to_node(server_id: str, user_uuids: List[str]) -> dict:
+    """Отправляет пачку UUID на ноду одним запросом POST /users.
+    
+    Если нода еще не поддерживает массовый эндпоинт, UUID отправляются по одному.
+    Возвращает {uuid: success}.
+    """
+    server_config = XRAY_SERVERS[server_id]
+    response = await xray_nodes.get(server_id).post(
+        f"{server_config['url']}/users",
+        headers={
+            "X-API-Key": server_config["api_key"],
+            "Content-Type": "application/json"
+        },
+        json={"uuids": user_uuids},
+        timeout=FAST_ADD_NODE_TIMEOUT
+    )
+    
+    if response.status_code in (404, 405):
+        results = await asyncio.gather(
+            *[fast_add_to_node(server_id, user_uuid) for user_uuid in user_uuids],
+            return_exceptions=True
+        )
+        return {user_uuid: result is True for user_uuid, result in zip(user_uuids, results)}
+    
+    return {user_uuid: response.is_success for user_uuid in user_uuids}
+
+class XrayProvisioningQueue:
+    """Очередь добавления пользователей на ноды.
+    
+    Пары (uuid, server) накапливаются в течение короткого окна и отправляются
+    одной пачкой на каждую ноду. enqueue возвращает future с результатом для пары.
+    """
+    
+    def __init__(self, window: float, max_batch: int):
+        self.window = window
+        self.max_batch = max_batch
+        self.batches_sent = 0
+        self.users_sent = 0
+        self._pending = {}
+        self._flush_task = None
+    
+    def enqueue(self, user_uuid: str, server_id: str) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        node_pending = self._pending.setdefault(server_id, {})
+        future = node_pending.get(user_uuid)
+        if future is None:
+            future = loop.create_future()
+            node_pending[user_uuid] = future
+        
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = loop.create_task(self._flush_after_window())
+        return future
+    
+    async def _flush_after_window(self):
+        await asyncio.sleep(self.window)
+        await self.flush()
+    
+    async def flush(self):
+        pending, self._pending = self._pending, {}
+        await asyncio.gather(*[
+            self._flush_node(server_id, node_pending)
+            for server_id, node_pending in pending.items()
+        ])
+    
+    async def _flush_node(self, server_id: str, node_pending: dict):
+        user_uuids = list(node_pending)
+        for start in range(0, len(user_uuids), self.max_batch):
+            batch = user_uuids[start:start + self.max_batch]
+            try:
+                results = await bulk_add_to_node(server_id, batch)
+            except Exception as e:
+                logger.warning(f"⚠️ Bulk add to {server_id} failed for {len(batch)} users: {e}")
+                results = {}
+            
+            self.batches_sent += 1
+            self.users_sent += len(batch)
+            
+            for user_uuid in batch:
+                future = node_pending[user_uuid]
+                if not future.done():
+                    future.set_result(results.get(user_uuid, False))
+    
+    def stats(self) -> dict:
+        return {
+            "pending": sum(len(node_pending) for node_pending in self._pending.values()),
+            "batches_sent": self.batches_sent,
+            "users_sent": self.users_sent
+        }
+
+xray_provisioning_queue = XrayProvisioningQueue(PROVISION_BATCH_WINDOW, PROVISION_MAX_BATCH)
+
+async def fast_add_to_xray(user_uuid: str, servers_to_add) -> dict:
+    """Быстрое параллельное добавление в Xray через очередь массового добавления"""
     try:
-        for server_name in servers_to_add:
-            if server_name in XRAY_SERVERS:
-                try:
-                    async with httpx.AsyncClient() as client:
-                        await client.post(
-                            f"{XRAY_SERVERS[server_name]['url']}/user",
-                            headers={
-                                "X-API-Key": XRAY_SERVERS[server_name]["api_key"],
-                                "Content-Type": "application/json"
-                            },
-                            json={"uuid": user_uuid},
-                            timeout=5.0
-                        )
-                    logger.info(f"⚡ FAST: User {user_uuid} sent to {server_name}")
-                except Exception as e:
-                    logger.warning(f"⚠️ Fast add failed for {server_name}: {e}")
+        server_ids = [server_name for server_name in servers_to_add if server_name in XRAY_SERVERS]
+        results = await provision_on_nodes(
+            server_ids,
+            # shield: таймаут одного вызова не должен отменять общий future очереди
+            lambda server_id: asyncio.shield(xray_provisioning_queue.enqueue(user_uuid, server_id)),
+            PROVISION_BATCH_WINDOW + FAST_ADD_NODE_TIMEOUT,
+            PROVISION_BATCH_WINDOW + FAST_ADD_DEADLINE
+        )
+        
+        for server_name, result in results.items():
+            if result["success"]:
+                logger.info(f"⚡ FAST: User {user_uuid} sent to {server_name} ({result['elapsed_ms']} ms)")
+            else:
+                logger.warning(f"⚠️ Fast add failed for {server_name}: {result.get('error', 'bad response')}")
+                await provisioning_outbox.enqueue("add", server_name, user_uuid)
+        
+        return results
     except Exception as e:
         logger.error(f"❌ Error in fast_add_to_xray: {e}")
+        return {}
 
 def add_referral_bonus_immediately(referrer_id: str, referred_id: str):
     if not db: 
@@ -460,7 +1048,11 @@ def add_referral_bonus_immediately(referrer_id: str, referred_id: str):
         return False
 
 def save_vless_key_to_db(user_id: str, server_id: str, vless_key: str, config_data: dict):
-    """Сохраняет VLESS ключ пользователя в базу данных"""
+    """Сохраняет VLESS ключ пользователя в базу данных.
+    
+    Id ключа добавляется в vless_key_ids пользователя, чтобы при истечении подписки
+    ключи отключались без запросов к vless_keys.
+    """
     if not db:
         return False
     
@@ -477,7 +1069,17 @@ def save_vless_key_to_db(user_id: str, server_id: str, vless_key: str, config_da
             'is_active': True
         }
         
-        db.collection('vless_keys').document(vless_key_id).set(vless_data)
+        key_ref = db.collection('vless_keys').document(vless_key_id)
+        batch = db.batch()
+        batch.set(key_ref, vless_data)
+        batch.update(db.collection('users').document(user_id), {
+            'vless_key_ids': firestore.ArrayUnion([vless_key_id])
+        })
+        try:
+            batch.commit()
+        except google_exceptions.NotFound:
+            # Ключ без документа пользователя: отключать при истечении нечего
+            key_ref.set(vless_data)
         return True
         
     except Exception as e:
@@ -612,144 +1214,337 @@ def create_user_vless_configs(user_id: str, vless_uuid: str, server_id: str = No
     
     return configs
 
-def process_subscription_days(user_id: str) -> bool:
-    """Обработка дней подписки с удалением из Xray при окончании"""
+def parse_subscription_end(value) -> Optional[datetime]:
+    """Приводит subscription_end (ISO строка или timestamp Firestore) к локальному datetime"""
+    if not value:
+        return None
+    try:
+        if isinstance(value, str):
+            value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        if value.tzinfo is not None:
+            value = value.astimezone().replace(tzinfo=None)
+        return value
+    except Exception:
+        return None
+
+def get_subscription_end(user: dict) -> Optional[datetime]:
+    """Момент окончания подписки.
+    
+    Для документов старого формата (счетчик subscription_days, уменьшаемый по
+    last_subscription_check) окончание вычисляется из счетчика.
+    """
+    if not user or not user.get('has_subscription', False):
+        return None
+    
+    last_check = user.get('last_subscription_check')
+    if last_check:
+        try:
+            last_date = datetime.fromisoformat(last_check.replace('Z', '+00:00')).date()
+            days_left = user.get('subscription_days', 0)
+            return datetime.combine(last_date + timedelta(days=days_left), datetime.min.time())
+        except Exception:
+            pass
+    
+    return parse_subscription_end(user.get('subscription_end'))
+
+def get_subscription_days(user: dict) -> int:
+    """Количество оставшихся дней подписки, вычисленное на момент чтения"""
+    subscription_end = get_subscription_end(user)
+    if not subscription_end:
+        return 0
+    remaining = (subscription_end - datetime.now()).total_seconds()
+    return max(0, math.ceil(remaining / 86400))
+
+def is_subscription_active(user: dict) -> bool:
+    subscription_end = get_subscription_end(user)
+    return subscription_end is not None and subscription_end > datetime.now()
+
+def migrate_subscription_end() -> int:
+    """Одноразовая миграция: переводит документы со счетчика дней на абсолютный subscription_end"""
     if not db:
-        return False
+        return 0
     
-    try:
-        user = get_user(user_id)
-        if not user:
-            return False
-            
-        has_subscription = user.get('has_subscription', False)
-        subscription_days = user.get('subscription_days', 0)
-        vless_uuid = user.get('vless_uuid')
-        last_check = user.get('last_subscription_check')
-        today = datetime.now().date()
+    query = db.collection('users').where('has_subscription', '==', True)
+    writes = []
+    for doc in query.stream():
+        user = doc.to_dict()
+        if not user.get('last_subscription_check') and user.get('subscription_end'):
+            continue
+        
+        subscription_end = get_subscription_end(user)
+        if subscription_end is None:
+            # Нет ни даты проверки, ни окончания: отсчитываем остаток дней от текущего момента
+            days_left = user.get('subscription_days') or 0
+            if days_left <= 0:
+                logger.warning(f"⚠️ User {doc.id} has a subscription without end or days left, skipped")
+                continue
+            subscription_end = datetime.now() + timedelta(days=days_left)
         
-        if not has_subscription or subscription_days <= 0:
-            return True
-            
-        if not last_check:
-            db.collection('users').document(user_id).update({
-                'last_subscription_check': today.isoformat()
-            })
-            return True
+        writes.append((doc.reference, {
+            'subscription_end': subscription_end.isoformat(),
+            'last_subscription_check': firestore.DELETE_FIELD
+        }))
+    
+    for start in range(0, len(writes), FIRESTORE_BATCH_LIMIT):
+        batch = db.batch()
+        for ref, update_data in writes[start:start + FIRESTORE_BATCH_LIMIT]:
+            batch.update(ref, update_data)
+        batch.commit()
+    
+    logger.info(f"✅ Migrated {len(writes)} users to subscription_end")
+    return len(writes)
+
+def migrate_vless_key_ids() -> int:
+    """Одноразовая миграция: заполняет vless_key_ids у активных пользователей по коллекции vless_keys"""
+    if not db:
+        return 0
+    
+    key_ids = {}
+    for doc in db.collection('vless_keys').stream():
+        user_id = (doc.to_dict() or {}).get('user_id')
+        if user_id:
+            key_ids.setdefault(user_id, []).append(doc.id)
+    
+    writes = [
+        (doc.reference, {'vless_key_ids': firestore.ArrayUnion(key_ids[doc.id]) if doc.id in key_ids else []})
+        for doc in db.collection('users').where('has_subscription', '==', True).stream()
+        if 'vless_key_ids' not in (doc.to_dict() or {})
+    ]
+    
+    for start in range(0, len(writes), FIRESTORE_BATCH_LIMIT):
+        batch = db.batch()
+        for ref, update_data in writes[start:start + FIRESTORE_BATCH_LIMIT]:
+            batch.update(ref, update_data)
+        batch.commit()
+    
+    logger.info(f"✅ Backfilled vless_key_ids for {len(writes)} users")
+    return len(writes)
+
+def get_expired_subscriptions(now_iso: str) -> list:
+    """Находит активные подписки с subscription_end <= now. Возвращает снимки документов.
+    
+    Требует составного индекса users(has_subscription, subscription_end).
+    """
+    if not db:
+        return []
+    query = (
+        db.collection('users')
+        .where('has_subscription', '==', True)
+        .where('subscription_end', '<=', now_iso)
+    )
+    return list(query.stream())
+
+def get_vless_key_ids(user_docs: list) -> List[str]:
+    """Возвращает id документов vless_keys для снимков пользователей.
+    
+    Id берутся из vless_key_ids пользователя; запросы к vless_keys (по
+    FIRESTORE_IN_LIMIT пользователей) выполняются только для документов без этого поля.
+    """
+    key_ids = []
+    legacy_user_ids = []
+    for doc in user_docs:
+        user_key_ids = (doc.to_dict() or {}).get('vless_key_ids')
+        if user_key_ids is None:
+            legacy_user_ids.append(doc.id)
         else:
-            try:
-                last_date = datetime.fromisoformat(last_check.replace('Z', '+00:00')).date()
-                days_passed = (today - last_date).days
-                
-                if days_passed > 0:
-                    new_days = max(0, subscription_days - days_passed)
-                    
-                    update_data = {
-                        'subscription_days': new_days,
-                        'last_subscription_check': today.isoformat()
-                    }
-                    
-                    if new_days == 0:
-                        update_data['has_subscription'] = False
-                        update_data['subscription_end'] = datetime.now().isoformat()  # Записываем конец подписки
-                        if vless_uuid:
-                            asyncio.create_task(remove_user_from_xray(vless_uuid))
-                            user_vless_keys = get_user_vless_keys(user_id)
-                            for key_data in user_vless_keys:
-                                update_vless_key_status(user_id, key_data['server_id'], False)
-                    
-                    db.collection('users').document(user_id).update(update_data)
-                    
-            except Exception as e:
-                logger.error(f"❌ Error processing subscription days: {e}")
-        
-        return True
-            
-    except Exception as e:
-        logger.error(f"❌ Error processing subscription: {e}")
-        return False
+            key_ids.extend(user_key_ids)
+    
+    for start in range(0, len(legacy_user_ids), FIRESTORE_IN_LIMIT):
+        chunk = legacy_user_ids[start:start + FIRESTORE_IN_LIMIT]
+        query = db.collection('vless_keys').where('user_id', 'in', chunk)
+        key_ids.extend(doc.id for doc in query.stream())
+    return key_ids
+
+def expire_subscriptions(docs: list) -> List[dict]:
+    """Отключает истекшие подписки и их VLESS ключи пачками batch commit.
+    
+    Документ пользователя обновляется с предусловием last_update_time из снимка:
+    подписка, продленная после запроса, не перезаписывается и пропускается.
+    Возвращает пользователей, подписка которых действительно отключена.
+    """
+    if not db or not docs:
+        return []
+    
+    now_iso = datetime.now().isoformat()
+    user_update = {
+        'has_subscription': False,
+        'subscription_days': 0,
+        'xray_servers': firestore.DELETE_FIELD,
+        'updated_at': firestore.SERVER_TIMESTAMP
+    }
+    
+    def precondition(doc):
+        return db.write_option(last_update_time=doc.update_time)
+    
+    expired = []
+    for start in range(0, len(docs), FIRESTORE_BATCH_LIMIT):
+        chunk = docs[start:start + FIRESTORE_BATCH_LIMIT]
+        try:
+            batch = db.batch()
+            for doc in chunk:
+                batch.update(doc.reference, user_update, option=precondition(doc))
+            batch.commit()
+            expired.extend(chunk)
+        except (google_exceptions.FailedPrecondition, google_exceptions.NotFound):
+            # Часть документов изменилась после запроса - повторяем по одному
+            for doc in chunk:
+                try:
+                    doc.reference.update(user_update, option=precondition(doc))
+                    expired.append(doc)
+                except (google_exceptions.FailedPrecondition, google_exceptions.NotFound):
+                    logger.info(f"ℹ️ User {doc.id} changed since the expiry query, skipped")
+    
+    user_ids = [doc.id for doc in expired]
+    key_writes = [
+        (db.collection('vless_keys').document(key_id), {
+            'is_active': False,
+            'updated_at': firestore.SERVER_TIMESTAMP
+        })
+        for key_id in get_vless_key_ids(expired)
+    ]
+    for start in range(0, len(key_writes), FIRESTORE_BATCH_LIMIT):
+        batch = db.batch()
+        for ref, update_data in key_writes[start:start + FIRESTORE_BATCH_LIMIT]:
+            batch.update(ref, update_data)
+        batch.commit()
+    
+    for user_id in user_ids:
+        user_cache.invalidate(user_id)
+    
+    logger.info(f"⏰ Expired {len(user_ids)} of {len(docs)} subscriptions at {now_iso} ({len(user_ids) + len(key_writes)} writes)")
+    return [{**doc.to_dict(), 'user_id': doc.id} for doc in expired]
+
+# Метрики последнего запуска проверки подписок
+subscription_checker_stats = {
+    "runs": 0,
+    "last_started_at": None,
+    "last_duration_ms": None,
+    "last_expired": 0,
+    "last_xray_errors": 0,
+    "last_error": None
+}
 
 async def check_all_subscriptions():
-    """Автоматическая проверка всех подписок - ИСПРАВЛЕННАЯ ВЕРСИЯ"""
+    """Автоматическая проверка подписок: выбираются только истекшие по subscription_end"""
     if not db:
         return []
     
+    started = time.monotonic()
+    subscription_checker_stats["runs"] += 1
+    subscription_checker_stats["last_started_at"] = datetime.now().isoformat()
+    subscription_checker_stats["last_error"] = None
+    
     try:
-        users_ref = db.collection('users').where('has_subscription', '==', True)
-        users = users_ref.stream()
-        
-        expired_users = []
-        
-        for user_doc in users:
-            user_data = user_doc.to_dict()
-            user_id = user_data.get('user_id')
+        candidates = await db_repo.run(get_expired_subscriptions, datetime.now().isoformat())
+        expired = await db_repo.run(expire_subscriptions, candidates)
+        xray_errors = 0
+        
+        if expired:
+            # Продление, записанное уже после отключения, успевает обновить индекс:
+            # такой UUID не отзывается и не удаляется с нод
+            revoked = [
+                user['vless_uuid'] for user in expired
+                if user.get('vless_uuid')
+                and entitlement_index.revoke_expired(user['vless_uuid'], get_subscription_end(user))
+            ]
             
-            # Используем синхронную версию, так как APScheduler не поддерживает async
-            success = process_subscription_days(user_id)
-            
-            if success:
-                user_updated = get_user(user_id)
-                if not user_updated.get('has_subscription', False):
-                    expired_users.append(user_id)
-        
+            results = await gather_bounded([
+                remove_user_from_xray(vless_uuid) for vless_uuid in revoked
+            ], SUBSCRIPTION_CHECK_CONCURRENCY)
+            xray_errors = sum(1 for result in results if result is not True)
+        
+        expired_users = [user['user_id'] for user in expired]
+        subscription_checker_stats["last_expired"] = len(expired_users)
+        subscription_checker_stats["last_xray_errors"] = xray_errors
         logger.info(f"✅ Checked all subscriptions. Expired users: {len(expired_users)}")
         return expired_users
         
     except Exception as e:
+        subscription_checker_stats["last_error"] = str(e)
         logger.error(f"❌ Error checking subscriptions: {e}")
         return []
-
-def check_all_subscriptions_wrapper():
-    """Обертка для запуска асинхронной функции в отдельном event loop"""
-    try:
-        # Создаем новый event loop для выполнения асинхронной задачи
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        result = loop.run_until_complete(check_all_subscriptions())
-        loop.close()
-        return result
-    except Exception as e:
-        logger.error(f"❌ Error in subscription checker wrapper: {e}")
-        return []
+    finally:
+        subscription_checker_stats["last_duration_ms"] = round((time.monotonic() - started) * 1000, 1)
 
 def start_subscription_checker():
-    """Запуск периодической проверки подписок - ИСПРАВЛЕННАЯ ВЕРСИЯ"""
+    """Запуск периодической проверки подписок в event loop приложения"""
     try:
-        scheduler = BackgroundScheduler()
         scheduler.add_job(
-            check_all_subscriptions_wrapper,  # Используем обертку вместо асинхронной функции
-            'interval',
-            hours=6,
-            id='subscription_check'
+            check_all_subscriptions,
+            IntervalTrigger(hours=SUBSCRIPTION_CHECK_INTERVAL_HOURS, jitter=SUBSCRIPTION_CHECK_JITTER),
+            id='subscription_check',
+            replace_existing=True,
+            coalesce=True,
+            max_instances=1,
+            misfire_grace_time=SUBSCRIPTION_CHECK_MISFIRE_GRACE,
+            # Планировщик хранит задачи в памяти: после рестарта первая проверка
+            # выполняется сразу, а не через интервал
+            next_run_time=datetime.now()
         )
-        scheduler.start()
-        logger.info("✅ Subscription checker started (interval: 6 hours)")
+        if not scheduler.running:
+            scheduler.start()
+        logger.info(f"✅ Subscription checker started (interval: {SUBSCRIPTION_CHECK_INTERVAL_HOURS} hours)")
     except Exception as e:
         logger.error(f"❌ Error starting subscription checker: {e}")
 
+def new_payment_data(payment_id: str, user_id: str, amount: float, tariff: str, payment_type: str, payment_method: str, selected_server: str = None) -> dict:
+    payment_data = {
+        'payment_id': payment_id,
+        'user_id': user_id,
+        'amount': amount,
+        'tariff': tariff,
+        'status': 'pending',
+        'payment_type': payment_type,
+        'payment_method': payment_method,
+        'created_at': firestore.SERVER_TIMESTAMP,
+        'yookassa_id': None
+    }
+    
+    if selected_server:
+        payment_data['selected_server'] = selected_server
+    return payment_data
+
 def save_payment(payment_id: str, user_id: str, amount: float, tariff: str, payment_type: str = "tariff", payment_method: str = "yookassa", selected_server: str = None):
     if not db: 
         return
     try:
-        payment_data = {
-            'payment_id': payment_id,
-            'user_id': user_id,
-            'amount': amount,
-            'tariff': tariff,
-            'status': 'pending',
-            'payment_type': payment_type,
-            'payment_method': payment_method,
-            'created_at': firestore.SERVER_TIMESTAMP,
-            'yookassa_id': None
-        }
-        
-        if selected_server:
-            payment_data['selected_server'] = selected_server
-        
+        payment_data = new_payment_data(payment_id, user_id, amount, tariff, payment_type, payment_method, selected_server)
         db.collection('payments').document(payment_id).set(payment_data)
     except Exception as e:
         logger.error(f"❌ Error saving payment: {e}")
 
+@firestore.transactional
+def _pay_from_balance(transaction, user_ref, payment_ref, payment_data: dict):
+    snapshot = user_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return False, None
+    
+    balance = (snapshot.to_dict() or {}).get('balance', 0.0)
+    if balance < payment_data['amount']:
+        return False, balance
+    
+    transaction.update(user_ref, {
+        'balance': firestore.Increment(-payment_data['amount']),
+        'updated_at': firestore.SERVER_TIMESTAMP
+    })
+    transaction.set(payment_ref, payment_data)
+    return True, balance
+
+def pay_from_balance(payment_id: str, user_id: str, amount: float, tariff: str, selected_server: str = None):
+    """Списывает оплату тарифа с баланса и создает платеж одной транзакцией.
+    
+    Баланс проверяется внутри транзакции, поэтому параллельные покупки не уводят
+    его в минус. Возвращает (paid, баланс до списания или None, если пользователя нет).
+    """
+    user_ref = db.collection('users').document(user_id)
+    payment_ref = db.collection('payments').document(payment_id)
+    payment_data = new_payment_data(payment_id, user_id, amount, tariff, "tariff", "balance", selected_server)
+    paid, balance = _pay_from_balance(db.transaction(), user_ref, payment_ref, payment_data)
+    if paid:
+        user_cache.invalidate(user_id)
+        logger.info(f"💰 Balance updated for user {user_id}: {-amount:+}")
+    return paid, balance
+
 def update_payment_status(payment_id: str, status: str, yookassa_id: str = None):
     if not db: 
         return
@@ -765,6 +1560,60 @@ def update_payment_status(payment_id: str, status: str, yookassa_id: str = None)
     except Exception as e:
         logger.error(f"❌ Error updating payment status: {e}")
 
+@firestore.transactional
+def _claim_payment_settlement(transaction, payment_ref, status: str):
+    snapshot = payment_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return False, None
+    
+    payment = snapshot.to_dict()
+    if payment['status'] in PAYMENT_FINAL_STATUSES or payment['status'] == status:
+        return False, payment
+    
+    update_data = {'status': status}
+    if status == 'succeeded':
+        update_data['confirmed_at'] = firestore.SERVER_TIMESTAMP
+        if payment['payment_type'] == 'balance':
+            transaction.update(db.collection('users').document(payment['user_id']), {
+                'balance': firestore.Increment(payment['amount']),
+                'updated_at': firestore.SERVER_TIMESTAMP
+            })
+            update_data['fulfilled'] = True
+        else:
+            # Продление подписки требует запросов к нодам и выполняется после транзакции
+            update_data['fulfilled'] = False
+    
+    transaction.update(payment_ref, update_data)
+    return True, payment
+
+def claim_payment_settlement(payment_id: str, status: str):
+    """Атомарно переводит платеж в новый статус и зачисляет пополнение баланса.
+    
+    Возвращает (claimed, payment). claimed=True получает только один вызывающий:
+    уже финальный платеж или платеж с тем же статусом повторно не применяется.
+    """
+    payment_ref = db.collection('payments').document(payment_id)
+    return _claim_payment_settlement(db.transaction(), payment_ref, status)
+
+def get_payments_page(status: str, before: datetime, limit: int, start_after=None, unfulfilled: bool = False):
+    """Страница платежей со статусом status по возрастанию времени.
+    
+    Ожидающие платежи отбираются по created_at, невыполненные оплаченные тарифы
+    (unfulfilled=True) — по confirmed_at. Возвращает (платежи, последний документ
+    для start_after или None, если страница последняя).
+    """
+    time_field = 'confirmed_at' if unfulfilled else 'created_at'
+    query = db.collection('payments').where('status', '==', status)
+    if unfulfilled:
+        query = query.where('fulfilled', '==', False)
+    query = query.where(time_field, '<=', before).order_by(time_field).limit(limit)
+    if start_after is not None:
+        query = query.start_after(start_after)
+    
+    docs = list(query.stream())
+    last_doc = docs[-1] if len(docs) == limit else None
+    return [{**doc.to_dict(), 'payment_id': doc.id} for doc in docs], last_doc
+
 def get_payment(payment_id: str):
     if not db: 
         return None
@@ -814,53 +1663,86 @@ def extract_referrer_id(start_param: str) -> str:
     
     return start_param
 
-async def update_subscription_days(user_id: str, additional_days: int, server_id: str = None) -> bool:
-    """Обновление дней подписки с ГАРАНТИРОВАННЫМ добавлением в Xray - БЫСТРО"""
+@firestore.transactional
+def _extend_subscription(transaction, user_ref, additional_days: int, update_data: dict, payment_ref=None):
+    # Все чтения транзакции выполняются до записей
+    user_data = user_ref.get(transaction=transaction).to_dict() or {}
+    if payment_ref is not None:
+        payment = payment_ref.get(transaction=transaction).to_dict() or {}
+        if payment.get('fulfilled') is True:
+            return False, None
+    
+    now = datetime.now()
+    # Продлеваем от текущего окончания, если подписка еще активна
+    current_end = get_subscription_end(user_data)
+    base = current_end if current_end and current_end > now else now
+    subscription_end = base + timedelta(days=additional_days)
+    
+    update_data = dict(update_data)
+    if update_data['has_subscription']:
+        # Записываем начало подписки, если это новая подписка
+        if not user_data.get('subscription_start'):
+            update_data['subscription_start'] = now.isoformat()
+        # Дни подписки вычисляются при чтении из subscription_end
+        update_data['subscription_end'] = subscription_end.isoformat()
+    
+    transaction.update(user_ref, update_data)
+    if payment_ref is not None:
+        transaction.update(payment_ref, {'fulfilled': True})
+    return True, subscription_end
+
+def extend_subscription(user_id: str, additional_days: int, update_data: dict, payment_id: str = None):
+    """Продлевает подписку от окончания, прочитанного в транзакции.
+    
+    С payment_id платеж отмечается выполненным в той же транзакции, а уже
+    выполненный платеж подписку повторно не продлевает. Возвращает
+    (applied, subscription_end).
+    """
+    user_ref = db.collection('users').document(user_id)
+    payment_ref = db.collection('payments').document(payment_id) if payment_id else None
+    return _extend_subscription(db.transaction(), user_ref, additional_days, update_data, payment_ref)
+
+async def update_subscription_days(user_id: str, additional_days: int, server_id: str = None, payment_id: str = None) -> bool:
+    """Обновление дней подписки с ГАРАНТИРОВАННЫМ добавлением в Xray - БЫСТРО.
+    
+    С payment_id продление выполняется не более одного раза на платеж.
+    """
     if not db: 
         return False
     try:
         user_ref = db.collection('users').document(user_id)
-        user = user_ref.get()
+        user = await db_repo.run(user_ref.get)
         
         if user.exists:
             user_data = user.to_dict()
-            current_days = user_data.get('subscription_days', 0)
-            new_days = current_days + additional_days
             
-            has_subscription = user_data.get('has_subscription', False)
+            has_subscription = is_subscription_active(user_data)
             if not has_subscription and additional_days > 0:
                 has_subscription = True
             
             update_data = {
-                'subscription_days': new_days,
                 'has_subscription': has_subscription,
                 'updated_at': firestore.SERVER_TIMESTAMP,
-                'last_subscription_check': datetime.now().date().isoformat()
+                'last_subscription_check': firestore.DELETE_FIELD
             }
             
-            # Записываем начало подписки, если это новая подписка
-            if has_subscription and not user_data.get('subscription_start'):
-                update_data['subscription_start'] = datetime.now().isoformat()
-            
-            # Рассчитываем дату окончания подписки
-            if has_subscription:
-                subscription_end = datetime.now() + timedelta(days=new_days)
-                update_data['subscription_end'] = subscription_end.isoformat()
-            
             if has_subscription:
                 try:
                     vless_uuid = await ensure_user_uuid(user_id, server_id)
                     update_data['vless_uuid'] = vless_uuid
-                    
-                    if not user_data.get('subscription_start'):
-                        update_data['subscription_start'] = datetime.now().isoformat()
-                        
                 except Exception as e:
                     logger.error(f"❌ FAILED to ensure UUID for user {user_id}: {e}")
                     return False
             
-            user_ref.update(update_data)
-            logger.info(f"✅ Subscription updated for user {user_id}: +{additional_days} days, start: {update_data.get('subscription_start')}, end: {update_data.get('subscription_end')}")
+            applied, subscription_end = await db_repo.run(extend_subscription, user_id, additional_days, update_data, payment_id)
+            if not applied:
+                logger.info(f"ℹ️ Payment {payment_id} already fulfilled for user {user_id}")
+                return True
+            user_cache.invalidate(user_id)
+            
+            if has_subscription and update_data.get('vless_uuid'):
+                entitlement_index.grant(update_data['vless_uuid'], user_id, subscription_end)
+            logger.info(f"✅ Subscription updated for user {user_id}: +{additional_days} days, end: {subscription_end.isoformat()}")
             return True
         else:
             return False
@@ -879,6 +1761,7 @@ def save_referral_link(user_id: str, referral_link: str):
             'referral_link': referral_link,
             'updated_at': firestore.SERVER_TIMESTAMP
         })
+        user_cache.invalidate(user_id)
         logger.info(f"✅ Referral link saved for user {user_id}")
         return True
     except Exception as e:
@@ -903,6 +1786,993 @@ def generate_referral_link(user_id: str) -> str:
     """Генерирует реферальную ссылку для пользователя"""
     return f"https://t.me/vaaaac_bot?start=ref_{user_id}"
 
+def create_user(user_id: str, user_data: dict) -> bool:
+    """Создает документ пользователя"""
+    if not db:
+        return False
+    try:
+        db.collection('users').document(user_id).set(user_data)
+        user_cache.invalidate(user_id)
+        return True
+    except Exception as e:
+        logger.error(f"❌ Error creating user: {e}")
+        return False
+
+def referral_exists(referrer_id: str, referred_id: str) -> bool:
+    """Проверяет, начислялся ли уже реферальный бонус за эту пару"""
+    if not db:
+        return False
+    referral_id = f"{referrer_id}_{referred_id}"
+    return db.collection('referrals').document(referral_id).get().exists
+
+def apply_referral_bonus_if_missing(user: dict, user_id: str):
+    """Начисляет реферальный бонус после покупки, если он еще не был начислен"""
+    referrer_id = user.get('referred_by') if user else None
+    if not referrer_id:
+        return False
+    
+    if referral_exists(referrer_id, user_id):
+        return False
+    
+    return add_referral_bonus_immediately(referrer_id, user_id)
+
+def clear_user_referrals(user_id: str):
+    """Удаляет рефералов пользователя и отметку о его реферере"""
+    referrals_ref = db.collection('referrals').where('referrer_id', '==', user_id)
+    for ref in referrals_ref.stream():
+        ref.reference.delete()
+    
+    db.collection('users').document(user_id).update({
+        'referred_by': firestore.DELETE_FIELD
+    })
+    user_cache.invalidate(user_id)
+
+def find_user_by_uuid(user_uuid: str):
+    """Находит пользователя по VLESS UUID"""
+    if not db:
+        return None
+    query = db.collection('users').where('vless_uuid', '==', user_uuid).limit(1)
+    for doc in query.stream():
+        return doc.to_dict()
+    return None
+
+def get_subscribed_users() -> List[dict]:
+    """Возвращает всех пользователей с флагом активной подписки"""
+    if not db:
+        return []
+    query = db.collection('users').where('has_subscription', '==', True)
+    return [doc.to_dict() for doc in query.stream()]
+
+def cancel_user_subscription(user_id: str):
+    """Отменяет подписку пользователя. Возвращает (данные пользователя, обновление) или None"""
+    user_ref = db.collection('users').document(user_id)
+    user = user_ref.get()
+    
+    if not user.exists:
+        return None
+    
+    update_data = {
+        'has_subscription': False,
+        'subscription_days': 0,
+        'subscription_start': None,
+        'subscription_end': datetime.now().isoformat(),  # Записываем время окончания подписки
+        'xray_servers': firestore.DELETE_FIELD,
+        'updated_at': firestore.SERVER_TIMESTAMP
+    }
+    
+    user_ref.update(update_data)
+    user_cache.invalidate(user_id)
+    
+    for key_data in get_user_vless_keys(user_id):
+        update_vless_key_status(user_id, key_data['server_id'], False)
+    
+    return user.to_dict(), update_data
+
+class FirestoreRepository:
+    """Асинхронный слой доступа к Firestore.
+    
+    Синхронные вызовы Firestore выполняются в ограниченном пуле потоков,
+    чтобы не блокировать event loop uvicorn. Все обработчики ходят в базу через него.
+    """
+    
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="firestore")
+    
+    async def run(self, func, *args, **kwargs):
+        """Выполняет блокирующую функцию в пуле потоков"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+    
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+    
+    async def get_user(self, user_id: str):
+        return await self.run(get_user, user_id)
+    
+    async def create_user(self, user_id: str, user_data: dict) -> bool:
+        return await self.run(create_user, user_id, user_data)
+    
+    async def update_user_balance(self, user_id: str, amount: float) -> bool:
+        return await self.run(update_user_balance, user_id, amount)
+    
+    async def get_user_vless_keys(self, user_id: str) -> List[dict]:
+        return await self.run(get_user_vless_keys, user_id)
+    
+    async def save_vless_key(self, user_id: str, server_id: str, vless_key: str, config_data: dict) -> bool:
+        return await self.run(save_vless_key_to_db, user_id, server_id, vless_key, config_data)
+    
+    async def update_vless_key_status(self, user_id: str, server_id: str, is_active: bool) -> bool:
+        return await self.run(update_vless_key_status, user_id, server_id, is_active)
+    
+    async def get_referrals(self, referrer_id: str) -> List[dict]:
+        return await self.run(get_referrals, referrer_id)
+    
+    async def referral_exists(self, referrer_id: str, referred_id: str) -> bool:
+        return await self.run(referral_exists, referrer_id, referred_id)
+    
+    async def add_referral_bonus(self, referrer_id: str, referred_id: str) -> bool:
+        return await self.run(add_referral_bonus_immediately, referrer_id, referred_id)
+    
+    async def apply_referral_bonus_if_missing(self, user: dict, user_id: str) -> bool:
+        return await self.run(apply_referral_bonus_if_missing, user, user_id)
+    
+    async def clear_referrals(self, user_id: str):
+        return await self.run(clear_user_referrals, user_id)
+    
+    async def save_referral_link(self, user_id: str, referral_link: str) -> bool:
+        return await self.run(save_referral_link, user_id, referral_link)
+    
+    async def save_payment(self, *args, **kwargs):
+        return await self.run(save_payment, *args, **kwargs)
+    
+    async def update_payment_status(self, payment_id: str, status: str, yookassa_id: str = None):
+        return await self.run(update_payment_status, payment_id, status, yookassa_id)
+    
+    async def get_payment(self, payment_id: str):
+        return await self.run(get_payment, payment_id)
+    
+    async def find_user_by_uuid(self, user_uuid: str):
+        return await self.run(find_user_by_uuid, user_uuid)
+    
+    async def get_subscribed_users(self) -> List[dict]:
+        return await self.run(get_subscribed_users)
+    
+    async def cancel_subscription(self, user_id: str):
+        return await self.run(cancel_user_subscription, user_id)
+    
+    async def create_vless_configs(self, user_id: str, vless_uuid: str, server_id: str = None) -> List[dict]:
+        return await self.run(create_user_vless_configs, user_id, vless_uuid, server_id)
+
+db_repo = FirestoreRepository(FIRESTORE_MAX_WORKERS)
+
+class EntitlementIndex:
+    """Индекс доступа в памяти: vless_uuid -> (user_id, окончание подписки).
+    
+    Загружается при старте и обновляется при активации, истечении и отмене подписки,
+    поэтому проверка доступа по UUID не обращается к Firestore.
+    
+    Каждое изменение получает возрастающий номер и попадает в журнал, из которого
+    ноды забирают дельту по курсору "epoch:seq". Epoch меняется при рестарте
+    процесса, и старые курсоры получают полную пересинхронизацию.
+    
+    Для каждого UUID хранятся и его ноды (поле xray_servers пользователя); UUID без
+    назначенных нод относится ко всем нодам.
+    
+    Истечение по времени тоже попадает в журнал: перед чтением дельты или снимка
+    записи с наступившим expires_at отзываются (куча по expires_at), а long-poll
+    просыпается к ближайшему истечению.
+    """
+    
+    def __init__(self, change_log_size: int):
+        self.loaded = False
+        self.epoch = uuid.uuid4().hex[:12]
+        self.seq = 0
+        self._entries = {}
+        self._expiry_heap = []
+        self._servers = {}
+        self._changes = deque(maxlen=change_log_size)
+        self._changed = asyncio.Event()
+        self._loading = False
+        self._touched_during_load = set()
+    
+    async def load(self):
+        """Загружает активные подписки из Firestore"""
+        if not db:
+            return
+        
+        self._loading = True
+        self._touched_during_load.clear()
+        try:
+            users = await db_repo.get_subscribed_users()
+            snapshot = {}
+            servers = {}
+            for user in users:
+                vless_uuid = user.get('vless_uuid')
+                expires_at = get_subscription_end(user)
+                if vless_uuid and expires_at and expires_at > datetime.now():
+                    snapshot[vless_uuid] = (user.get('user_id'), expires_at)
+                    if user.get('xray_servers') is not None:
+                        servers[vless_uuid] = set(user['xray_servers'])
+            
+            # Изменения, пришедшие во время загрузки, новее снимка
+            for vless_uuid, entry in snapshot.items():
+                if vless_uuid not in self._touched_during_load:
+                    self._entries[vless_uuid] = entry
+                    if vless_uuid in servers:
+                        self._servers.setdefault(vless_uuid, set()).update(servers[vless_uuid])
+            self._rebuild_expiry_heap()
+            
+            self.loaded = True
+            logger.info(f"✅ Entitlement index loaded: {len(self._entries)} active UUIDs")
+        except Exception as e:
+            logger.error(f"❌ Error loading entitlement index: {e}")
+        finally:
+            self._loading = False
+    
+    def _record(self, op: str, vless_uuid: str, user_id: str = None, expires_at: datetime = None):
+        self.seq += 1
+        self._changes.append({
+            "seq": self.seq,
+            "op": op,
+            "uuid": vless_uuid,
+            "user_id": user_id,
+            "expires_at": expires_at.isoformat() if expires_at else None
+        })
+        # Будим всех ожидающих long-poll и готовим новое событие
+        self._changed.set()
+        self._changed = asyncio.Event()
+    
+    def grant(self, vless_uuid: str, user_id: str, expires_at: datetime):
+        if self._loading:
+            self._touched_during_load.add(vless_uuid)
+        self._entries[vless_uuid] = (user_id, expires_at)
+        heapq.heappush(self._expiry_heap, (expires_at, vless_uuid))
+        # Продления оставляют в куче устаревшие записи - периодически сжимаем
+        if len(self._expiry_heap) > 2 * len(self._entries) + 1024:
+            self._rebuild_expiry_heap()
+        self._record("add", vless_uuid, user_id, expires_at)
+    
+    def assign(self, vless_uuid: str, server_ids):
+        """Добавляет UUID к нодам server_ids"""
+        self._servers.setdefault(vless_uuid, set()).update(server_ids)
+    
+    def revoke(self, vless_uuid: str):
+        if self._loading:
+            self._touched_during_load.add(vless_uuid)
+        self._servers.pop(vless_uuid, None)
+        entry = self._entries.pop(vless_uuid, None)
+        if entry is not None:
+            self._record("revoke", vless_uuid, entry[0])
+    
+    def revoke_expired(self, vless_uuid: str, expired_at: Optional[datetime]) -> bool:
+        """Отзывает UUID, если индекс не получил более позднего продления, чем expired_at"""
+        entry = self._entries.get(vless_uuid)
+        if entry is not None and expired_at is not None and entry[1] > expired_at:
+            return False
+        self.revoke(vless_uuid)
+        return True
+    
+    def _rebuild_expiry_heap(self):
+        self._expiry_heap = [(expires_at, vless_uuid) for vless_uuid, (_, expires_at) in self._entries.items()]
+        heapq.heapify(self._expiry_heap)
+    
+    def _is_current(self, item: tuple) -> bool:
+        entry = self._entries.get(item[1])
+        return entry is not None and entry[1] == item[0]
+    
+    def expire_due(self) -> int:
+        """Отзывает записи с наступившим expires_at. Возвращает число отозванных"""
+        now = datetime.now()
+        expired = 0
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            item = heapq.heappop(self._expiry_heap)
+            if self._is_current(item):
+                self.revoke(item[1])
+                expired += 1
+        return expired
+    
+    def next_expiry(self) -> Optional[datetime]:
+        while self._expiry_heap and not self._is_current(self._expiry_heap[0]):
+            heapq.heappop(self._expiry_heap)
+        return self._expiry_heap[0][0] if self._expiry_heap else None
+    
+    @property
+    def cursor(self) -> str:
+        return f"{self.epoch}:{self.seq}"
+    
+    def owner(self, vless_uuid: str) -> Optional[str]:
+        entry = self._entries.get(vless_uuid)
+        return entry[0] if entry else None
+    
+    def is_desired(self, vless_uuid: str, server_id: str) -> bool:
+        """Должен ли UUID быть клиентом ноды: подписка действует и нода назначена"""
+        if self.check(vless_uuid) is None:
+            return False
+        servers = self._servers.get(vless_uuid)
+        return servers is None or server_id in servers
+    
+    def desired_uuids(self, server_id: str) -> set:
+        return {vless_uuid for vless_uuid in self._entries if self.is_desired(vless_uuid, server_id)}
+    
+    def server_counts(self) -> dict:
+        """Число действующих подписок, назначенных на каждую ноду"""
+        return {server_id: len(self.desired_uuids(server_id)) for server_id in XRAY_SERVERS}
+    
+    def snapshot(self) -> List[dict]:
+        self.expire_due()
+        now = datetime.now()
+        return [
+            {"uuid": vless_uuid, "user_id": user_id, "expires_at": expires_at.isoformat()}
+            for vless_uuid, (user_id, expires_at) in self._entries.items()
+            if expires_at > now
+        ]
+    
+    def changes_since(self, cursor: str) -> Optional[List[dict]]:
+        """Изменения после курсора или None, если нужна полная пересинхронизация"""
+        try:
+            epoch, seq = cursor.split(":")
+            seq = int(seq)
+        except (AttributeError, ValueError):
+            return None
+        
+        self.expire_due()
+        if epoch != self.epoch or seq > self.seq:
+            return None
+        if seq == self.seq:
+            return []
+        # Журнал уже не содержит нужных записей
+        if not self._changes or self._changes[0]["seq"] > seq + 1:
+            return None
+        return [change for change in self._changes if change["seq"] > seq]
+    
+    async def wait_for_change(self, timeout: float):
+        """Ждет изменения, но не дольше ближайшего истечения подписки"""
+        next_expiry = self.next_expiry()
+        if next_expiry is not None:
+            # Небольшой запас: таймер может сработать чуть раньше expires_at
+            timeout = min(timeout, max(0.0, (next_expiry - datetime.now()).total_seconds()) + 0.01)
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+    
+    def check(self, vless_uuid: str) -> Optional[tuple]:
+        """Возвращает (user_id, expires_at) для UUID с действующей подпиской"""
+        entry = self._entries.get(vless_uuid)
+        if entry is None or entry[1] <= datetime.now():
+            return None
+        return entry
+    
+    def stats(self) -> dict:
+        return {
+            "loaded": self.loaded,
+            "entries": len(self._entries),
+            "cursor": self.cursor
+        }
+
+entitlement_index = EntitlementIndex(ENTITLEMENT_CHANGE_LOG_SIZE)
+
+async def fetch_node_clients(server_id: str) -> set:
+    """Получает множество UUID клиентов ноды"""
+    server_config = XRAY_SERVERS[server_id]
+    response = await xray_nodes.get(server_id).get(
+        f"{server_config['url']}/users",
+        headers={"X-API-Key": server_config["api_key"]},
+        timeout=30.0
+    )
+    response.raise_for_status()
+    
+    data = response.json()
+    users = data.get("users", []) if isinstance(data, dict) else data
+    return {user.get("uuid") if isinstance(user, dict) else user for user in users} - {None}
+
+class XrayReconciler:
+    """Сверяет клиентов каждой ноды с подписками, назначенными на эту ноду, и применяет только разницу.
+    
+    Недостающие UUID добавляются, лишние удаляются пачками с паузой между ними,
+    чтобы не перегружать ноду. Перед каждой пачкой удаления доступ перепроверяется
+    по индексу: пользователь, активированный во время сверки, не удаляется.
+    Если лишних клиентов больше max_removals, удаление на ноде не выполняется;
+    в режиме dry_run расхождение только логируется. Расхождение по каждой ноде
+    доступно в stats().
+    """
+    
+    def __init__(self, batch_size: int, batch_interval: float, max_ops_per_node: int,
+                 max_removals: int, dry_run: bool = False):
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.max_ops_per_node = max_ops_per_node
+        self.max_removals = max_removals
+        self.dry_run = dry_run
+        self.drift = {}
+        self.last_run_at = None
+    
+    async def run(self):
+        if not entitlement_index.loaded:
+            logger.info("ℹ️ Reconciler skipped: entitlement index is not loaded yet")
+            return
+        
+        await asyncio.gather(*[self.reconcile_node(server_id) for server_id in XRAY_SERVERS])
+        self.last_run_at = datetime.now().isoformat()
+    
+    async def reconcile_node(self, server_id: str):
+        try:
+            node_clients = await fetch_node_clients(server_id)
+        except Exception as e:
+            logger.warning(f"⚠️ Reconciler could not read clients of {server_id}: {e}")
+            self.drift[server_id] = {"error": str(e), "checked_at": datetime.now().isoformat()}
+            return
+        
+        # Желаемое состояние берется после чтения ноды, чтобы не сравнивать с более старым
+        desired = entitlement_index.desired_uuids(server_id)
+        missing = list(desired - node_clients)
+        extra = list(node_clients - desired)
+        
+        drift = {
+            "missing": len(missing),
+            "extra": len(extra),
+            "added": 0,
+            "removed": 0,
+            "removal_skipped": None,
+            "checked_at": datetime.now().isoformat()
+        }
+        self.drift[server_id] = drift
+        
+        if missing or extra:
+            logger.info(f"🔄 Reconciling {server_id}: {len(missing)} missing, {len(extra)} extra")
+        
+        budget = self.max_ops_per_node
+        for start in range(0, min(len(missing), budget), self.batch_size):
+            batch = missing[start:min(start + self.batch_size, budget)]
+            try:
+                results = await bulk_add_to_node(server_id, batch)
+                drift["added"] += sum(1 for success in results.values() if success)
+            except Exception as e:
+                logger.warning(f"⚠️ Reconciler add to {server_id} failed: {e}")
+            await asyncio.sleep(self.batch_interval)
+        
+        if not extra:
+            return
+        if self.dry_run:
+            drift["removal_skipped"] = "dry_run"
+            logger.info(f"ℹ️ Reconciler dry run: would remove {len(extra)} clients from {server_id}")
+            return
+        if len(extra) > self.max_removals:
+            drift["removal_skipped"] = "threshold"
+            logger.error(
+                f"❌ Reconciler found {len(extra)} extra clients on {server_id} "
+                f"(limit {self.max_removals}), removal skipped"
+            )
+            return
+        
+        budget -= len(missing)
+        for start in range(0, max(0, min(len(extra), budget)), self.batch_size):
+            # Подписка могла быть активирована, пока шли предыдущие пачки
+            batch = [
+                user_uuid for user_uuid in extra[start:min(start + self.batch_size, budget)]
+                if not entitlement_index.is_desired(user_uuid, server_id)
+            ]
+            results = await asyncio.gather(
+                *[remove_from_node(server_id, user_uuid) for user_uuid in batch],
+                return_exceptions=True
+            )
+            drift["removed"] += sum(1 for result in results if result is True)
+            await asyncio.sleep(self.batch_interval)
+    
+    def stats(self) -> dict:
+        return {
+            "last_run_at": self.last_run_at,
+            "dry_run": self.dry_run,
+            "nodes": self.drift
+        }
+
+xray_reconciler = XrayReconciler(
+    RECONCILE_BATCH_SIZE,
+    RECONCILE_BATCH_INTERVAL,
+    RECONCILE_MAX_OPS_PER_NODE,
+    RECONCILE_MAX_REMOVALS_PER_NODE,
+    RECONCILE_DRY_RUN
+)
+
+class XrayNodeStats:
+    """Кэш статистики нод (число клиентов, трафик), который периодически обновляется в фоне.
+    
+    /health и / отдают данные из кэша, не обращаясь к нодам. Данные старше
+    stale_after секунд помечаются stale.
+    """
+    
+    def __init__(self, stale_after: float):
+        self.stale_after = stale_after
+        self._stats = {}
+    
+    async def poll(self):
+        await asyncio.gather(*[self.poll_node(server_id) for server_id in XRAY_SERVERS])
+    
+    async def poll_node(self, server_id: str):
+        """Контракт ноды: GET {url}/stats с X-API-Key отвечает {"users": n, "uplink": байты,
+        "downlink": байты}. Нода без /stats (404) опрашивается через GET {url}/users"""
+        server_config = XRAY_SERVERS[server_id]
+        try:
+            response = await xray_nodes.get(server_id).get(
+                f"{server_config['url']}/stats",
+                headers={"X-API-Key": server_config["api_key"]},
+                timeout=10.0
+            )
+            if response.status_code == 404:
+                # Нода без /stats - считаем клиентов по списку
+                data = {"users": len(await fetch_node_clients(server_id))}
+            else:
+                response.raise_for_status()
+                data = response.json()
+            
+            self._stats[server_id] = {
+                "users": int(data.get("users", 0)),
+                "uplink": data.get("uplink"),
+                "downlink": data.get("downlink"),
+                "updated_at": datetime.now().isoformat(),
+                "updated_monotonic": time.monotonic(),
+                "error": None
+            }
+        except Exception as e:
+            previous = self._stats.get(server_id, {})
+            # Оставляем последние известные значения, но фиксируем ошибку
+            self._stats[server_id] = {**previous, "error": str(e)}
+            logger.warning(f"⚠️ Node stats poll failed for {server_id}: {e}")
+    
+    def is_stale(self, server_id: str) -> bool:
+        updated = self._stats.get(server_id, {}).get("updated_monotonic")
+        return updated is None or time.monotonic() - updated > self.stale_after
+    
+    def users_count(self, server_id: str = None) -> int:
+        server_ids = [server_id] if server_id else list(XRAY_SERVERS.keys())
+        return sum(self._stats.get(node_id, {}).get("users", 0) for node_id in server_ids)
+    
+    def get(self, server_id: str) -> dict:
+        return self._stats.get(server_id, {})
+    
+    def snapshot(self) -> dict:
+        return {
+            server_id: {
+                "users": self._stats.get(server_id, {}).get("users"),
+                "uplink": self._stats.get(server_id, {}).get("uplink"),
+                "downlink": self._stats.get(server_id, {}).get("downlink"),
+                "updated_at": self._stats.get(server_id, {}).get("updated_at"),
+                "error": self._stats.get(server_id, {}).get("error"),
+                "stale": self.is_stale(server_id)
+            }
+            for server_id in XRAY_SERVERS
+        }
+
+node_stats = XrayNodeStats(NODE_STATS_STALE_AFTER)
+
+def write_traffic_rollups(buckets: dict):
+    """Записывает агрегаты трафика пачками batch commit.
+    
+    buckets: (владелец, начало окна) -> [uplink, downlink, is_user]. Окно и прирост
+    счетчиков пользователя по нему попадают в одну пачку, поэтому пачка применяется
+    целиком или не применяется вовсе. Записанные окна удаляются из buckets: после
+    ошибки в нем остаются только незаписанные.
+    """
+    # Каждое окно - до двух записей: документ окна и счетчики пользователя
+    chunk_size = FIRESTORE_BATCH_LIMIT // 2
+    keys = list(buckets)
+    for start in range(0, len(keys), chunk_size):
+        chunk = keys[start:start + chunk_size]
+        batch = db.batch()
+        totals = {}
+        for owner, bucket_start in chunk:
+            uplink, downlink, is_user = buckets[(owner, bucket_start)]
+            batch.set(db.collection('traffic_usage').document(f"{owner}_{bucket_start}"), {
+                'owner': owner,
+                'bucket_start': datetime.fromtimestamp(bucket_start).isoformat(),
+                'uplink': firestore.Increment(uplink),
+                'downlink': firestore.Increment(downlink)
+            }, merge=True)
+            if is_user:
+                total = totals.setdefault(owner, [0, 0])
+                total[0] += uplink
+                total[1] += downlink
+        for user_id, (uplink, downlink) in totals.items():
+            batch.set(db.collection('users').document(user_id), {
+                'traffic_uplink': firestore.Increment(uplink),
+                'traffic_downlink': firestore.Increment(downlink)
+            }, merge=True)
+        batch.commit()
+        
+        for key in chunk:
+            del buckets[key]
+        for user_id in totals:
+            user_cache.invalidate(user_id)
+
+class TrafficCollector:
+    """Собирает трафик пользователей с нод (счетчики обнуляются при чтении),
+    агрегирует его по часовым окнам и записывает в Firestore пачками batch за интервал.
+    
+    Незаписанные агрегаты хранятся до следующей записи, но не больше max_pending_buckets:
+    при переполнении отбрасываются самые старые окна. Счетчики в документе пользователя
+    пишутся из тех же окон, поэтому отброшенный трафик не попадает и в них.
+    """
+    
+    def __init__(self, bucket_seconds: int, heavy_user_bytes: int, max_pending_buckets: int):
+        self.bucket_seconds = bucket_seconds
+        self.heavy_user_bytes = heavy_user_bytes
+        self.max_pending_buckets = max_pending_buckets
+        self.heavy_users = []
+        self.dropped_buckets = 0
+        self.last_collected_at = None
+        self.last_error = None
+        # (владелец, начало окна) -> [uplink, downlink, владелец - пользователь];
+        # хранится до успешной записи
+        self._buckets = {}
+    
+    async def fetch_node_traffic(self, server_id: str) -> dict:
+        """Прирост трафика с ноды.
+        
+        Контракт ноды: GET {url}/traffic?reset=true с заголовком X-API-Key отвечает
+        {"users": {email: {"uplink": байты, "downlink": байты}}} и обнуляет счетчики.
+        На ноде это XrayManager.query_user_traffic(reset=True).
+        """
+        server_config = XRAY_SERVERS[server_id]
+        response = await xray_nodes.get(server_id).get(
+            f"{server_config['url']}/traffic",
+            params={"reset": "true"},
+            headers={"X-API-Key": server_config["api_key"]},
+            timeout=30.0
+        )
+        response.raise_for_status()
+        return response.json().get("users", {})
+    
+    async def collect(self):
+        results = await asyncio.gather(
+            *[self.fetch_node_traffic(server_id) for server_id in XRAY_SERVERS],
+            return_exceptions=True
+        )
+        
+        bucket_start = int(time.time()) // self.bucket_seconds * self.bucket_seconds
+        interval_usage = {}
+        for server_id, node_traffic in zip(XRAY_SERVERS, results):
+            if isinstance(node_traffic, Exception):
+                logger.warning(f"⚠️ Traffic collection failed for {server_id}: {node_traffic}")
+                continue
+            
+            for key, counters in node_traffic.items():
+                uplink = int(counters.get("uplink", 0))
+                downlink = int(counters.get("downlink", 0))
+                if not uplink and not downlink:
+                    continue
+                
+                # Счетчики Xray именуются по email клиента: это UUID или user_id
+                user_id = entitlement_index.owner(key)
+                owner = user_id or key
+                
+                bucket = self._buckets.setdefault((owner, bucket_start), [0, 0, user_id is not None])
+                bucket[0] += uplink
+                bucket[1] += downlink
+                
+                interval_usage[owner] = interval_usage.get(owner, 0) + uplink + downlink
+        
+        self.heavy_users = sorted(
+            ({"owner": owner, "bytes": used} for owner, used in interval_usage.items() if used >= self.heavy_user_bytes),
+            key=lambda item: item["bytes"],
+            reverse=True
+        )
+        for heavy in self.heavy_users:
+            logger.warning(f"⚠️ Heavy traffic user {heavy['owner']}: {heavy['bytes']} bytes in {TRAFFIC_COLLECT_INTERVAL} s")
+        
+        await self.flush()
+        self.last_collected_at = datetime.now().isoformat()
+    
+    async def flush(self):
+        if not self._buckets:
+            return
+        if not db:
+            # Без базы агрегаты некуда записать
+            self.dropped_buckets += len(self._buckets)
+            self._buckets = {}
+            return
+        
+        buckets = self._buckets
+        self._buckets = {}
+        try:
+            await db_repo.run(write_traffic_rollups, buckets)
+            self.last_error = None
+        except Exception as e:
+            # Счетчики на нодах уже обнулены - возвращаем незаписанные окна до следующей записи
+            self.last_error = str(e)
+            logger.error(f"❌ Error writing traffic rollups, {len(buckets)} buckets kept: {e}")
+            for key, (uplink, downlink, is_user) in buckets.items():
+                bucket = self._buckets.setdefault(key, [0, 0, is_user])
+                bucket[0] += uplink
+                bucket[1] += downlink
+            self._trim()
+    
+    def _trim(self):
+        overflow = len(self._buckets) - self.max_pending_buckets
+        if overflow <= 0:
+            return
+        oldest = sorted(self._buckets, key=lambda key: key[1])[:overflow]
+        for key in oldest:
+            del self._buckets[key]
+        self.dropped_buckets += overflow
+        logger.warning(f"⚠️ Dropped {overflow} unsaved traffic buckets")
+    
+    def stats(self, include_users: bool = False) -> dict:
+        """Статистика сборщика. Список тяжелых пользователей - только для администратора"""
+        stats = {
+            "last_collected_at": self.last_collected_at,
+            "pending_buckets": len(self._buckets),
+            "dropped_buckets": self.dropped_buckets,
+            "heavy_users_count": len(self.heavy_users),
+            "last_error": self.last_error
+        }
+        if include_users:
+            stats["heavy_users"] = self.heavy_users
+        return stats
+
+traffic_collector = TrafficCollector(TRAFFIC_BUCKET_SECONDS, TRAFFIC_HEAVY_USER_BYTES, TRAFFIC_MAX_PENDING_BUCKETS)
+
+def get_server_load(server_id: str, assigned_counts: dict = None) -> dict:
+    """Текущая загрузка ноды.
+    
+    Число клиентов берется из кэша статистики ноды. Если статистики нет (ошибка
+    опроса или устаревшие данные), используется число подписок, назначенных на
+    ноду, из индекса доступа. Здоровье ноды определяется ее circuit breaker.
+    """
+    stats = node_stats.get(server_id)
+    capacity = XRAY_SERVERS.get(server_id, {}).get("capacity", NODE_DEFAULT_CAPACITY)
+    
+    if stats.get("users") is not None and not stats.get("error") and not node_stats.is_stale(server_id):
+        users = stats["users"]
+        users_source = "node"
+    else:
+        if assigned_counts is None:
+            assigned_counts = entitlement_index.server_counts()
+        users = assigned_counts.get(server_id, 0)
+        users_source = "subscriptions"
+    
+    return {
+        "users": users,
+        "users_source": users_source,
+        "load": round(users / capacity, 3) if capacity else 0.0,
+        "bandwidth": (stats.get("uplink") or 0) + (stats.get("downlink") or 0),
+        "healthy": server_id in XRAY_SERVERS and xray_nodes.is_available(server_id)
+    }
+
+def rank_servers() -> List[dict]:
+    """Серверы по возрастанию загрузки: сначала здоровые, затем по доле занятых мест и трафику"""
+    assigned_counts = entitlement_index.server_counts()
+    ranked = [{**server, **get_server_load(server["id"], assigned_counts)} for server in VLESS_SERVERS]
+    ranked.sort(key=lambda server: (not server["healthy"], server["load"], server["bandwidth"]))
+    return ranked
+
+def resolve_server(selected_server: Optional[str]) -> Optional[str]:
+    """Заменяет "auto" на наименее загруженный сервер"""
+    if selected_server != "auto":
+        return selected_server
+    ranked = rank_servers()
+    return ranked[0]["id"] if ranked else None
+
+def outbox_doc_id(op: str, server_id: str, user_uuid: str) -> str:
+    return f"{op}_{server_id}_{user_uuid}"
+
+def outbox_put(op: str, server_id: str, user_uuid: str):
+    """Сохраняет операцию в outbox. Повтор той же операции перезаписывает документ,
+    противоположная операция для той же пары (uuid, server) удаляется"""
+    opposite = "remove" if op == "add" else "add"
+    batch = db.batch()
+    batch.set(db.collection('provisioning_outbox').document(outbox_doc_id(op, server_id, user_uuid)), {
+        'op': op,
+        'server_id': server_id,
+        'uuid': user_uuid,
+        'attempts': 0,
+        'next_attempt_at': datetime.now().isoformat(),
+        'last_error': None,
+        'created_at': firestore.SERVER_TIMESTAMP
+    })
+    batch.delete(db.collection('provisioning_outbox').document(outbox_doc_id(opposite, server_id, user_uuid)))
+    batch.commit()
+
+def outbox_get_due(server_id: str, limit: int) -> List[dict]:
+    """Операции одной ноды, срок повтора которых наступил.
+    
+    Требует составного индекса provisioning_outbox(server_id, next_attempt_at).
+    """
+    query = (
+        db.collection('provisioning_outbox')
+        .where('server_id', '==', server_id)
+        .where('next_attempt_at', '<=', datetime.now().isoformat())
+        .limit(limit)
+    )
+    return [doc.to_dict() for doc in query.stream()]
+
+def outbox_complete(done: List[dict], failed: List[tuple]) -> List[dict]:
+    """Удаляет выполненные операции и переносит неудачные по экспоненциальной задержке.
+    
+    Операции, исчерпавшие OUTBOX_MAX_ATTEMPTS попыток, переносятся в коллекцию
+    provisioning_dead_letter. Возвращает перенесенные операции.
+    """
+    writes = []
+    dead = []
+    for item in done:
+        writes.append(('delete', 'provisioning_outbox', outbox_doc_id(item['op'], item['server_id'], item['uuid']), None))
+    for item, error in failed:
+        doc_id = outbox_doc_id(item['op'], item['server_id'], item['uuid'])
+        attempts = item.get('attempts', 0) + 1
+        if attempts >= OUTBOX_MAX_ATTEMPTS:
+            dead.append({**item, 'attempts': attempts, 'last_error': error})
+            writes.append(('delete', 'provisioning_outbox', doc_id, None))
+            writes.append(('set', 'provisioning_dead_letter', doc_id, {
+                **item,
+                'attempts': attempts,
+                'last_error': error,
+                'failed_at': firestore.SERVER_TIMESTAMP
+            }))
+            continue
+        delay = min(OUTBOX_MAX_DELAY, OUTBOX_BASE_DELAY * 2 ** attempts) * random.uniform(0.8, 1.2)
+        writes.append(('update', 'provisioning_outbox', doc_id, {
+            'attempts': attempts,
+            'next_attempt_at': (datetime.now() + timedelta(seconds=delay)).isoformat(),
+            'last_error': error
+        }))
+    
+    for start in range(0, len(writes), FIRESTORE_BATCH_LIMIT):
+        batch = db.batch()
+        for action, collection, doc_id, data in writes[start:start + FIRESTORE_BATCH_LIMIT]:
+            ref = db.collection(collection).document(doc_id)
+            if action == 'delete':
+                batch.delete(ref)
+            elif action == 'set':
+                batch.set(ref, data)
+            else:
+                batch.update(ref, data)
+        batch.commit()
+    return dead
+
+class ProvisioningOutbox:
+    """Надежная очередь операций добавления/удаления на нодах.
+    
+    Неудавшиеся операции сохраняются в Firestore (переживают рестарт) и повторяются
+    с экспоненциальной задержкой. Ключ документа (op, server, uuid) исключает дубли.
+    Очередь читается отдельно для каждой доступной ноды (до batch_size операций),
+    поэтому недоступная нода не задерживает повторы для остальных.
+    """
+    
+    def __init__(self, batch_size: int):
+        self.batch_size = batch_size
+        self.processed = 0
+        self.failed = 0
+        self.dead_lettered = 0
+        self.last_run_at = None
+        self._lock = asyncio.Lock()
+        self._rerun = False
+    
+    async def enqueue(self, op: str, server_id: str, user_uuid: str):
+        if not db:
+            return
+        try:
+            await db_repo.run(outbox_put, op, server_id, user_uuid)
+        except Exception as e:
+            logger.error(f"❌ Error saving {op} of {user_uuid} on {server_id} to outbox: {e}")
+    
+    async def process(self):
+        """Один проход по очереди за раз. Вызов во время прохода не запускает второй,
+        а только заказывает повтор после текущего: нода могла восстановиться уже
+        после того, как проход отобрал доступные ноды."""
+        if not db:
+            return
+        if self._lock.locked():
+            self._rerun = True
+            return
+        
+        async with self._lock:
+            self._rerun = True
+            while self._rerun:
+                self._rerun = False
+                await self._process_once()
+    
+    async def _process_once(self):
+        # Операции для недоступных нод не читаются и не тратят попытку
+        server_ids = [server_id for server_id in XRAY_SERVERS if xray_nodes.is_available(server_id)]
+        node_due = await asyncio.gather(*[
+            db_repo.run(outbox_get_due, server_id, self.batch_size) for server_id in server_ids
+        ])
+        due = [item for items in node_due for item in items]
+        
+        done, failed = [], []
+        groups = {}
+        for item in due:
+            groups.setdefault((item['server_id'], item['op']), []).append(item)
+        
+        async def run_group(server_id: str, op: str, items: List[dict]):
+            try:
+                if op == "add":
+                    results = await bulk_add_to_node(server_id, [item['uuid'] for item in items])
+                    outcomes = [results.get(item['uuid'], False) for item in items]
+                else:
+                    outcomes = await asyncio.gather(
+                        *[remove_from_node(server_id, item['uuid']) for item in items],
+                        return_exceptions=True
+                    )
+            except Exception as e:
+                outcomes = [e] * len(items)
+            
+            for item, outcome in zip(items, outcomes):
+                if outcome is True:
+                    done.append(item)
+                else:
+                    failed.append((item, str(outcome) if isinstance(outcome, Exception) else "node rejected"))
+        
+        await asyncio.gather(*[run_group(server_id, op, items) for (server_id, op), items in groups.items()])
+        
+        dead = []
+        if done or failed:
+            dead = await db_repo.run(outbox_complete, done, failed)
+            logger.info(f"🔁 Outbox: {len(done)} operations done, {len(failed) - len(dead)} rescheduled")
+        for item in dead:
+            logger.error(
+                f"❌ Outbox gave up on {item['op']} of {item['uuid']} on {item['server_id']} "
+                f"after {item['attempts']} attempts: {item['last_error']}"
+            )
+        
+        self.processed += len(done)
+        self.failed += len(failed)
+        self.dead_lettered += len(dead)
+        self.last_run_at = datetime.now().isoformat()
+    
+    def stats(self) -> dict:
+        return {
+            "processed": self.processed,
+            "failed_attempts": self.failed,
+            "dead_lettered": self.dead_lettered,
+            "last_run_at": self.last_run_at
+        }
+
+provisioning_outbox = ProvisioningOutbox(OUTBOX_BATCH_SIZE)
+
+def start_xray_jobs():
+    """Запуск фоновых задач по нодам: сверка с подписками и сбор статистики"""
+    try:
+        scheduler.add_job(
+            xray_reconciler.run,
+            IntervalTrigger(minutes=RECONCILE_INTERVAL_MINUTES, jitter=30),
+            id='xray_reconcile',
+            replace_existing=True,
+            coalesce=True,
+            max_instances=1
+        )
+        if not scheduler.running:
+            scheduler.start()
+        scheduler.add_job(
+            node_stats.poll,
+            IntervalTrigger(seconds=NODE_STATS_INTERVAL),
+            id='node_stats_poll',
+            replace_existing=True,
+            coalesce=True,
+            max_instances=1,
+            next_run_time=datetime.now()
+        )
+        scheduler.add_job(
+            provisioning_outbox.process,
+            IntervalTrigger(seconds=OUTBOX_INTERVAL),
+            id='provisioning_outbox',
+            replace_existing=True,
+            coalesce=True,
+            max_instances=1,
+            next_run_time=datetime.now()
+        )
+        scheduler.add_job(
+            traffic_collector.collect,
+            IntervalTrigger(seconds=TRAFFIC_COLLECT_INTERVAL),
+            id='traffic_collect',
+            replace_existing=True,
+            coalesce=True,
+            max_instances=1
+        )
+        logger.info(f"✅ Xray jobs started (reconcile: {RECONCILE_INTERVAL_MINUTES} min, stats: {NODE_STATS_INTERVAL} s)")
+    except Exception as e:
+        logger.error(f"❌ Error starting Xray jobs: {e}")
+
 # Функция для запуска бота в отдельном процессе
 def run_bot():
     """Запуск бота в отдельном процессе"""
@@ -915,16 +2785,35 @@ def run_bot():
 @app.on_event("startup")
 async def startup_event():
     """Действия при запуске приложения"""
+    global main_loop
     logger.info("🚀 VAC VPN Server starting up...")
     
+    main_loop = asyncio.get_running_loop()
+    
     ensure_logo_exists()
+    await xray_nodes.startup()
+    spawn_background(entitlement_index.load())
     start_subscription_checker()
+    start_xray_jobs()
+    start_payment_sweeper()
     
     logger.info("🔄 Starting Telegram bot automatically...")
     bot_thread = threading.Thread(target=run_bot, daemon=True)
     bot_thread.start()
     logger.info("✅ Telegram bot started successfully")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Действия при остановке приложения"""
+    logger.info("🛑 VAC VPN Server shutting down...")
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
+    await xray_provisioning_queue.flush()
+    await traffic_collector.flush()
+    await yookassa.shutdown()
+    await xray_nodes.shutdown()
+    db_repo.shutdown()
+
 # API ЭНДПОИНТЫ
 @app.get("/")
 async def root():
@@ -943,8 +2832,13 @@ async def root():
         "timestamp": datetime.now().isoformat()
     }
 
+def is_admin_request(request: Request) -> bool:
+    """Проверяет заголовок X-Admin-Key. Без ADMIN_API_KEY доступ закрыт"""
+    provided = request.headers.get("x-admin-key", "")
+    return bool(ADMIN_API_KEY) and hmac.compare_digest(provided.encode(), ADMIN_API_KEY.encode())
+
 @app.get("/health")
-async def health_check():
+async def health_check(request: Request):
     xray_users_count = await get_xray_users_count()
     return {
         "status": "healthy",
@@ -952,16 +2846,31 @@ async def health_check():
         "service": "VAC VPN API",
         "firebase": "connected" if db else "disconnected",
         "xray_users": xray_users_count,
+        "xray_nodes": node_stats.snapshot(),
+        "circuit_breakers": xray_nodes.breaker_stats(),
+        "provisioning_outbox": provisioning_outbox.stats(),
+        "payment_streams": payment_status_hub.stats(),
+        "payment_sweeper": payment_sweeper.stats(),
+        "yookassa": yookassa.stats(),
         "available_servers": [server["name"] for server in VLESS_SERVERS],
         "database_connected": db is not None,
+        "user_cache": user_cache.stats(),
+        "provisioning_queue": xray_provisioning_queue.stats(),
+        "subscription_checker": subscription_checker_stats,
+        "entitlement_index": entitlement_index.stats(),
+        "reconciler": xray_reconciler.stats(),
+        "traffic": traffic_collector.stats(include_users=is_admin_request(request)),
         "environment": "production"
     }
 
 @app.get("/servers")
 async def get_available_servers():
+    servers = rank_servers()
+    if servers:
+        servers[0]["recommended"] = True
     return {
         "success": True,
-        "servers": VLESS_SERVERS
+        "servers": servers
     }
 
 @app.get("/debug-servers")
@@ -969,16 +2878,15 @@ async def debug_servers():
     results = {}
     for server_name, server_config in XRAY_SERVERS.items():
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(
-                    f"{server_config['url']}/health",
-                    timeout=5.0
-                )
-                results[server_name] = {
-                    "status": response.status_code,
-                    "url": server_config['url'],
-                    "healthy": response.status_code == 200
-                }
+            response = await xray_nodes.get(server_name).get(
+                f"{server_config['url']}/health",
+                timeout=5.0
+            )
+            results[server_name] = {
+                "status": response.status_code,
+                "url": server_config['url'],
+                "healthy": response.status_code == 200
+            }
         except Exception as e:
             results[server_name] = {
                 "error": str(e),
@@ -993,15 +2901,7 @@ async def clear_referrals(user_id: str):
         if not db:
             return {"error": "Database not connected"}
         
-        referrals_ref = db.collection('referrals').where('referrer_id', '==', user_id)
-        referrals = referrals_ref.stream()
-        for ref in referrals:
-            ref.reference.delete()
-        
-        user_ref = db.collection('users').document(user_id)
-        user_ref.update({
-            'referred_by': firestore.DELETE_FIELD
-        })
+        await db_repo.clear_referrals(user_id)
         
         return {"success": True, "message": "Referrals cleared"}
         
@@ -1026,22 +2926,18 @@ async def init_user(request: InitUserRequest):
             referrer_id = extract_referrer_id(request.start_param)
             
             if referrer_id:
-                referrer = get_user(referrer_id)
+                referrer = await db_repo.get_user(referrer_id)
                 
                 if referrer and referrer_id != request.user_id:
-                    referral_id = f"{referrer_id}_{request.user_id}"
-                    referral_exists = db.collection('referrals').document(referral_id).get().exists
-                    
-                    if not referral_exists:
+                    if not await db_repo.referral_exists(referrer_id, request.user_id):
                         is_referral = True
-                        bonus_result = add_referral_bonus_immediately(referrer_id, request.user_id)
+                        bonus_result = await db_repo.add_referral_bonus(referrer_id, request.user_id)
                         if bonus_result:
                             bonus_applied = True
         
-        user_ref = db.collection('users').document(request.user_id)
-        user_doc = user_ref.get()
+        user_data = await db_repo.get_user(request.user_id)
         
-        if not user_doc.exists:
+        if not user_data:
             user_data = {
                 'user_id': request.user_id,
                 'username': request.username,
@@ -1054,7 +2950,6 @@ async def init_user(request: InitUserRequest):
                 'subscription_end': None,
                 'vless_uuid': None,
                 'preferred_server': None,
-                'last_subscription_check': datetime.now().date().isoformat(),
                 'created_at': firestore.SERVER_TIMESTAMP
             }
             
@@ -1065,7 +2960,7 @@ async def init_user(request: InitUserRequest):
             referral_link = generate_referral_link(request.user_id)
             user_data['referral_link'] = referral_link
             
-            user_ref.set(user_data)
+            await db_repo.create_user(request.user_id, user_data)
             
             return {
                 "success": True, 
@@ -1076,13 +2971,12 @@ async def init_user(request: InitUserRequest):
                 "referral_link": referral_link
             }
         else:
-            user_data = user_doc.to_dict()
             has_referrer = user_data.get('referred_by') is not None
             
             # Если у пользователя еще нет реферальной ссылки, генерируем и сохраняем её
             if not user_data.get('referral_link'):
                 referral_link = generate_referral_link(request.user_id)
-                save_referral_link(request.user_id, referral_link)
+                await db_repo.save_referral_link(request.user_id, referral_link)
             else:
                 referral_link = user_data.get('referral_link')
             
@@ -1099,21 +2993,45 @@ async def init_user(request: InitUserRequest):
         logger.error(f"❌ Error initializing user: {e}")
         return JSONResponse(status_code=500, content={"error": str(e)})
 
+def parse_fields(fields: str = None) -> Optional[set]:
+    """Разбирает параметр fields=a,b,c. None означает все поля"""
+    if not fields:
+        return None
+    return {field.strip() for field in fields.split(',') if field.strip()}
+
+def project_fields(data: dict, requested: Optional[set]) -> dict:
+    """Оставляет в ответе только запрошенные поля (user_id возвращается всегда)"""
+    if requested is None:
+        return data
+    return {key: value for key, value in data.items() if key == "user_id" or key in requested}
+
 @app.get("/user-data")
-async def get_user_info(user_id: str):
+async def get_user_info(user_id: str, fields: str = None):
     try:
         if not db:
             return JSONResponse(status_code=500, content={"error": "Database not connected"})
         
         if not user_id or user_id == 'unknown':
             return JSONResponse(status_code=400, content={"error": "Invalid user ID"})
-            
-        # БЫСТРАЯ проверка подписки без блокировки
-        asyncio.create_task(process_subscription_days_async(user_id))
-            
-        user = get_user(user_id)
+        
+        requested = parse_fields(fields)
+        need_vless_keys = requested is None or "vless_keys" in requested
+        need_referrals = requested is None or "referral_stats" in requested
+        
+        # Независимые чтения выполняем параллельно
+        reads = [db_repo.get_user(user_id)]
+        if need_vless_keys:
+            reads.append(db_repo.get_user_vless_keys(user_id))
+        if need_referrals:
+            reads.append(db_repo.get_referrals(user_id))
+        
+        results = await asyncio.gather(*reads)
+        user = results[0]
+        vless_keys = results[1] if need_vless_keys else []
+        referrals = results[-1] if need_referrals else []
+        
         if not user:
-            return {
+            return project_fields({
                 "user_id": user_id,
                 "balance": 0,
                 "has_subscription": False,
@@ -1123,10 +3041,10 @@ async def get_user_info(user_id: str):
                 "subscription_start": None,
                 "subscription_end": None,
                 "referral_link": None
-            }
+            }, requested)
         
-        has_subscription = user.get('has_subscription', False)
-        subscription_days = user.get('subscription_days', 0)
+        has_subscription = is_subscription_active(user)
+        subscription_days = get_subscription_days(user)
         vless_uuid = user.get('vless_uuid')
         balance = user.get('balance', 0.0)
         preferred_server = user.get('preferred_server')
@@ -1134,13 +3052,10 @@ async def get_user_info(user_id: str):
         subscription_end = user.get('subscription_end')
         referral_link = user.get('referral_link')
         
-        vless_keys = get_user_vless_keys(user_id)
-        
-        referrals = get_referrals(user_id)
         referral_count = len(referrals)
         total_bonus_money = sum([ref.get('referrer_bonus', 0) for ref in referrals])
         
-        return {
+        return project_fields({
             "user_id": user_id,
             "balance": balance,
             "has_subscription": has_subscription,
@@ -1150,6 +3065,10 @@ async def get_user_info(user_id: str):
             "subscription_start": subscription_start,
             "subscription_end": subscription_end,
             "referral_link": referral_link,
+            "traffic": {
+                "uplink": user.get('traffic_uplink', 0),
+                "downlink": user.get('traffic_downlink', 0)
+            },
             "vless_keys": vless_keys,
             "referral_stats": {
                 "total_referrals": referral_count,
@@ -1158,26 +3077,19 @@ async def get_user_info(user_id: str):
                 "referred_bonus": REFERRAL_BONUS_REFERRED
             },
             "available_servers": VLESS_SERVERS
-        }
+        }, requested)
         
     except Exception as e:
         logger.error(f"❌ Error in get_user_info: {e}")
         return JSONResponse(status_code=500, content={"error": f"Error getting user info: {str(e)}"})
 
-async def process_subscription_days_async(user_id: str):
-    """Асинхронная обработка дней подписки"""
-    try:
-        process_subscription_days(user_id)
-    except Exception as e:
-        logger.error(f"❌ Error in async subscription processing: {e}")
-
 @app.post("/add-balance")
 async def add_balance(request: AddBalanceRequest):
     try:
         if not db:
             return JSONResponse(status_code=500, content={"error": "Database not connected"})
             
-        user = get_user(request.user_id)
+        user = await db_repo.get_user(request.user_id)
         if not user:
             return JSONResponse(status_code=404, content={"error": "User not found"})
         
@@ -1188,14 +3100,11 @@ async def add_balance(request: AddBalanceRequest):
             return JSONResponse(status_code=400, content={"error": "Максимальная сумма пополнения 50,000₽"})
         
         if request.payment_method == "yookassa":
-            SHOP_ID = os.getenv("SHOP_ID")
-            API_KEY = os.getenv("API_KEY")
-            
-            if not SHOP_ID or not API_KEY:
+            if not yookassa.configured:
                 return JSONResponse(status_code=500, content={"error": "Payment gateway not configured"})
             
             payment_id = str(uuid.uuid4())
-            save_payment(payment_id, request.user_id, request.amount, "balance", "balance", "yookassa")
+            await db_repo.save_payment(payment_id, request.user_id, request.amount, "balance", "balance", "yookassa")
             
             yookassa_data = {
                 "amount": {"value": f"{request.amount:.2f}", "currency": "RUB"},
@@ -1210,21 +3119,11 @@ async def add_balance(request: AddBalanceRequest):
                 }
             }
             
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    "https://api.yookassa.ru/v3/payments",
-                    auth=(SHOP_ID, API_KEY),
-                    headers={
-                        "Content-Type": "application/json",
-                        "Idempotence-Key": payment_id
-                    },
-                    json=yookassa_data,
-                    timeout=30.0
-                )
+            response = await yookassa.create_payment(yookassa_data, payment_id)
             
             if response.status_code in [200, 201]:
                 payment_data = response.json()
-                update_payment_status(payment_id, "pending", payment_data.get("id"))
+                await db_repo.update_payment_status(payment_id, "pending", payment_data.get("id"))
                 
                 return {
                     "success": True,
@@ -1249,7 +3148,7 @@ async def activate_tariff(request: ActivateTariffRequest):
         if not db:
             return JSONResponse(status_code=500, content={"error": "Database not connected"})
             
-        user = get_user(request.user_id)
+        user = await db_repo.get_user(request.user_id)
         if not user:
             return JSONResponse(status_code=404, content={"error": "User not found"})
         
@@ -1260,34 +3159,27 @@ async def activate_tariff(request: ActivateTariffRequest):
         tariff_price = tariff_data["price"]
         tariff_days = tariff_data["days"]
         
-        selected_server = request.selected_server or user.get('preferred_server') or "London"
+        selected_server = resolve_server(
+            request.selected_server or request.preferred_server or user.get('preferred_server') or "London"
+        )
         
         if request.payment_method == "balance":
-            user_balance = user.get('balance', 0.0)
-            
-            if user_balance < tariff_price:
-                return JSONResponse(status_code=400, content={"error": f"Недостаточно средств на балансе. Необходимо: {tariff_price}₽, доступно: {user_balance}₽"})
-            
             payment_id = str(uuid.uuid4())
-            save_payment(payment_id, request.user_id, tariff_price, request.tariff, "tariff", "balance", selected_server)
+            paid, user_balance = await db_repo.run(pay_from_balance, payment_id, request.user_id, tariff_price, request.tariff, selected_server)
             
-            update_user_balance(request.user_id, -tariff_price)
+            if not paid:
+                if user_balance is None:
+                    return JSONResponse(status_code=404, content={"error": "User not found"})
+                return JSONResponse(status_code=400, content={"error": f"Недостаточно средств на балансе. Необходимо: {tariff_price}₽, доступно: {user_balance}₽"})
             
-            success = await update_subscription_days(request.user_id, tariff_days, selected_server)
+            success = await update_subscription_days(request.user_id, tariff_days, selected_server, payment_id)
             
             if not success:
                 return JSONResponse(status_code=500, content={"error": "Ошибка активации подписки"})
             
-            if user.get('referred_by'):
-                referrer_id = user['referred_by']
-                referral_id = f"{referrer_id}_{request.user_id}"
-                
-                referral_exists = db.collection('referrals').document(referral_id).get().exists
-                
-                if not referral_exists:
-                    add_referral_bonus_immediately(referrer_id, request.user_id)
+            await db_repo.apply_referral_bonus_if_missing(user, request.user_id)
             
-            update_payment_status(payment_id, "succeeded")
+            await db_repo.update_payment_status(payment_id, "succeeded")
             
             return {
                 "success": True,
@@ -1300,14 +3192,11 @@ async def activate_tariff(request: ActivateTariffRequest):
             }
         
         elif request.payment_method == "yookassa":
-            SHOP_ID = os.getenv("SHOP_ID")
-            API_KEY = os.getenv("API_KEY")
-            
-            if not SHOP_ID or not API_KEY:
+            if not yookassa.configured:
                 return JSONResponse(status_code=500, content={"error": "Payment gateway not configured"})
             
             payment_id = str(uuid.uuid4())
-            save_payment(payment_id, request.user_id, tariff_price, request.tariff, "tariff", "yookassa", selected_server)
+            await db_repo.save_payment(payment_id, request.user_id, tariff_price, request.tariff, "tariff", "yookassa", selected_server)
             
             yookassa_data = {
                 "amount": {"value": f"{tariff_price:.2f}", "currency": "RUB"},
@@ -1324,21 +3213,11 @@ async def activate_tariff(request: ActivateTariffRequest):
                 }
             }
             
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    "https://api.yookassa.ru/v3/payments",
-                    auth=(SHOP_ID, API_KEY),
-                    headers={
-                        "Content-Type": "application/json",
-                        "Idempotence-Key": payment_id
-                    },
-                    json=yookassa_data,
-                    timeout=30.0
-                )
+            response = await yookassa.create_payment(yookassa_data, payment_id)
             
             if response.status_code in [200, 201]:
                 payment_data = response.json()
-                update_payment_status(payment_id, "pending", payment_data.get("id"))
+                await db_repo.update_payment_status(payment_id, "pending", payment_data.get("id"))
                 
                 return {
                     "success": True,
@@ -1366,40 +3245,31 @@ async def buy_with_balance(request: BuyWithBalanceRequest):
         if not db:
             return JSONResponse(status_code=500, content={"error": "Database not connected"})
         
-        user = get_user(request.user_id)
+        user = await db_repo.get_user(request.user_id)
         if not user:
             return JSONResponse(status_code=404, content={"error": "User not found"})
         
-        selected_server = request.selected_server or "London"
+        selected_server = resolve_server(request.selected_server) or "London"
         
-        user_balance = user.get('balance', 0.0)
+        payment_id = str(uuid.uuid4())
+        paid, user_balance = await db_repo.run(pay_from_balance, payment_id, request.user_id, request.tariff_price, request.tariff_id, selected_server)
         
-        if user_balance < request.tariff_price:
+        if not paid:
+            if user_balance is None:
+                return JSONResponse(status_code=404, content={"error": "User not found"})
             return JSONResponse(status_code=400, content={
                 "success": False,
                 "error": f"Недостаточно средств на балансе. На вашем балансе {user_balance}₽, а требуется {request.tariff_price}₽"
             })
         
-        payment_id = str(uuid.uuid4())
-        save_payment(payment_id, request.user_id, request.tariff_price, request.tariff_id, "tariff", "balance", selected_server)
-        
-        update_user_balance(request.user_id, -request.tariff_price)
-        
-        success = await update_subscription_days(request.user_id, request.tariff_days, selected_server)
+        success = await update_subscription_days(request.user_id, request.tariff_days, selected_server, payment_id)
         
         if not success:
             return JSONResponse(status_code=500, content={"error": "Ошибка активации подписки"})
         
-        if user.get('referred_by'):
-            referrer_id = user['referred_by']
-            referral_id = f"{referrer_id}_{request.user_id}"
-            
-            referral_exists = db.collection('referrals').document(referral_id).get().exists
-            
-            if not referral_exists:
-                add_referral_bonus_immediately(referrer_id, request.user_id)
+        await db_repo.apply_referral_bonus_if_missing(user, request.user_id)
         
-        update_payment_status(payment_id, "succeeded")
+        await db_repo.update_payment_status(payment_id, "succeeded")
         
         return {
             "success": True,
@@ -1415,8 +3285,309 @@ async def buy_with_balance(request: BuyWithBalanceRequest):
         logger.error(f"❌ Error in buy-with-balance: {e}")
         return JSONResponse(status_code=500, content={"error": str(e)})
 
+def is_payment_settled(payment: dict) -> bool:
+    """Финальное состояние для клиента: отмена или оплата с выполненным зачислением.
+    
+    У оплаченного тарифа fulfilled=false, пока подписка не продлена; у платежей,
+    созданных до появления поля, его нет, и они считаются выполненными.
+    """
+    if payment['status'] == 'succeeded':
+        return payment.get('fulfilled', True)
+    return payment['status'] in PAYMENT_FINAL_STATUSES
+
+def payment_status_response(payment_id: str, payment: dict) -> dict:
+    if payment['status'] == 'succeeded':
+        if payment['payment_type'] == 'balance':
+            return {
+                "success": True,
+                "status": "succeeded",
+                "fulfilled": payment.get('fulfilled', True),
+                "payment_id": payment_id,
+                "amount": payment['amount'],
+                "balance_added": payment['amount']
+            }
+        return {
+            "success": True,
+            "status": "succeeded",
+            "fulfilled": payment.get('fulfilled', True),
+            "payment_id": payment_id,
+            "amount": payment['amount'],
+            "selected_server": payment.get('selected_server')
+        }
+    
+    return {
+        "success": True,
+        "status": payment['status'],
+        "payment_id": payment_id
+    }
+
+class PaymentStatusHub:
+    """Pub/sub статусов платежей внутри процесса: payment_id -> очереди ожидающих клиентов"""
+    
+    def __init__(self):
+        self._subscribers = {}
+    
+    def subscribe(self, payment_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue()
+        self._subscribers.setdefault(payment_id, set()).add(queue)
+        return queue
+    
+    def unsubscribe(self, payment_id: str, queue: asyncio.Queue):
+        subscribers = self._subscribers.get(payment_id)
+        if subscribers is None:
+            return
+        subscribers.discard(queue)
+        if not subscribers:
+            del self._subscribers[payment_id]
+    
+    def publish(self, payment_id: str, payment: dict):
+        for queue in self._subscribers.get(payment_id, ()):
+            queue.put_nowait(dict(payment))
+    
+    def stats(self) -> dict:
+        return {
+            "payments": len(self._subscribers),
+            "subscribers": sum(len(subscribers) for subscribers in self._subscribers.values())
+        }
+
+payment_status_hub = PaymentStatusHub()
+
+async def fetch_yookassa_payment(yookassa_id: str) -> Optional[dict]:
+    """Запрашивает платеж в API ЮKassa. Возвращает объект платежа или None"""
+    if not yookassa.configured:
+        logger.error("❌ Payment gateway not configured")
+        return None
+    
+    try:
+        response = await yookassa.get_payment(yookassa_id)
+    except httpx.HTTPError as e:
+        logger.warning(f"⚠️ YooKassa request for payment {yookassa_id} failed: {e!r}")
+        return None
+    
+    if response.status_code != 200:
+        logger.warning(f"⚠️ YooKassa returned {response.status_code} for payment {yookassa_id}")
+        return None
+    return response.json()
+
+async def fulfill_tariff_payment(payment_id: str, payment: dict) -> bool:
+    """Продлевает подписку по оплаченному тарифу и отмечает платеж выполненным.
+    
+    Продление и fulfilled=true записываются одной транзакцией, поэтому повторный
+    вызов (например, из PaymentSweeper) подписку второй раз не продлевает.
+    """
+    user_id = payment['user_id']
+    tariff_days = TARIFFS[payment['tariff']]["days"]
+    success = await update_subscription_days(user_id, tariff_days, payment.get('selected_server'), payment_id)
+    if success:
+        payment_status_hub.publish(payment_id, {**payment, 'status': 'succeeded', 'fulfilled': True})
+        user = await db_repo.get_user(user_id)
+        await db_repo.apply_referral_bonus_if_missing(user, user_id)
+    return success
+
+async def settle_payment(payment_id: str, payment: dict, status: str) -> bool:
+    """Применяет статус платежа, полученный от ЮKassa.
+    
+    Проведенный или отмененный платеж больше не меняется, поэтому повторные
+    уведомления по нему ничего не зачисляют. Пополнение баланса зачисляется в той же
+    транзакции, что и смена статуса; у тарифа fulfilled=false до продления подписки.
+    """
+    if payment['status'] in PAYMENT_FINAL_STATUSES or payment['status'] == status:
+        return True
+    
+    # Транзакция с проверкой статуса: параллельные вызовы зачисляют платеж один раз
+    claimed, payment = await db_repo.run(claim_payment_settlement, payment_id, status)
+    if not claimed:
+        return payment is not None
+    payment['status'] = status
+    
+    if status != 'succeeded':
+        logger.info(f"💳 Payment {payment_id} is now {status}")
+        payment_status_hub.publish(payment_id, payment)
+        return True
+    
+    user_id = payment['user_id']
+    if payment['payment_type'] == 'balance':
+        user_cache.invalidate(user_id)
+        payment['fulfilled'] = True
+        payment_status_hub.publish(payment_id, payment)
+        success = True
+    else:
+        # Оплата прошла, но подписка еще продлевается: ожидающим промежуточное событие,
+        # финальное публикует fulfill_tariff_payment
+        payment['fulfilled'] = False
+        payment_status_hub.publish(payment_id, payment)
+        success = await fulfill_tariff_payment(payment_id, payment)
+    
+    if success:
+        logger.info(f"✅ Payment {payment_id} settled for user {user_id}")
+    else:
+        logger.error(f"❌ Failed to settle payment {payment_id} for user {user_id}")
+    return success
+
+class PaymentSweeper:
+    """Периодическая сверка платежей, по которым не пришло уведомление ЮKassa.
+    
+    Ожидающие платежи перезапрашиваются в API постранично и проводятся через
+    settle_payment. Оплаченные тарифы с fulfilled=false продлеваются повторно.
+    """
+    
+    def __init__(self, page_size: int, concurrency: int):
+        self.page_size = page_size
+        self.concurrency = concurrency
+        self.runs = 0
+        self.checked = 0
+        self.settled = 0
+        self.fulfilled = 0
+        self.errors = 0
+        self.last_run_at = None
+    
+    async def check_payment(self, payment: dict):
+        payment_id = payment['payment_id']
+        yookassa_data = await fetch_yookassa_payment(payment['yookassa_id'])
+        self.checked += 1
+        if not yookassa_data:
+            self.errors += 1
+            return
+        
+        status = yookassa_data.get('status')
+        if status != payment['status']:
+            if await settle_payment(payment_id, payment, status):
+                self.settled += 1
+            else:
+                self.errors += 1
+    
+    async def sweep(self):
+        if not db:
+            return
+        
+        self.runs += 1
+        self.last_run_at = datetime.now().isoformat()
+        cutoff = datetime.now(timezone.utc) - PAYMENT_SWEEP_MIN_AGE
+        
+        last_doc = None
+        while True:
+            payments, last_doc = await db_repo.run(get_payments_page, 'pending', cutoff, self.page_size, last_doc)
+            payments = [payment for payment in payments if payment.get('yookassa_id')]
+            
+            results = await gather_bounded(
+                [self.check_payment(payment) for payment in payments],
+                self.concurrency
+            )
+            for result in results:
+                if isinstance(result, Exception):
+                    self.errors += 1
+                    logger.error(f"❌ Payment sweep error: {result}")
+            
+            if last_doc is None:
+                break
+        
+        last_doc = None
+        while True:
+            payments, last_doc = await db_repo.run(get_payments_page, 'succeeded', cutoff, self.page_size, last_doc, True)
+            for payment in payments:
+                if await fulfill_tariff_payment(payment['payment_id'], payment):
+                    self.fulfilled += 1
+                else:
+                    self.errors += 1
+            if last_doc is None:
+                break
+    
+    def stats(self) -> dict:
+        return {
+            "runs": self.runs,
+            "checked": self.checked,
+            "settled": self.settled,
+            "fulfilled": self.fulfilled,
+            "errors": self.errors,
+            "last_run_at": self.last_run_at
+        }
+
+payment_sweeper = PaymentSweeper(PAYMENT_SWEEP_PAGE_SIZE, PAYMENT_SWEEP_CONCURRENCY)
+
+def start_payment_sweeper():
+    """Запуск периодической сверки платежей с ЮKassa"""
+    try:
+        scheduler.add_job(
+            payment_sweeper.sweep,
+            IntervalTrigger(minutes=PAYMENT_SWEEP_INTERVAL_MINUTES),
+            id='payment_sweep',
+            replace_existing=True,
+            coalesce=True,
+            max_instances=1
+        )
+        if not scheduler.running:
+            scheduler.start()
+        logger.info(f"✅ Payment sweeper started (interval: {PAYMENT_SWEEP_INTERVAL_MINUTES} minutes)")
+    except Exception as e:
+        logger.error(f"❌ Error starting payment sweeper: {e}")
+
+def is_yookassa_address(request: Request) -> bool:
+    """Проверяет, что уведомление пришло с адреса ЮKassa. Пустой список отключает проверку"""
+    if not YOOKASSA_WEBHOOK_NETWORKS:
+        return True
+    
+    # Левые записи X-Forwarded-For задает сам клиент, доверять можно только
+    # записи, добавленной нашим прокси
+    host = request.client.host if request.client else ""
+    forwarded = [hop.strip() for hop in request.headers.get("x-forwarded-for", "").split(",") if hop.strip()]
+    if TRUSTED_PROXY_HOPS and forwarded:
+        host = forwarded[-min(TRUSTED_PROXY_HOPS, len(forwarded))]
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return any(address in network for network in YOOKASSA_WEBHOOK_NETWORKS)
+
+@app.post("/yookassa/webhook")
+async def yookassa_webhook(request: Request):
+    """Уведомления ЮKassa о смене статуса платежа.
+    
+    Тело уведомления не подписано, поэтому статус не берется из него: платеж
+    перезапрашивается в API, и применяется только подтвержденный статус.
+    """
+    try:
+        if not db:
+            return JSONResponse(status_code=500, content={"error": "Database not connected"})
+        
+        if not is_yookassa_address(request):
+            logger.warning(f"⚠️ Rejected YooKassa webhook from {request.client.host if request.client else 'unknown'}")
+            return JSONResponse(status_code=403, content={"error": "Forbidden"})
+        
+        notification = await request.json()
+        event = notification.get('event')
+        payment_object = notification.get('object') or {}
+        yookassa_id = payment_object.get('id')
+        payment_id = (payment_object.get('metadata') or {}).get('payment_id')
+        
+        if event not in ('payment.succeeded', 'payment.canceled') or not yookassa_id or not payment_id:
+            return {"success": True, "ignored": True}
+        
+        payment = await db_repo.get_payment(payment_id)
+        if not payment or payment.get('yookassa_id') != yookassa_id:
+            logger.warning(f"⚠️ YooKassa webhook for unknown payment {payment_id} ({yookassa_id})")
+            return {"success": True, "ignored": True}
+        
+        if payment['status'] in PAYMENT_FINAL_STATUSES:
+            return {"success": True, "status": payment['status']}
+        
+        yookassa_data = await fetch_yookassa_payment(yookassa_id)
+        if not yookassa_data:
+            # Ответ не 200 — ЮKassa повторит уведомление
+            return JSONResponse(status_code=502, content={"error": "Payment verification failed"})
+        
+        status = yookassa_data.get('status')
+        if not await settle_payment(payment_id, payment, status):
+            return JSONResponse(status_code=500, content={"error": "Settlement failed"})
+        
+        return {"success": True, "status": status}
+        
+    except Exception as e:
+        logger.error(f"❌ Error processing YooKassa webhook: {e}")
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
 @app.get("/payment-status")
 async def check_payment(payment_id: str, user_id: str):
+    """Статус платежа из Firestore. Статус обновляется уведомлениями ЮKassa"""
     try:
         if not db:
             return JSONResponse(status_code=500, content={"error": "Database not connected"})
@@ -1424,7 +3595,7 @@ async def check_payment(payment_id: str, user_id: str):
         if not payment_id or payment_id == 'undefined':
             return JSONResponse(status_code=400, content={"error": "Invalid payment ID"})
             
-        payment = get_payment(payment_id)
+        payment = await db_repo.get_payment(payment_id)
         if not payment:
             return JSONResponse(status_code=404, content={"error": "Payment not found"})
         
@@ -1433,130 +3604,93 @@ async def check_payment(payment_id: str, user_id: str):
         if not actual_user_id or actual_user_id == 'undefined':
             return JSONResponse(status_code=400, content={"error": "Invalid user ID"})
         
-        if payment['status'] == 'succeeded':
-            if payment['payment_type'] == 'balance':
-                return {
-                    "success": True,
-                    "status": "succeeded",
-                    "payment_id": payment_id,
-                    "amount": payment['amount'],
-                    "balance_added": payment['amount']
-                }
-            else:
-                return {
-                    "success": True,
-                    "status": "succeeded",
-                    "payment_id": payment_id,
-                    "amount": payment['amount'],
-                    "selected_server": payment.get('selected_server')
-                }
-        
-        if payment.get('payment_method') == 'yookassa':
-            yookassa_id = payment.get('yookassa_id')
-            if yookassa_id:
-                SHOP_ID = os.getenv("SHOP_ID")
-                API_KEY = os.getenv("API_KEY")
-                
-                if not SHOP_ID or not API_KEY:
-                    return JSONResponse(status_code=500, content={"error": "Payment gateway not configured"})
-                
-                async with httpx.AsyncClient() as client:
-                    response = await client.get(
-                        f"https://api.yookassa.ru/v3/payments/{yookassa_id}",
-                        auth=(SHOP_ID, API_KEY),
-                        timeout=30.0
-                    )
-                    
-                    if response.status_code == 200:
-                        yookassa_data = response.json()
-                        status = yookassa_data.get('status')
-                        
-                        update_payment_status(payment_id, status, yookassa_id)
-                        
-                        if status == 'succeeded':
-                            if payment['payment_type'] == 'balance':
-                                amount = payment['amount']
-                                success = update_user_balance(actual_user_id, amount)
-                                
-                                if success:
-                                    return {
-                                        "success": True,
-                                        "status": status,
-                                        "payment_id": payment_id,
-                                        "amount": amount,
-                                        "balance_added": amount,
-                                        "message": f"Баланс успешно пополнен на {amount}₽!"
-                                    }
-                                else:
-                                    return JSONResponse(status_code=500, content={"error": "Ошибка пополнения баланса"})
-                            
-                            tariff_user_id = payment.get('user_id', actual_user_id)
-                            tariff = payment['tariff']
-                            tariff_days = TARIFFS[tariff]["days"]
-                            selected_server = payment.get('selected_server')
-                            
-                            success = await update_subscription_days(tariff_user_id, tariff_days, selected_server)
-                            
-                            if not success:
-                                return JSONResponse(status_code=500, content={"error": "Failed to activate subscription"})
-                            
-                            user = get_user(tariff_user_id)
-                            if user and user.get('referred_by'):
-                                referrer_id = user['referred_by']
-                                referral_id = f"{referrer_id}_{tariff_user_id}"
-                                
-                                referral_exists = db.collection('referrals').document(referral_id).get().exists
-                                
-                                if not referral_exists:
-                                    add_referral_bonus_immediately(referrer_id, tariff_user_id)
-                            
-                            return {
-                                "success": True,
-                                "status": status,
-                                "payment_id": payment_id,
-                                "amount": payment['amount'],
-                                "days_added": tariff_days,
-                                "selected_server": selected_server
-                            }
-        
-        return {
-            "success": True,
-            "status": payment['status'],
-            "payment_id": payment_id
-        }
+        return payment_status_response(payment_id, payment)
         
     except Exception as e:
         logger.error(f"❌ Error checking payment: {e}")
         return JSONResponse(status_code=500, content={"error": f"Error checking payment: {str(e)}"})
 
+@app.get("/payment-status/stream")
+async def payment_status_stream(payment_id: str, user_id: str, request: Request):
+    """SSE-поток статуса платежа: текущий статус сразу, затем каждое изменение.
+    
+    Поток закрывается, когда платеж отменен или оплачен и зачислен (fulfilled), или
+    по истечении PAYMENT_STREAM_TIMEOUT (событие timeout). Оплаченный, но еще не
+    зачисленный тариф приходит промежуточным событием с fulfilled=false.
+    """
+    if not db:
+        return JSONResponse(status_code=500, content={"error": "Database not connected"})
+    
+    if not payment_id or payment_id == 'undefined':
+        return JSONResponse(status_code=400, content={"error": "Invalid payment ID"})
+    
+    # Подписка до чтения документа, чтобы не пропустить изменение между ними
+    queue = payment_status_hub.subscribe(payment_id)
+    try:
+        payment = await db_repo.get_payment(payment_id)
+    except Exception:
+        payment_status_hub.unsubscribe(payment_id, queue)
+        raise
+    
+    if not payment:
+        payment_status_hub.unsubscribe(payment_id, queue)
+        return JSONResponse(status_code=404, content={"error": "Payment not found"})
+    
+    async def events():
+        try:
+            current = payment
+            yield f"data: {json.dumps(payment_status_response(payment_id, current))}\n\n"
+            
+            deadline = time.monotonic() + PAYMENT_STREAM_TIMEOUT
+            while not is_payment_settled(current):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    yield "event: timeout\ndata: {}\n\n"
+                    return
+                
+                try:
+                    current = await asyncio.wait_for(queue.get(), timeout=min(PAYMENT_STREAM_KEEPALIVE, remaining))
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        return
+                    yield ": keepalive\n\n"
+                    continue
+                
+                yield f"data: {json.dumps(payment_status_response(payment_id, current))}\n\n"
+        finally:
+            payment_status_hub.unsubscribe(payment_id, queue)
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.get("/get-vless-config")
 async def get_vless_config(user_id: str, server_id: str = None):
     try:
         if not db:
             return JSONResponse(status_code=500, content={"error": "Database not connected"})
-            
-        # Асинхронная проверка подписки без блокировки
-        asyncio.create_task(process_subscription_days_async(user_id))
-            
-        user = get_user(user_id)
+        
+        user = await db_repo.get_user(user_id)
         if not user:
             return JSONResponse(status_code=404, content={"error": "User not found"})
         
-        if not user.get('has_subscription', False):
+        if not is_subscription_active(user):
             return JSONResponse(status_code=400, content={"error": "No active subscription"})
         
         # СУПЕР БЫСТРОЕ получение UUID
         vless_uuid = await ensure_user_uuid(user_id, server_id)
         
         # Мгновенное создание конфигов
-        configs = create_user_vless_configs(user_id, vless_uuid, server_id)
+        configs = await db_repo.create_vless_configs(user_id, vless_uuid, server_id)
         
         return {
             "success": True,
             "user_id": user_id,
             "vless_uuid": vless_uuid,
             "has_subscription": True,
-            "subscription_days": user.get('subscription_days', 0),
+            "subscription_days": get_subscription_days(user),
             "selected_server": server_id or "all",
             "configs": configs,
             "config_ready": True,
@@ -1573,7 +3707,7 @@ async def save_vless_key(request: SaveVlessKeyRequest):
         if not db:
             return JSONResponse(status_code=500, content={"error": "Database not connected"})
         
-        success = save_vless_key_to_db(
+        success = await db_repo.save_vless_key(
             request.user_id, 
             request.server_id, 
             request.vless_key, 
@@ -1598,7 +3732,7 @@ async def get_user_vless_keys_endpoint(user_id: str):
         if not db:
             return JSONResponse(status_code=500, content={"error": "Database not connected"})
         
-        vless_keys = get_user_vless_keys(user_id)
+        vless_keys = await db_repo.get_user_vless_keys(user_id)
         
         return {
             "success": True,
@@ -1611,24 +3745,40 @@ async def get_user_vless_keys_endpoint(user_id: str):
         logger.error(f"❌ Error getting user VLESS keys: {e}")
         return JSONResponse(status_code=500, content={"error": str(e)})
 
+def access_result(entry: Optional[tuple]) -> dict:
+    """Формирует ответ проверки доступа по записи индекса (user_id, expires_at)"""
+    if not entry:
+        return {
+            "has_access": False,
+            "reason": "No active subscription"
+        }
+    
+    user_id, expires_at = entry
+    remaining = (expires_at - datetime.now()).total_seconds()
+    return {
+        "has_access": True,
+        "user_id": user_id,
+        "subscription_days": max(0, math.ceil(remaining / 86400)),
+        "expires_at": expires_at.isoformat()
+    }
+
 @app.get("/check-user-access")
 async def check_user_access(user_uuid: str):
     try:
-        users_ref = db.collection('users')
-        query = users_ref.where('vless_uuid', '==', user_uuid).limit(1)
-        results = query.stream()
+        if entitlement_index.loaded:
+            return {"success": True, **access_result(entitlement_index.check(user_uuid))}
+        
+        # Индекс еще загружается - отвечаем из Firestore
+        if not db:
+            return JSONResponse(status_code=500, content={"success": False, "error": "Database not connected"})
+        
+        user_data = await db_repo.find_user_by_uuid(user_uuid)
         
-        for doc in results:
-            user_data = doc.to_dict()
+        if user_data:
             user_id = user_data.get('user_id')
+            subscription_days = get_subscription_days(user_data)
             
-            process_subscription_days(user_id)
-            
-            user_updated = get_user(user_id)
-            has_subscription = user_updated.get('has_subscription', False)
-            subscription_days = user_updated.get('subscription_days', 0)
-            
-            if has_subscription and subscription_days > 0:
+            if subscription_days > 0:
                 return {
                     "success": True,
                     "has_access": True,
@@ -1648,21 +3798,51 @@ async def check_user_access(user_uuid: str):
             content={"success": False, "error": str(e)}
         )
 
+@app.post("/check-user-access/batch")
+async def check_user_access_batch(request: CheckAccessBatchRequest):
+    try:
+        if len(request.uuids) > CHECK_ACCESS_BATCH_LIMIT:
+            return JSONResponse(
+                status_code=400,
+                content={"success": False, "error": f"Too many UUIDs, limit is {CHECK_ACCESS_BATCH_LIMIT}"}
+            )
+        
+        if not entitlement_index.loaded:
+            return JSONResponse(
+                status_code=503,
+                content={"success": False, "error": "Entitlement index is loading"}
+            )
+        
+        return {
+            "success": True,
+            "results": {
+                user_uuid: access_result(entitlement_index.check(user_uuid))
+                for user_uuid in request.uuids
+            }
+        }
+        
+    except Exception as e:
+        return JSONResponse(
+            status_code=500,
+            content={"success": False, "error": str(e)}
+        )
+
 @app.get("/active-users")
 async def get_active_users():
     try:
-        users_ref = db.collection('users')
-        query = users_ref.where('has_subscription', '==', True)
-        results = query.stream()
+        if not db:
+            return JSONResponse(status_code=500, content={"success": False, "error": "Database not connected"})
+        
+        users = await db_repo.get_subscribed_users()
         
         active_users = []
-        for doc in results:
-            user_data = doc.to_dict()
-            if user_data.get('subscription_days', 0) > 0:
+        for user_data in users:
+            subscription_days = get_subscription_days(user_data)
+            if subscription_days > 0:
                 active_users.append({
                     "user_id": user_data.get('user_id'),
                     "uuid": user_data.get('vless_uuid'),
-                    "subscription_days": user_data.get('subscription_days', 0),
+                    "subscription_days": subscription_days,
                     "subscription_start": user_data.get('subscription_start'),
                     "subscription_end": user_data.get('subscription_end')
                 })
@@ -1679,10 +3859,56 @@ async def get_active_users():
             content={"success": False, "error": str(e)}
         )
 
+def entitlement_resync_response() -> dict:
+    return {
+        "success": True,
+        "resync": True,
+        "users": entitlement_index.snapshot(),
+        "cursor": entitlement_index.cursor
+    }
+
+@app.get("/active-users/changes")
+async def get_active_users_changes(cursor: str = None, wait: float = 0):
+    """Дельта-синхронизация для нод: UUID, добавленные и отозванные после курсора.
+    
+    При wait > 0 запрос ждет (long-poll) до появления изменений или истечения wait секунд.
+    Без курсора или с устаревшим курсором возвращается полный снимок с resync=true.
+    """
+    try:
+        if not entitlement_index.loaded:
+            return JSONResponse(
+                status_code=503,
+                content={"success": False, "error": "Entitlement index is loading"}
+            )
+        
+        changes = entitlement_index.changes_since(cursor) if cursor else None
+        
+        if changes is None:
+            return entitlement_resync_response()
+        
+        if not changes and wait > 0:
+            await entitlement_index.wait_for_change(min(wait, ENTITLEMENT_MAX_WAIT))
+            changes = entitlement_index.changes_since(cursor)
+            if changes is None:
+                return entitlement_resync_response()
+        
+        return {
+            "success": True,
+            "resync": False,
+            "changes": changes,
+            "cursor": entitlement_index.cursor
+        }
+        
+    except Exception as e:
+        return JSONResponse(
+            status_code=500,
+            content={"success": False, "error": str(e)}
+        )
+
 @app.post("/force-add-to-xray")
 async def force_add_to_xray(user_id: str, server_id: str = None):
     try:
-        user = get_user(user_id)
+        user = await db_repo.get_user(user_id)
         if not user:
             return JSONResponse(status_code=404, content={"error": "User not found"})
         
@@ -1692,6 +3918,9 @@ async def force_add_to_xray(user_id: str, server_id: str = None):
         
         success = await add_user_to_xray_server(server_id, user_id, vless_uuid)
         
+        if not success and server_id in XRAY_SERVERS:
+            await provisioning_outbox.enqueue("add", server_id, vless_uuid)
+        
         if success:
             return {
                 "success": True,
@@ -1710,7 +3939,7 @@ async def force_add_to_xray(user_id: str, server_id: str = None):
 @app.post("/emergency-add-to-xray")
 async def emergency_add_to_xray(user_id: str):
     try:
-        user = get_user(user_id)
+        user = await db_repo.get_user(user_id)
         if not user:
             return JSONResponse(status_code=404, content={"error": "User not found"})
         
@@ -1718,23 +3947,29 @@ async def emergency_add_to_xray(user_id: str):
         if not vless_uuid:
             return JSONResponse(status_code=400, content={"error": "User has no UUID"})
         
-        success_count = 0
-        for server_name, server_config in XRAY_SERVERS.items():
-            try:
-                success = await add_user_to_xray_server(server_name, user_id, vless_uuid)
-                if success:
-                    success_count += 1
-            except Exception as e:
-                logger.error(f"❌ Emergency add failed for {server_name}: {e}")
+        results = await provision_on_nodes(
+            list(XRAY_SERVERS.keys()),
+            lambda server_id: add_user_to_xray_server(server_id, user_id, vless_uuid),
+            EMERGENCY_ADD_NODE_TIMEOUT,
+            EMERGENCY_ADD_DEADLINE
+        )
+        
+        for server_name, result in results.items():
+            if not result["success"]:
+                logger.error(f"❌ Emergency add failed for {server_name}: {result.get('error', 'API error')}")
+                await provisioning_outbox.enqueue("add", server_name, vless_uuid)
         
-        user_vless_keys = get_user_vless_keys(user_id)
+        success_count = sum(1 for result in results.values() if result["success"])
+        
+        user_vless_keys = await db_repo.get_user_vless_keys(user_id)
         for key_data in user_vless_keys:
-            update_vless_key_status(user_id, key_data['server_id'], True)
+            await db_repo.update_vless_key_status(user_id, key_data['server_id'], True)
         
         return {
             "success": True,
             "message": f"User {user_id} emergency added to {success_count} servers",
             "servers_added": success_count,
+            "servers": results,
             "keys_activated": len(user_vless_keys)
         }
             
@@ -1748,28 +3983,15 @@ async def admin_cancel_subscription(user_id: str):
         if not db:
             return JSONResponse(status_code=500, content={"error": "Database not connected"})
         
-        user_ref = db.collection('users').document(user_id)
-        user = user_ref.get()
+        result = await db_repo.cancel_subscription(user_id)
         
-        if not user.exists:
+        if not result:
             return JSONResponse(status_code=404, content={"error": "User not found"})
         
-        user_data = user.to_dict()
+        user_data, update_data = result
         vless_uuid = user_data.get('vless_uuid')
-        
-        update_data = {
-            'has_subscription': False,
-            'subscription_days': 0,
-            'subscription_start': None,
-            'subscription_end': datetime.now().isoformat(),  # Записываем время окончания подписки
-            'updated_at': firestore.SERVER_TIMESTAMP
-        }
-        
-        user_ref.update(update_data)
-        
-        user_vless_keys = get_user_vless_keys(user_id)
-        for key_data in user_vless_keys:
-            update_vless_key_status(user_id, key_data['server_id'], False)
+        if vless_uuid:
+            entitlement_index.revoke(vless_uuid)
         
         return {
             "success": True,
@@ -1792,7 +4014,7 @@ async def get_referral_link_endpoint(user_id: str):
         if not db:
             return JSONResponse(status_code=500, content={"error": "Database not connected"})
         
-        user = get_user(user_id)
+        user = await db_repo.get_user(user_id)
         if not user:
             return JSONResponse(status_code=404, content={"error": "User not found"})
         
@@ -1800,7 +4022,7 @@ async def get_referral_link_endpoint(user_id: str):
         if not referral_link:
             # Если ссылки нет, генерируем и сохраняем её
             referral_link = generate_referral_link(user_id)
-            save_referral_link(user_id, referral_link)
+            await db_repo.save_referral_link(user_id, referral_link)
         
         return {
             "success": True,
@@ -1819,7 +4041,7 @@ async def get_referral_stats(user_id: str):
         if not db:
             return JSONResponse(status_code=500, content={"error": "Database not connected"})
         
-        referrals = get_referrals(user_id)
+        referrals = await db_repo.get_referrals(user_id)
         referral_count = len(referrals)
         total_bonus_money = sum([ref.get('referrer_bonus', 0) for ref in referrals])
         
@@ -1865,6 +4087,12 @@ async def telegram_web_app(request: Request, tgWebAppData: str = None):
         return RedirectResponse(url="/")
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate-subscriptions":
+        # python app.py migrate-subscriptions
+        migrate_subscription_end()
+        migrate_vless_key_ids()
+        sys.exit(0)
+    
     import uvicorn
     port = int(os.environ.get("PORT", 8000))
     uvicorn.run(app, host="0.0.0.0", port=port)
@@ -79,9 +79,12 @@ async def make_api_request(endpoint: str, method: str = "GET", json_data: dict =
         logger.error(f"API request error for {endpoint}: {e}")
         return {"error": f"Connection error: {str(e)}"}
 
-async def get_user_info(user_id: int):
+async def get_user_info(user_id: int, fields: str = None):
     """Получает информацию о пользователе через API"""
-    return await make_api_request("/user-data", "GET", params={"user_id": str(user_id)})
+    params = {"user_id": str(user_id)}
+    if fields:
+        params["fields"] = fields
+    return await make_api_request("/user-data", "GET", params=params)
 
 async def create_user(user_data: dict):
     """Создает пользователя через API"""
@@ -205,7 +208,7 @@ def get_welcome_message(user_name: str, is_referral: bool = False):
 
 async def get_cabinet_message(user_id: int):
     """Получает информацию о кабинете через API"""
-    user_data = await get_user_info(user_id)
+    user_data = await get_user_info(user_id, fields="balance,has_subscription,subscription_days,referral_stats")
     
     if user_data.get('error'):
         return f"""
@@ -0,0 +1,382 @@
+import copy
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import httpx
+import pytest
+from google.api_core import exceptions as google_exceptions
+from google.cloud.firestore_v1 import transforms
+from google.cloud.firestore_v1.client import Client
+
+import app as app_module
+import yookassa_client
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data, update_time):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self.update_time = update_time
+        self._data = copy.deepcopy(data)
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+    def get(self, field):
+        return (self._data or {}).get(field)
+
+
+class FakeDocumentReference:
+    def __init__(self, db, collection: str, doc_id: str):
+        self._db = db
+        self.collection_name = collection
+        self.id = doc_id
+
+    def get(self, transaction=None):
+        self._db.round_trip()
+        return self._db.snapshot(self.collection_name, self.id)
+
+    def set(self, data, merge=False):
+        self._db.commit([("set", self, data, merge)])
+
+    def update(self, data, option=None):
+        self._db.commit([("update", self, data, option)])
+
+    def delete(self):
+        self._db.commit([("delete", self, None, None)])
+
+
+class FakeQuery:
+    OPERATORS = {
+        "==": lambda value, expected: value == expected,
+        "<=": lambda value, expected: value is not None and value <= expected,
+        "<": lambda value, expected: value is not None and value < expected,
+        ">=": lambda value, expected: value is not None and value >= expected,
+        ">": lambda value, expected: value is not None and value > expected,
+        "in": lambda value, expected: value in expected,
+    }
+
+    def __init__(self, db, collection: str, filters=(), order=None, limit=None, start_after=None):
+        self._db = db
+        self._collection = collection
+        self._filters = list(filters)
+        self._order = order
+        self._limit = limit
+        self._start_after = start_after
+
+    def _copy(self, **changes):
+        params = {
+            "filters": self._filters,
+            "order": self._order,
+            "limit": self._limit,
+            "start_after": self._start_after,
+        }
+        params.update(changes)
+        return FakeQuery(self._db, self._collection, **params)
+
+    def where(self, field, op, value):
+        return self._copy(filters=self._filters + [(field, op, value)])
+
+    def order_by(self, field):
+        return self._copy(order=field)
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def start_after(self, snapshot):
+        return self._copy(start_after=snapshot)
+
+    def stream(self):
+        self._db.round_trip()
+        self._db.queries += 1
+        self._db.queried.append(self._collection)
+        docs = [
+            snapshot for snapshot in self._db.snapshots(self._collection)
+            if all(
+                field in snapshot._data and self.OPERATORS[op](snapshot._data[field], value)
+                for field, op, value in self._filters
+            )
+        ]
+        if self._order:
+            docs.sort(key=lambda snapshot: (snapshot._data.get(self._order), snapshot.id))
+        if self._start_after is not None:
+            ids = [snapshot.id for snapshot in docs]
+            docs = docs[ids.index(self._start_after.id) + 1:] if self._start_after.id in ids else docs
+        if self._limit is not None:
+            docs = docs[:self._limit]
+        return iter(docs)
+
+
+class FakeCollection(FakeQuery):
+    def __init__(self, db, name: str):
+        super().__init__(db, name)
+
+    def document(self, doc_id: str):
+        return FakeDocumentReference(self._db, self._collection, doc_id)
+
+
+class FakeBatch:
+    def __init__(self, db):
+        self._db = db
+        self._writes = []
+
+    def set(self, reference, data, merge=False):
+        self._writes.append(("set", reference, data, merge))
+
+    def update(self, reference, data, option=None):
+        self._writes.append(("update", reference, data, option))
+
+    def delete(self, reference):
+        self._writes.append(("delete", reference, None, None))
+
+    def commit(self):
+        self._db.commit(self._writes)
+        self._writes = []
+
+
+class FakeTransaction(FakeBatch):
+    """Транзакция с тем интерфейсом, который использует @firestore.transactional.
+
+    Транзакции выполняются строго по очереди, как при пессимистичной блокировке
+    документов в Firestore.
+    """
+
+    _read_only = False
+    _max_attempts = 1
+
+    def __init__(self, db):
+        super().__init__(db)
+        self._id = None
+
+    def _clean_up(self):
+        self._writes = []
+
+    def _begin(self, retry_id=None):
+        self._db.transaction_lock.acquire()
+        self._id = object()
+
+    def _commit(self):
+        try:
+            self._db.commit(self._writes)
+        finally:
+            self._writes = []
+            self._id = None
+            self._db.transaction_lock.release()
+
+    def _rollback(self):
+        if self._id is not None:
+            self._writes = []
+            self._id = None
+            self._db.transaction_lock.release()
+
+
+class FakeFirestore:
+    """Firestore в памяти: документы, запросы, batch, транзакции и предусловия last_update_time"""
+
+    def __init__(self):
+        self.data = {}
+        self.update_times = {}
+        self.commits = 0
+        self.queries = 0
+        # Коллекции выполненных запросов, по порядку
+        self.queried = []
+        self.fail_next_commits = 0
+        # Задержка каждого чтения, имитирует сетевой round trip до Firestore
+        self.latency = 0.0
+        self.transaction_lock = threading.Lock()
+        self._lock = threading.RLock()
+        self._clock = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+    def round_trip(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def collection(self, name: str):
+        return FakeCollection(self, name)
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def transaction(self):
+        return FakeTransaction(self)
+
+    write_option = staticmethod(Client.write_option)
+
+    def put(self, collection: str, doc_id: str, data: dict):
+        self.commit([("set", self.collection(collection).document(doc_id), data, False)])
+
+    def doc(self, collection: str, doc_id: str):
+        return copy.deepcopy(self.data.get(collection, {}).get(doc_id))
+
+    def snapshot(self, collection: str, doc_id: str):
+        with self._lock:
+            return FakeSnapshot(
+                self.collection(collection).document(doc_id),
+                self.data.get(collection, {}).get(doc_id),
+                self.update_times.get((collection, doc_id))
+            )
+
+    def snapshots(self, collection: str):
+        with self._lock:
+            return [self.snapshot(collection, doc_id) for doc_id in self.data.get(collection, {})]
+
+    def _resolve(self, current, value):
+        if value is app_module.firestore.SERVER_TIMESTAMP:
+            return datetime.now(timezone.utc)
+        if isinstance(value, transforms.Increment):
+            return (current or 0) + value.value
+        if isinstance(value, transforms.ArrayUnion):
+            result = list(current or [])
+            return result + [item for item in value.values if item not in result]
+        if isinstance(value, transforms.ArrayRemove):
+            return [item for item in current or [] if item not in value.values]
+        return copy.deepcopy(value)
+
+    def _merge(self, document: dict, data: dict):
+        for key, value in data.items():
+            if value is app_module.firestore.DELETE_FIELD:
+                document.pop(key, None)
+            else:
+                document[key] = self._resolve(document.get(key), value)
+
+    def commit(self, writes):
+        with self._lock:
+            if self.fail_next_commits:
+                self.fail_next_commits -= 1
+                raise google_exceptions.ServiceUnavailable("commit failed")
+
+            # Все записи проверяются до применения: batch атомарен
+            for action, reference, _, option in writes:
+                key = (reference.collection_name, reference.id)
+                exists = reference.id in self.data.get(reference.collection_name, {})
+                if action == "update" and not exists:
+                    raise google_exceptions.NotFound(f"No document to update: {key}")
+                last_update_time = getattr(option, "_last_update_time", None)
+                if last_update_time is not None and self.update_times.get(key) != last_update_time:
+                    raise google_exceptions.FailedPrecondition(f"Document changed: {key}")
+
+            for action, reference, data, option in writes:
+                collection = self.data.setdefault(reference.collection_name, {})
+                key = (reference.collection_name, reference.id)
+                if action == "delete":
+                    collection.pop(reference.id, None)
+                    self.update_times.pop(key, None)
+                    continue
+
+                document = collection.get(reference.id, {}) if action == "update" or option is True else {}
+                document = dict(document)
+                self._merge(document, data)
+                collection[reference.id] = document
+                self._clock += timedelta(microseconds=1)
+                self.update_times[key] = self._clock
+
+            self.commits += 1
+
+
+class StubNodeClients(app_module.XrayNodeClients):
+    """Клиенты нод поверх httpx.MockTransport, с настоящими circuit breaker"""
+
+    def __init__(self, servers: dict, handler):
+        super().__init__(servers)
+        self.handler = handler
+
+    def _create_client(self, server_id: str) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            # Обработчик берется в момент запроса: тест может сменить его после создания клиента
+            transport=app_module.BreakerTransport(
+                httpx.MockTransport(lambda request: self.handler(request)),
+                self.breakers[server_id]
+            ),
+            timeout=httpx.Timeout(30.0, connect=5.0)
+        )
+
+
+@pytest.fixture
+def app():
+    return app_module
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    db = FakeFirestore()
+    monkeypatch.setattr(app_module, "db", db)
+    monkeypatch.setattr(app_module, "user_cache", app_module.TTLCache(100, 60))
+    return db
+
+
+@pytest.fixture
+def entitlements(monkeypatch):
+    index = app_module.EntitlementIndex(1000)
+    index.loaded = True
+    monkeypatch.setattr(app_module, "entitlement_index", index)
+    return index
+
+
+@pytest.fixture
+def stub_nodes(monkeypatch):
+    """Подменяет ноды Xray. Обработчик задается через stub_nodes.handler = func(request)"""
+
+    def not_configured(request):
+        return httpx.Response(500, json={"error": "no handler"})
+
+    clients = StubNodeClients(app_module.XRAY_SERVERS, not_configured)
+    monkeypatch.setattr(app_module, "xray_nodes", clients)
+
+    class Nodes:
+        requests = []
+
+        @property
+        def handler(self):
+            return clients.handler
+
+        @handler.setter
+        def handler(self, func):
+            def recording(request):
+                Nodes.requests.append(request)
+                return func(request)
+            clients.handler = recording
+
+    Nodes.requests = []
+    return Nodes()
+
+
+class StubGateway:
+    """ЮKassa на httpx.MockTransport: платежи по id, ответы можно подменить через handler"""
+
+    def __init__(self):
+        self.payments = {}
+        self.requests = []
+        self.handler = None
+        self.client = yookassa_client.YooKassaClient("shop", "secret", base_url="https://gateway.test")
+        self.client._client = httpx.AsyncClient(
+            base_url="https://gateway.test",
+            transport=httpx.MockTransport(self._handle)
+        )
+
+    def _handle(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        if self.handler is not None:
+            return self.handler(request)
+        payment = self.payments.get(request.url.path.rsplit("/", 1)[-1])
+        if request.method != "GET" or payment is None:
+            return httpx.Response(404, json={"type": "error", "code": "not_found"})
+        return httpx.Response(200, json=payment)
+
+
+@pytest.fixture
+def gateway(monkeypatch):
+    """Подменяет клиент ЮKassa, повторы выполняются без задержки"""
+    stub = StubGateway()
+    monkeypatch.setattr(app_module, "yookassa", stub.client)
+    monkeypatch.setattr(yookassa_client, "YOOKASSA_RETRY_BASE_DELAY", 0)
+    return stub
+
+
+def server_id_of(request: httpx.Request) -> str:
+    """Имя ноды из XRAY_SERVERS по адресу запроса"""
+    for server_id, server_config in app_module.XRAY_SERVERS.items():
+        if str(request.url).startswith((server_config["url"], server_config["api_url"])):
+            return server_id
+    raise AssertionError(f"Unknown node URL {request.url}")
@@ -0,0 +1,90 @@
+import asyncio
+import json
+import math
+import time
+from collections import Counter
+
+import httpx
+import pytest
+
+from tests.conftest import server_id_of
+
+
+def test_bulk_add_sends_one_request(app, stub_nodes):
+    stub_nodes.handler = lambda request: httpx.Response(200, json={"success": True})
+
+    results = asyncio.run(app.bulk_add_to_node("London", ["a", "b", "c"]))
+
+    assert results == {"a": True, "b": True, "c": True}
+    assert len(stub_nodes.requests) == 1
+    assert stub_nodes.requests[0].url.path == "/users"
+    assert json.loads(stub_nodes.requests[0].content) == {"uuids": ["a", "b", "c"]}
+
+
+@pytest.mark.parametrize("status", [404, 405])
+def test_bulk_add_falls_back_to_single_adds(app, stub_nodes, status):
+    def handler(request):
+        if request.url.path == "/users":
+            return httpx.Response(status)
+        uuid = json.loads(request.content)["uuid"]
+        return httpx.Response(500 if uuid == "bad" else 200)
+
+    stub_nodes.handler = handler
+
+    results = asyncio.run(app.bulk_add_to_node("London", ["a", "bad", "c"]))
+
+    assert results == {"a": True, "bad": False, "c": True}
+    assert sorted(request.url.path for request in stub_nodes.requests) == ["/user", "/user", "/user", "/users"]
+
+
+def test_queue_coalesces_adds_per_node(app, stub_nodes):
+    stub_nodes.handler = lambda request: httpx.Response(200, json={"success": True})
+    queue = app.XrayProvisioningQueue(0.01, 500)
+
+    async def main():
+        futures = [
+            queue.enqueue(f"uuid-{index}", server_id)
+            for index in range(50)
+            for server_id in app.XRAY_SERVERS
+        ]
+        return await asyncio.gather(*futures)
+
+    assert all(asyncio.run(main()))
+    assert sorted(server_id_of(request) for request in stub_nodes.requests) == sorted(app.XRAY_SERVERS)
+    assert queue.stats() == {"pending": 0, "batches_sent": 2, "users_sent": 100}
+
+
+def test_queue_splits_large_batches(app, stub_nodes):
+    stub_nodes.handler = lambda request: httpx.Response(200, json={"success": True})
+    queue = app.XrayProvisioningQueue(0.01, 10)
+
+    async def main():
+        return await asyncio.gather(*[queue.enqueue(f"uuid-{index}", "London") for index in range(25)])
+
+    assert all(asyncio.run(main()))
+    assert [len(json.loads(request.content)["uuids"]) for request in stub_nodes.requests] == [10, 10, 5]
+
+
+def test_activation_burst_is_coalesced(app, stub_nodes, monkeypatch):
+    activations = 1000
+    stub_nodes.handler = lambda request: httpx.Response(200, json={"success": True})
+    queue = app.XrayProvisioningQueue(app.PROVISION_BATCH_WINDOW, app.PROVISION_MAX_BATCH)
+    monkeypatch.setattr(app, "xray_provisioning_queue", queue)
+
+    async def main():
+        started = time.monotonic()
+        results = await asyncio.gather(*[
+            app.fast_add_to_xray(f"uuid-{index}", list(app.XRAY_SERVERS))
+            for index in range(activations)
+        ])
+        return results, time.monotonic() - started
+
+    results, elapsed = asyncio.run(main())
+
+    assert all(result["success"] for node_results in results for result in node_results.values())
+    batches_per_node = math.ceil(activations / app.PROVISION_MAX_BATCH)
+    calls = Counter(server_id_of(request) for request in stub_nodes.requests)
+    assert calls == {server_id: batches_per_node for server_id in app.XRAY_SERVERS}
+    assert queue.stats()["users_sent"] == activations * len(app.XRAY_SERVERS)
+    # Вся волна укладывается в одно окно накопления плюс накладные расходы
+    assert elapsed < app.PROVISION_BATCH_WINDOW + 0.5
@@ -0,0 +1,63 @@
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+
+
+@pytest.fixture
+def client(app):
+    return TestClient(app.app)
+
+
+def test_answers_from_index_without_firestore(app, fake_db, entitlements, client):
+    entitlements.grant("uuid-1", "user-1", datetime.now() + timedelta(days=2, hours=1))
+    entitlements.grant("uuid-2", "user-2", datetime.now() - timedelta(minutes=1))
+
+    active = client.get("/check-user-access", params={"user_uuid": "uuid-1"}).json()
+    expired = client.get("/check-user-access", params={"user_uuid": "uuid-2"}).json()
+    unknown = client.get("/check-user-access", params={"user_uuid": "uuid-3"}).json()
+
+    assert active["has_access"] is True
+    assert active["user_id"] == "user-1"
+    assert active["subscription_days"] == 3
+    assert expired == {"success": True, "has_access": False, "reason": "No active subscription"}
+    assert unknown["has_access"] is False
+    assert fake_db.queries == 0
+
+
+def test_falls_back_to_firestore_until_index_is_loaded(app, fake_db, entitlements, client):
+    entitlements.loaded = False
+    fake_db.put("users", "user-1", {
+        "user_id": "user-1",
+        "vless_uuid": "uuid-1",
+        "has_subscription": True,
+        "subscription_end": (datetime.now() + timedelta(days=5)).isoformat(),
+    })
+
+    found = client.get("/check-user-access", params={"user_uuid": "uuid-1"}).json()
+    missing = client.get("/check-user-access", params={"user_uuid": "uuid-2"}).json()
+
+    assert found == {"success": True, "has_access": True, "user_id": "user-1", "subscription_days": 5}
+    assert missing["has_access"] is False
+    assert fake_db.queries == 2
+
+
+def test_batch_answers_every_uuid(app, fake_db, entitlements, client):
+    entitlements.grant("uuid-1", "user-1", datetime.now() + timedelta(days=1))
+
+    response = client.post("/check-user-access/batch", json={"uuids": ["uuid-1", "uuid-2"]})
+
+    results = response.json()["results"]
+    assert results["uuid-1"]["has_access"] is True
+    assert results["uuid-1"]["user_id"] == "user-1"
+    assert results["uuid-2"] == {"has_access": False, "reason": "No active subscription"}
+    assert fake_db.queries == 0
+
+
+def test_batch_limits(app, entitlements, client):
+    too_many = client.post("/check-user-access/batch", json={"uuids": ["u"] * (app.CHECK_ACCESS_BATCH_LIMIT + 1)})
+    assert too_many.status_code == 400
+
+    entitlements.loaded = False
+    loading = client.post("/check-user-access/batch", json={"uuids": ["uuid-1"]})
+    assert loading.status_code == 503
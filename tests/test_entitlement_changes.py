@@ -0,0 +1,116 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+import httpx
+
+
+def later(**kwargs) -> datetime:
+    return datetime.now() + timedelta(**kwargs)
+
+
+def test_changes_since_cursor(app):
+    index = app.EntitlementIndex(100)
+    start = index.cursor
+    index.grant("uuid-1", "user-1", later(days=1))
+    index.grant("uuid-2", "user-2", later(days=1))
+    middle = index.cursor
+    index.revoke("uuid-1")
+
+    assert [(change["op"], change["uuid"]) for change in index.changes_since(start)] == [
+        ("add", "uuid-1"), ("add", "uuid-2"), ("revoke", "uuid-1")
+    ]
+    assert [change["op"] for change in index.changes_since(middle)] == ["revoke"]
+    assert index.changes_since(index.cursor) == []
+
+
+def test_stale_or_foreign_cursor_requires_resync(app):
+    index = app.EntitlementIndex(3)
+    start = index.cursor
+    for i in range(5):
+        index.grant(f"uuid-{i}", f"user-{i}", later(days=1))
+
+    # Журнал хранит 3 последних изменения
+    assert index.changes_since(start) is None
+    assert [change["seq"] for change in index.changes_since(f"{index.epoch}:2")] == [3, 4, 5]
+    assert index.changes_since(f"{index.epoch}:1") is None
+    # Курсор прошлого процесса, курсор из будущего и мусор
+    assert index.changes_since(f"other:{index.seq}") is None
+    assert index.changes_since(f"{index.epoch}:{index.seq + 1}") is None
+    assert index.changes_since("garbage") is None
+
+
+def test_time_based_expiry_reaches_the_feed(app):
+    index = app.EntitlementIndex(100)
+    index.grant("uuid-1", "user-1", later(milliseconds=50))
+    index.grant("uuid-2", "user-2", later(days=1))
+    # Продление: старое окончание в куче больше не действует
+    index.grant("uuid-3", "user-3", later(milliseconds=50))
+    index.grant("uuid-3", "user-3", later(days=1))
+    cursor = index.cursor
+
+    time.sleep(0.06)
+
+    changes = index.changes_since(cursor)
+    assert [(change["op"], change["uuid"], change["user_id"]) for change in changes] == [("revoke", "uuid-1", "user-1")]
+    # Дельта и полный снимок согласованы
+    assert sorted(user["uuid"] for user in index.snapshot()) == ["uuid-2", "uuid-3"]
+    assert index.changes_since(index.cursor) == []
+
+
+def poll(app, params: dict, during=None):
+    """GET /active-users/changes; during() выполняется, пока запрос ждет"""
+    async def main():
+        transport = httpx.ASGITransport(app=app.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://app") as client:
+            started = time.monotonic()
+            request = asyncio.create_task(client.get("/active-users/changes", params=params))
+            if during:
+                await asyncio.sleep(0.05)
+                during()
+            response = await request
+            return response.json(), time.monotonic() - started
+
+    return asyncio.run(main())
+
+
+def test_long_poll_wakes_on_grant(app, entitlements):
+    cursor = entitlements.cursor
+
+    body, elapsed = poll(
+        app, {"cursor": cursor, "wait": 5},
+        during=lambda: entitlements.grant("uuid-1", "user-1", later(days=1))
+    )
+
+    assert elapsed < 1
+    assert body["resync"] is False
+    assert [(change["op"], change["uuid"]) for change in body["changes"]] == [("add", "uuid-1")]
+    assert body["cursor"] == entitlements.cursor
+
+
+def test_long_poll_wakes_on_expiry(app, entitlements):
+    entitlements.grant("uuid-1", "user-1", later(milliseconds=100))
+
+    body, elapsed = poll(app, {"cursor": entitlements.cursor, "wait": 5})
+
+    assert elapsed < 1
+    assert [(change["op"], change["uuid"]) for change in body["changes"]] == [("revoke", "uuid-1")]
+
+
+def test_long_poll_times_out_empty(app, entitlements):
+    cursor = entitlements.cursor
+
+    body, elapsed = poll(app, {"cursor": cursor, "wait": 0.1})
+
+    assert 0.1 <= elapsed < 1
+    assert body == {"success": True, "resync": False, "changes": [], "cursor": cursor}
+
+
+def test_stale_cursor_gets_snapshot(app, entitlements):
+    entitlements.grant("uuid-1", "user-1", later(days=1))
+
+    body, _ = poll(app, {"cursor": "previous-process:42"})
+
+    assert body["resync"] is True
+    assert [user["uuid"] for user in body["users"]] == ["uuid-1"]
+    assert body["cursor"] == entitlements.cursor
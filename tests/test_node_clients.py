@@ -0,0 +1,231 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+from tests.conftest import server_id_of
+
+
+def test_one_pooled_client_per_node(app):
+    async def main():
+        nodes = app.XrayNodeClients(app.XRAY_SERVERS)
+        await nodes.startup()
+        clients = {server_id: nodes.get(server_id) for server_id in app.XRAY_SERVERS}
+        again = {server_id: nodes.get(server_id) for server_id in app.XRAY_SERVERS}
+        await nodes.shutdown()
+        return clients, again
+
+    clients, again = asyncio.run(main())
+    assert clients == again
+    assert len({id(client) for client in clients.values()}) == len(app.XRAY_SERVERS)
+    assert all(client.is_closed for client in clients.values())
+
+
+def test_closed_client_is_recreated(app):
+    async def main():
+        nodes = app.XrayNodeClients(app.XRAY_SERVERS)
+        first = nodes.get("London")
+        await first.aclose()
+        second = nodes.get("London")
+        await nodes.shutdown()
+        return first, second
+
+    first, second = asyncio.run(main())
+    assert first is not second
+
+
+def test_requests_reuse_the_node_client(app, stub_nodes):
+    stub_nodes.handler = lambda request: httpx.Response(200, json={"exists": True})
+
+    async def main():
+        results = await asyncio.gather(*[app.check_user_in_xray("uuid-1", "London") for _ in range(5)])
+        opened = list(app.xray_nodes._clients)
+        await app.xray_nodes.shutdown()
+        return results, opened
+
+    results, opened = asyncio.run(main())
+    assert all(results)
+    assert opened == ["London"]
+    assert {server_id_of(request) for request in stub_nodes.requests} == {"London"}
+
+
+class KeepAliveNode:
+    """Нода на настоящем TCP сокете: отвечает {"exists": true} и считает соединения"""
+
+    BODY = b'{"exists": true}'
+
+    def __init__(self):
+        self.connections = 0
+        self.requests = 0
+        self._server = None
+
+    async def start(self) -> str:
+        self._server = await asyncio.start_server(self._serve, "127.0.0.1", 0)
+        host, port = self._server.sockets[0].getsockname()[:2]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        self.connections += 1
+        try:
+            while await reader.readuntil(b"\r\n\r\n"):
+                self.requests += 1
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    b"Content-Length: %d\r\n\r\n%s" % (len(self.BODY), self.BODY)
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+def test_sequential_calls_reuse_one_connection(app, monkeypatch):
+    calls = 50
+    node = KeepAliveNode()
+
+    async def main():
+        url = await node.start()
+        servers = {"Stub": {"url": url, "api_url": url, "api_key": "key"}}
+        monkeypatch.setattr(app, "XRAY_SERVERS", servers)
+        monkeypatch.setattr(app, "xray_nodes", app.XrayNodeClients(servers))
+
+        started = time.monotonic()
+        pooled = [await app.check_user_in_xray("uuid-1", "Stub") for _ in range(calls)]
+        pooled_elapsed = time.monotonic() - started
+        pooled_connections = node.connections
+        await app.xray_nodes.shutdown()
+
+        # Как до пула: новый клиент, а значит новое соединение на каждый вызов
+        node.connections = 0
+        started = time.monotonic()
+        for _ in range(calls):
+            async with httpx.AsyncClient() as client:
+                await client.get(f"{url}/user/uuid-1")
+        fresh_elapsed = time.monotonic() - started
+        fresh_connections = node.connections
+
+        await node.stop()
+        return pooled, pooled_connections, pooled_elapsed, fresh_connections, fresh_elapsed
+
+    pooled, pooled_connections, pooled_elapsed, fresh_connections, fresh_elapsed = asyncio.run(main())
+    assert all(pooled)
+    assert pooled_connections == 1
+    assert fresh_connections == calls
+    assert pooled_elapsed < fresh_elapsed
+
+
+def test_breaker_opens_after_threshold_and_rejects_without_request(app, stub_nodes):
+    stub_nodes.handler = lambda request: httpx.Response(503)
+    breaker = app.xray_nodes.breakers["London"]
+
+    async def main():
+        results = [await app.check_user_in_xray("uuid-1", "London") for _ in range(breaker.failure_threshold)]
+        state = breaker.state
+        sent = len(stub_nodes.requests)
+        rejected = await app.check_user_in_xray("uuid-1", "London")
+        await app.xray_nodes.shutdown()
+        return results, state, sent, rejected
+
+    results, state, sent, rejected = asyncio.run(main())
+    assert not any(results)
+    assert state == "open"
+    assert not rejected
+    assert len(stub_nodes.requests) == sent == breaker.failure_threshold
+    assert not app.xray_nodes.is_available("London")
+
+
+def test_half_open_probe_closes_breaker_and_runs_outbox_once(app, stub_nodes, monkeypatch):
+    stub_nodes.handler = lambda request: httpx.Response(200, json={"status": "ok", "exists": True})
+    breaker = app.xray_nodes.breakers["London"]
+    runs = []
+
+    async def process():
+        runs.append("London")
+        await asyncio.sleep(0.05)
+
+    monkeypatch.setattr(app.provisioning_outbox, "process", process)
+
+    async def main():
+        breaker.state, breaker.opened_at = "open", time.monotonic() - breaker.reset_timeout
+        allowed = breaker.allow()
+        half_open = breaker.state
+        probe = breaker._probe_task
+        assert probe in app._background_tasks
+        await probe
+        # Повторное замыкание во время восстановления не запускает второй проход очереди
+        breaker.record_failure()
+        breaker.state = "half_open"
+        breaker.record_success()
+        await breaker._recovery_task
+        await app.xray_nodes.shutdown()
+        return allowed, half_open
+
+    allowed, half_open = asyncio.run(main())
+    assert not allowed
+    assert half_open == "half_open"
+    assert [request.url.path for request in stub_nodes.requests] == ["/health"]
+    assert breaker.state == "closed" and breaker.failures == 0
+    assert runs == ["London"]
+    assert not app._background_tasks
+
+
+def test_failed_probe_reopens_breaker(app, stub_nodes, monkeypatch):
+    stub_nodes.handler = lambda request: httpx.Response(503)
+    breaker = app.xray_nodes.breakers["London"]
+    monkeypatch.setattr(app.provisioning_outbox, "process", lambda: pytest.fail("outbox must not run"))
+
+    async def main():
+        breaker.state, breaker.opened_at = "open", time.monotonic() - breaker.reset_timeout
+        breaker.allow()
+        await breaker._probe_task
+        await app.xray_nodes.shutdown()
+
+    asyncio.run(main())
+    assert [request.url.path for request in stub_nodes.requests] == ["/health"]
+    assert breaker.state == "open"
+    assert time.monotonic() - breaker.opened_at < breaker.reset_timeout
+    assert not breaker.allow()
+
+
+def test_background_task_failure_is_logged(app, caplog):
+    async def broken():
+        raise RuntimeError("probe crashed")
+
+    async def main():
+        task = app.spawn_background(broken())
+        assert task in app._background_tasks
+        await asyncio.gather(task, return_exceptions=True)
+        await asyncio.sleep(0)
+        return task
+
+    task = asyncio.run(main())
+    assert task not in app._background_tasks
+    assert "probe crashed" in caplog.text
+
+
+def test_outbox_process_never_runs_concurrently(app, fake_db, monkeypatch):
+    outbox = app.ProvisioningOutbox(10)
+    active, passes = [], []
+
+    async def process_once():
+        active.append(1)
+        assert len(active) == 1
+        passes.append(len(passes))
+        await asyncio.sleep(0.02)
+        active.pop()
+
+    monkeypatch.setattr(outbox, "_process_once", process_once)
+
+    async def main():
+        await asyncio.gather(*[outbox.process() for _ in range(5)])
+        await outbox.process()
+
+    asyncio.run(main())
+    # Первый вызов, один повтор за вызовы во время прохода и отдельный последний
+    assert len(passes) == 3
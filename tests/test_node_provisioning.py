@@ -0,0 +1,66 @@
+import asyncio
+import time
+
+import httpx
+
+from tests.conftest import server_id_of
+
+
+def test_per_node_timeout_and_overall_deadline(app):
+    async def node_call(server_id):
+        await asyncio.sleep({"fast": 0, "hung": 10, "slow": 10}[server_id])
+        return True
+
+    async def main():
+        started = time.monotonic()
+        # hung упирается в таймаут ноды, slow - в общий дедлайн
+        fast_and_hung = await app.provision_on_nodes(["fast", "hung"], node_call, node_timeout=0.05, deadline=1.0)
+        middle = time.monotonic() - started
+        started = time.monotonic()
+        with_slow = await app.provision_on_nodes(["fast", "slow"], node_call, node_timeout=5.0, deadline=0.1)
+        return fast_and_hung, middle, with_slow, time.monotonic() - started
+
+    fast_and_hung, first_elapsed, with_slow, second_elapsed = asyncio.run(main())
+
+    assert fast_and_hung["fast"]["success"] is True
+    assert fast_and_hung["hung"]["success"] is False
+    assert fast_and_hung["hung"]["error"] == "timeout"
+    assert 40 <= fast_and_hung["hung"]["elapsed_ms"] < 500
+    assert first_elapsed < 0.5
+
+    assert with_slow["fast"]["success"] is True
+    assert with_slow["slow"] == {"success": False, "error": "deadline exceeded", "pending": True}
+    assert second_elapsed < 0.5
+
+
+def test_emergency_add_reports_pending_slow_node(app, fake_db, stub_nodes, monkeypatch):
+    fast_node, slow_node = list(app.XRAY_SERVERS)[:2]
+    monkeypatch.setattr(app, "EMERGENCY_ADD_NODE_TIMEOUT", 5.0)
+    monkeypatch.setattr(app, "EMERGENCY_ADD_DEADLINE", 0.2)
+    fake_db.put("users", "user-1", {"user_id": "user-1", "vless_uuid": "uuid-1"})
+
+    async def handler(request):
+        if server_id_of(request) == slow_node:
+            await asyncio.sleep(2)
+        return httpx.Response(200, json={"success": True})
+
+    stub_nodes.handler = handler
+
+    async def main():
+        transport = httpx.ASGITransport(app=app.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://app") as client:
+            started = time.monotonic()
+            response = await client.post("/emergency-add-to-xray", params={"user_id": "user-1"})
+            return response, time.monotonic() - started
+
+    response, elapsed = asyncio.run(main())
+
+    assert response.status_code == 200
+    body = response.json()
+    assert elapsed < 1.0
+    assert body["servers_added"] == 1
+    assert body["servers"][fast_node]["success"] is True
+    assert body["servers"][slow_node] == {"success": False, "error": "deadline exceeded", "pending": True}
+    # Нода, не успевшая к дедлайну, дообрабатывается через outbox
+    queued = fake_db.data["provisioning_outbox"].values()
+    assert [(item["op"], item["server_id"]) for item in queued] == [("add", slow_node)]
@@ -0,0 +1,93 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+import httpx
+import pytest
+
+from tests.conftest import server_id_of
+
+
+@pytest.fixture
+def node_stats(app, monkeypatch):
+    stats = app.XrayNodeStats(60)
+    monkeypatch.setattr(app, "node_stats", stats)
+    return stats
+
+
+def fresh(users: int, uplink: int = 0, downlink: int = 0, age: float = 0) -> dict:
+    return {
+        "users": users,
+        "uplink": uplink,
+        "downlink": downlink,
+        "updated_monotonic": time.monotonic() - age,
+        "error": None,
+    }
+
+
+def test_poll_caches_counts_and_keeps_last_values_on_error(app, node_stats, stub_nodes):
+    stub_nodes.handler = lambda request: httpx.Response(200, json={"users": 7, "uplink": 10, "downlink": 20})
+    asyncio.run(node_stats.poll())
+    assert node_stats.users_count() == 7 * len(app.XRAY_SERVERS)
+    assert asyncio.run(app.get_xray_users_count("London")) == 7
+
+    stub_nodes.handler = lambda request: httpx.Response(503)
+    asyncio.run(node_stats.poll_node("London"))
+    assert node_stats.get("London")["users"] == 7
+    assert node_stats.get("London")["error"]
+
+
+def test_missing_stats_endpoint_counts_node_clients(app, node_stats, stub_nodes):
+    def handler(request):
+        if request.url.path == "/stats":
+            return httpx.Response(404)
+        return httpx.Response(200, json={"users": [{"uuid": "a"}, {"uuid": "b"}]})
+
+    stub_nodes.handler = handler
+    asyncio.run(node_stats.poll_node("London"))
+
+    assert node_stats.get("London")["users"] == 2
+    assert [request.url.path for request in stub_nodes.requests] == ["/stats", "/users"]
+
+
+def test_load_is_scored_against_capacity(app, node_stats, entitlements, monkeypatch):
+    servers = {server_id: dict(config) for server_id, config in app.XRAY_SERVERS.items()}
+    servers["London"]["capacity"] = 200
+    monkeypatch.setattr(app, "XRAY_SERVERS", servers)
+    node_stats._stats = {"London": fresh(50, uplink=1, downlink=2), "Netherlands": fresh(100)}
+
+    london = app.get_server_load("London")
+    netherlands = app.get_server_load("Netherlands")
+
+    assert london == {"users": 50, "users_source": "node", "load": 0.25, "bandwidth": 3, "healthy": True}
+    assert netherlands["load"] == round(100 / app.NODE_DEFAULT_CAPACITY, 3)
+
+
+@pytest.mark.parametrize("stats", [
+    {},
+    {"users": 900, "error": "connection refused"},
+    fresh(900, age=3600),
+], ids=["missing", "error", "stale"])
+def test_missing_failed_or_stale_stats_use_assigned_subscriptions(app, node_stats, entitlements, stats):
+    node_stats._stats = {"London": stats}
+    entitlements.assign("uuid-1", ["London"])
+    entitlements.grant("uuid-1", "user-1", datetime.now() + timedelta(days=1))
+
+    load = app.get_server_load("London")
+
+    assert load["users"] == 1
+    assert load["users_source"] == "subscriptions"
+    assert load["healthy"] is True
+
+
+def test_ties_break_on_bandwidth_then_server_order(app, node_stats, entitlements):
+    london, netherlands = [server["id"] for server in app.VLESS_SERVERS]
+
+    node_stats._stats = {london: fresh(10, uplink=500), netherlands: fresh(10, uplink=100)}
+    assert [server["id"] for server in app.rank_servers()] == [netherlands, london]
+
+    node_stats._stats = {london: fresh(10, uplink=100), netherlands: fresh(10, uplink=100)}
+    assert [server["id"] for server in app.rank_servers()] == [london, netherlands]
+
+    node_stats._stats = {london: fresh(11), netherlands: fresh(10, uplink=10 ** 9)}
+    assert [server["id"] for server in app.rank_servers()] == [netherlands, london]
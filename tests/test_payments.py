@@ -0,0 +1,221 @@
+import asyncio
+import json
+from datetime import datetime, timedelta, timezone
+
+import httpx
+import pytest
+
+
+@pytest.fixture
+def user_uuid(app, monkeypatch):
+    async def ensure_user_uuid(user_id, server_id=None):
+        return "uuid-1"
+
+    monkeypatch.setattr(app, "ensure_user_uuid", ensure_user_uuid)
+    return "uuid-1"
+
+
+def paid_tariff(fake_db, payment_id: str = "pay-1") -> dict:
+    payment = {
+        "payment_id": payment_id,
+        "user_id": "user-1",
+        "amount": 150.0,
+        "tariff": "1month",
+        "status": "succeeded",
+        "payment_type": "tariff",
+        "payment_method": "yookassa",
+        "yookassa_id": f"yk-{payment_id}",
+        "fulfilled": False,
+        "confirmed_at": datetime.now(timezone.utc) - timedelta(hours=1),
+    }
+    fake_db.put("payments", payment_id, payment)
+    return payment
+
+
+def subscription_days(app, fake_db) -> int:
+    end = app.get_subscription_end(fake_db.doc("users", "user-1"))
+    return round((end - datetime.now()) / timedelta(days=1))
+
+
+def test_retried_fulfillment_extends_once(app, fake_db, entitlements, user_uuid):
+    fake_db.put("users", "user-1", {"user_id": "user-1", "balance": 0})
+    payment = paid_tariff(fake_db)
+
+    # Продление и отметка о выполнении записываются вместе: при сбое нет ни того, ни другого
+    fake_db.fail_next_commits = 1
+    assert not asyncio.run(app.fulfill_tariff_payment("pay-1", payment))
+    assert not fake_db.doc("users", "user-1").get("has_subscription")
+    assert fake_db.doc("payments", "pay-1")["fulfilled"] is False
+
+    sweeper = app.PaymentSweeper(page_size=10, concurrency=4)
+    asyncio.run(sweeper.sweep())
+    # Повтор с устаревшей копией платежа, прочитанной до выполнения
+    assert asyncio.run(app.fulfill_tariff_payment("pay-1", payment))
+
+    assert sweeper.fulfilled == 1
+    assert fake_db.doc("payments", "pay-1")["fulfilled"] is True
+    assert subscription_days(app, fake_db) == 30
+    assert entitlements.owner(user_uuid) == "user-1"
+
+
+def post_concurrently(app, requests: list) -> list:
+    async def run():
+        transport = httpx.ASGITransport(app=app.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://app") as client:
+            return await asyncio.gather(*[client.post(path, json=body) for path, body in requests])
+
+    return asyncio.run(run())
+
+
+def test_concurrent_balance_purchases_do_not_overdraw(app, fake_db, entitlements, user_uuid):
+    fake_db.put("users", "user-1", {"user_id": "user-1", "balance": 300.0})
+    activate = {"user_id": "user-1", "tariff": "1month", "payment_method": "balance", "selected_server": "London"}
+    buy = {"user_id": "user-1", "tariff_id": "1month", "tariff_price": 150.0, "tariff_days": 30, "selected_server": "London"}
+
+    responses = post_concurrently(app, [("/activate-tariff", activate), ("/buy-with-balance", buy)] * 3)
+
+    assert sorted(response.status_code for response in responses) == [200, 200, 400, 400, 400, 400]
+    assert fake_db.doc("users", "user-1")["balance"] == 0
+    assert subscription_days(app, fake_db) == 60
+    payments = fake_db.data["payments"].values()
+    assert [payment["status"] for payment in payments] == ["succeeded", "succeeded"]
+    assert all(payment["fulfilled"] for payment in payments)
+
+
+@pytest.mark.parametrize("payment_type", ["tariff", "balance"])
+def test_concurrent_webhooks_and_polls_settle_once(app, fake_db, entitlements, user_uuid, gateway, payment_type):
+    fake_db.put("users", "user-1", {"user_id": "user-1", "balance": 0})
+    payment = {
+        "payment_id": "pay-1",
+        "user_id": "user-1",
+        "amount": 150.0,
+        "tariff": "1month" if payment_type == "tariff" else "balance",
+        "status": "pending",
+        "payment_type": payment_type,
+        "payment_method": "yookassa",
+        "yookassa_id": "yk-pay-1",
+    }
+    fake_db.put("payments", "pay-1", payment)
+    gateway.payments["yk-pay-1"] = {"id": "yk-pay-1", "status": "succeeded"}
+    notification = {
+        "event": "payment.succeeded",
+        "object": {"id": "yk-pay-1", "status": "succeeded", "metadata": {"payment_id": "pay-1"}},
+    }
+    sweeper = app.PaymentSweeper(page_size=10, concurrency=4)
+
+    async def run():
+        transport = httpx.ASGITransport(app=app.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://app") as client:
+            webhooks = [
+                client.post("/yookassa/webhook", json=notification, headers={"X-Forwarded-For": "185.71.76.5"})
+                for _ in range(20)
+            ]
+            polls = [client.get("/payment-status", params={"payment_id": "pay-1", "user_id": "user-1"}) for _ in range(20)]
+            sweeps = [sweeper.check_payment(dict(payment)) for _ in range(20)]
+            return await asyncio.gather(*webhooks, *polls, *sweeps)
+
+    results = asyncio.run(run())
+
+    responses = [result for result in results if result is not None]
+    assert all(response.status_code == 200 for response in responses)
+    assert sweeper.errors == 0
+    settled = fake_db.doc("payments", "pay-1")
+    assert settled["status"] == "succeeded"
+    assert settled["fulfilled"] is True
+    user = fake_db.doc("users", "user-1")
+    if payment_type == "tariff":
+        assert user["balance"] == 0
+        assert subscription_days(app, fake_db) == 30
+    else:
+        assert user["balance"] == 150.0
+        assert not user.get("has_subscription")
+
+
+def pending_tariff(fake_db, payment_id: str = "pay-1") -> dict:
+    payment = {
+        "payment_id": payment_id,
+        "user_id": "user-1",
+        "amount": 150.0,
+        "tariff": "1month",
+        "status": "pending",
+        "payment_type": "tariff",
+        "payment_method": "yookassa",
+        "yookassa_id": f"yk-{payment_id}",
+    }
+    fake_db.put("payments", payment_id, payment)
+    return payment
+
+
+def stream_events(app, meanwhile=None) -> list:
+    """Читает /payment-status/stream до закрытия; meanwhile выполняется после подписки"""
+
+    async def run():
+        transport = httpx.ASGITransport(app=app.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://app") as client:
+            request = asyncio.create_task(
+                client.get("/payment-status/stream", params={"payment_id": "pay-1", "user_id": "user-1"})
+            )
+            while not app.payment_status_hub.stats()["subscribers"] and not request.done():
+                await asyncio.sleep(0.01)
+            if meanwhile:
+                await meanwhile()
+            return await request
+
+    response = asyncio.run(run())
+    assert response.status_code == 200
+    assert not app.payment_status_hub.stats()["subscribers"]
+    return [event for event in response.text.split("\n\n") if event]
+
+
+def parse(event: str) -> dict:
+    assert event.startswith("data: ")
+    return json.loads(event[len("data: "):])
+
+
+def test_stream_closes_only_after_tariff_is_fulfilled(app, fake_db, entitlements, user_uuid):
+    fake_db.put("users", "user-1", {"user_id": "user-1", "balance": 0})
+    payment = pending_tariff(fake_db)
+
+    events = stream_events(app, lambda: app.settle_payment("pay-1", dict(payment), "succeeded"))
+
+    assert [(event["status"], event.get("fulfilled")) for event in map(parse, events)] == [
+        ("pending", None),
+        ("succeeded", False),
+        ("succeeded", True),
+    ]
+    assert subscription_days(app, fake_db) == 30
+
+
+def test_stream_waits_when_read_sees_paid_but_unfulfilled(app, fake_db, entitlements, user_uuid):
+    fake_db.put("users", "user-1", {"user_id": "user-1", "balance": 0})
+    payment = paid_tariff(fake_db)
+
+    events = stream_events(app, lambda: app.fulfill_tariff_payment("pay-1", dict(payment)))
+
+    assert [(event["status"], event["fulfilled"]) for event in map(parse, events)] == [
+        ("succeeded", False),
+        ("succeeded", True),
+    ]
+
+
+def test_stream_closes_at_once_for_settled_payment(app, fake_db):
+    payment = pending_tariff(fake_db)
+    fake_db.put("payments", "pay-1", {**payment, "status": "canceled"})
+
+    events = stream_events(app)
+
+    assert [parse(event)["status"] for event in events] == ["canceled"]
+
+
+def test_stream_sends_keepalives_then_times_out(app, fake_db, monkeypatch):
+    pending_tariff(fake_db)
+    monkeypatch.setattr(app, "PAYMENT_STREAM_KEEPALIVE", 0.05)
+    monkeypatch.setattr(app, "PAYMENT_STREAM_TIMEOUT", 0.3)
+
+    events = stream_events(app)
+
+    assert parse(events[0])["status"] == "pending"
+    assert events[-1] == "event: timeout\ndata: {}"
+    keepalives = events[1:-1]
+    assert len(keepalives) >= 3
+    assert set(keepalives) == {": keepalive"}
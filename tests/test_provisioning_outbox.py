@@ -0,0 +1,64 @@
+import asyncio
+
+import app as app_module
+
+
+def queue(fake_db, count: int, server_id: str, attempts: int = 0):
+    for i in range(count):
+        user_uuid = f"{server_id}-{i}"
+        fake_db.put("provisioning_outbox", app_module.outbox_doc_id("add", server_id, user_uuid), {
+            "op": "add",
+            "server_id": server_id,
+            "uuid": user_uuid,
+            "attempts": attempts,
+            "next_attempt_at": "2000-01-01T00:00:00",
+            "last_error": None,
+        })
+
+
+def test_dead_node_does_not_starve_healthy_nodes(app, fake_db, monkeypatch):
+    dead_node, healthy_node = list(app.XRAY_SERVERS)[:2]
+    queue(fake_db, 50, dead_node)
+    queue(fake_db, 3, healthy_node)
+    added = []
+
+    async def bulk_add(server_id, uuids):
+        added.extend(uuids)
+        return {user_uuid: True for user_uuid in uuids}
+
+    monkeypatch.setattr(app.xray_nodes, "is_available", lambda server_id: server_id != dead_node)
+    monkeypatch.setattr(app, "bulk_add_to_node", bulk_add)
+
+    outbox = app.ProvisioningOutbox(batch_size=10)
+    asyncio.run(outbox.process())
+
+    assert sorted(added) == [f"{healthy_node}-{i}" for i in range(3)]
+    remaining = fake_db.data["provisioning_outbox"].values()
+    assert {item["server_id"] for item in remaining} == {dead_node}
+    assert all(item["attempts"] == 0 for item in remaining)
+
+
+def test_operation_is_dead_lettered_after_max_attempts(app, fake_db, monkeypatch):
+    server_id = list(app.XRAY_SERVERS)[0]
+    queue(fake_db, 1, server_id, attempts=app.OUTBOX_MAX_ATTEMPTS - 2)
+
+    async def bulk_add(server_id, uuids):
+        return {user_uuid: False for user_uuid in uuids}
+
+    monkeypatch.setattr(app.xray_nodes, "is_available", lambda server_id: True)
+    monkeypatch.setattr(app, "bulk_add_to_node", bulk_add)
+    doc_id = app.outbox_doc_id("add", server_id, f"{server_id}-0")
+
+    outbox = app.ProvisioningOutbox(batch_size=10)
+    asyncio.run(outbox.process())
+    assert fake_db.doc("provisioning_outbox", doc_id)["attempts"] == app.OUTBOX_MAX_ATTEMPTS - 1
+
+    # Следующая попытка последняя: операция уходит из очереди в dead letter
+    fake_db.data["provisioning_outbox"][doc_id]["next_attempt_at"] = "2000-01-01T00:00:00"
+    asyncio.run(outbox.process())
+
+    assert fake_db.doc("provisioning_outbox", doc_id) is None
+    dead = fake_db.doc("provisioning_dead_letter", doc_id)
+    assert dead["attempts"] == app.OUTBOX_MAX_ATTEMPTS
+    assert dead["last_error"] == "node rejected"
+    assert outbox.stats()["dead_lettered"] == 1
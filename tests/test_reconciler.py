@@ -0,0 +1,162 @@
+import asyncio
+import json
+from datetime import datetime, timedelta
+
+import httpx
+import pytest
+
+from tests.conftest import server_id_of
+
+
+class StubNode:
+    """Нода с набором клиентов: GET /users, POST /users, DELETE /user/{uuid}"""
+
+    def __init__(self, clients=()):
+        self.clients = set(clients)
+        self.on_add = None
+
+    def handle(self, request):
+        if request.method == "GET" and request.url.path == "/users":
+            return httpx.Response(200, json={"users": [{"uuid": uuid} for uuid in sorted(self.clients)]})
+        if request.method == "POST" and request.url.path == "/users":
+            uuids = json.loads(request.content)["uuids"]
+            self.clients.update(uuids)
+            if self.on_add:
+                self.on_add(uuids)
+            return httpx.Response(200, json={"success": True})
+        if request.method == "DELETE":
+            self.clients.discard(request.url.path.rsplit("/", 1)[-1])
+            return httpx.Response(200, json={"success": True})
+        return httpx.Response(404)
+
+
+@pytest.fixture
+def nodes(stub_nodes, app):
+    nodes = {server_id: StubNode() for server_id in app.XRAY_SERVERS}
+    stub_nodes.handler = lambda request: nodes[server_id_of(request)].handle(request)
+    return nodes
+
+
+def grant(entitlements, vless_uuid: str, servers=None, days: int = 30):
+    if servers is not None:
+        entitlements.assign(vless_uuid, servers)
+    entitlements.grant(vless_uuid, f"user-{vless_uuid}", datetime.now() + timedelta(days=days))
+
+
+def make_reconciler(app, **overrides):
+    params = {"batch_size": 2, "batch_interval": 0, "max_ops_per_node": 100, "max_removals": 10}
+    params.update(overrides)
+    return app.XrayReconciler(**params)
+
+
+def test_users_are_added_only_to_assigned_nodes(app, entitlements, nodes):
+    grant(entitlements, "u-london", ["London"])
+    grant(entitlements, "u-nl", ["Netherlands"])
+    grant(entitlements, "u-legacy")
+
+    asyncio.run(make_reconciler(app).run())
+
+    assert nodes["London"].clients == {"u-london", "u-legacy"}
+    assert nodes["Netherlands"].clients == {"u-nl", "u-legacy"}
+
+
+def test_extra_and_unassigned_clients_are_removed(app, entitlements, nodes):
+    grant(entitlements, "u-london", ["London"])
+    nodes["London"].clients = {"u-london", "u-expired"}
+    nodes["Netherlands"].clients = {"u-london"}
+
+    reconciler = make_reconciler(app)
+    asyncio.run(reconciler.run())
+
+    assert nodes["London"].clients == {"u-london"}
+    assert nodes["Netherlands"].clients == set()
+    assert reconciler.drift["London"]["removed"] == 1
+
+
+def test_user_activated_during_run_is_not_removed(app, entitlements, nodes):
+    grant(entitlements, "u-a", ["London"])
+    grant(entitlements, "u-b", ["London"])
+    nodes["London"].clients = {"u-late"}
+    # Активация приходит, пока реконсилер добавляет недостающих
+    nodes["London"].on_add = lambda uuids: grant(entitlements, "u-late", ["London"])
+
+    asyncio.run(make_reconciler(app).reconcile_node("London"))
+
+    assert nodes["London"].clients == {"u-a", "u-b", "u-late"}
+
+
+def test_removal_over_threshold_is_skipped(app, entitlements, nodes):
+    nodes["London"].clients = {f"foreign-{index}" for index in range(5)}
+
+    reconciler = make_reconciler(app, max_removals=3)
+    asyncio.run(reconciler.reconcile_node("London"))
+
+    assert len(nodes["London"].clients) == 5
+    assert reconciler.drift["London"]["removal_skipped"] == "threshold"
+
+
+def test_dry_run_reports_without_removing(app, entitlements, nodes):
+    nodes["London"].clients = {"foreign"}
+
+    reconciler = make_reconciler(app, dry_run=True)
+    asyncio.run(reconciler.reconcile_node("London"))
+
+    assert nodes["London"].clients == {"foreign"}
+    assert reconciler.drift["London"]["extra"] == 1
+    assert reconciler.drift["London"]["removal_skipped"] == "dry_run"
+
+
+def test_operations_are_limited_by_budget(app, entitlements, nodes):
+    for index in range(5):
+        grant(entitlements, f"u-{index}", ["London"])
+    nodes["London"].clients = {"stale-1", "stale-2"}
+
+    reconciler = make_reconciler(app, max_ops_per_node=4)
+    asyncio.run(reconciler.reconcile_node("London"))
+
+    assert reconciler.drift["London"]["added"] == 4
+    assert reconciler.drift["London"]["removed"] == 0
+    assert {"stale-1", "stale-2"} <= nodes["London"].clients
+
+
+def test_unreachable_node_is_reported(app, entitlements, stub_nodes):
+    stub_nodes.handler = lambda request: httpx.Response(503)
+
+    reconciler = make_reconciler(app)
+    asyncio.run(reconciler.reconcile_node("London"))
+
+    assert "error" in reconciler.drift["London"]
+
+
+def test_ensure_user_uuid_records_assigned_nodes(app, fake_db, entitlements, stub_nodes):
+    stub_nodes.handler = lambda request: httpx.Response(200, json={"success": True})
+    fake_db.put('users', '1', {'user_id': '1', 'has_subscription': False})
+
+    async def main():
+        vless_uuid = await app.ensure_user_uuid('1', 'London')
+        await app.ensure_user_uuid('1', 'Netherlands')
+        await asyncio.sleep(0.1)
+        return vless_uuid
+
+    vless_uuid = asyncio.run(main())
+
+    assert fake_db.doc('users', '1')['xray_servers'] == ['London', 'Netherlands']
+    assert entitlements._servers[vless_uuid] == {'London', 'Netherlands'}
+
+
+def test_active_legacy_user_keeps_all_nodes(app, fake_db, entitlements, stub_nodes):
+    stub_nodes.handler = lambda request: httpx.Response(200, json={"success": True})
+    fake_db.put('users', '1', {
+        'user_id': '1',
+        'has_subscription': True,
+        'subscription_end': (datetime.now() + timedelta(days=3)).isoformat(),
+        'vless_uuid': 'legacy-uuid'
+    })
+
+    async def main():
+        await app.ensure_user_uuid('1', 'London')
+        await asyncio.sleep(0.1)
+
+    asyncio.run(main())
+
+    assert sorted(fake_db.doc('users', '1')['xray_servers']) == sorted(app.XRAY_SERVERS)
@@ -0,0 +1,76 @@
+import asyncio
+import threading
+import time
+
+import httpx
+
+
+def test_run_executes_blocking_calls_in_pool(app):
+    repo = app.FirestoreRepository(4)
+
+    async def main():
+        loop_thread = threading.get_ident()
+        threads = await asyncio.gather(*[repo.run(threading.get_ident) for _ in range(4)])
+        return loop_thread, threads
+
+    try:
+        loop_thread, threads = asyncio.run(main())
+    finally:
+        repo.shutdown()
+    assert loop_thread not in threads
+
+
+def test_blocking_calls_do_not_stall_event_loop(app):
+    repo = app.FirestoreRepository(8)
+
+    async def main():
+        started = time.monotonic()
+        await asyncio.gather(*[repo.run(time.sleep, 0.1) for _ in range(8)])
+        return time.monotonic() - started
+
+    try:
+        elapsed = asyncio.run(main())
+    finally:
+        repo.shutdown()
+    assert elapsed < 0.5
+
+
+def test_get_user_reads_through_repository(app, fake_db):
+    fake_db.put('users', '42', {'user_id': '42', 'balance': 10.0})
+    repo = app.FirestoreRepository(2)
+    try:
+        user = asyncio.run(repo.get_user('42'))
+        missing = asyncio.run(repo.get_user('43'))
+    finally:
+        repo.shutdown()
+    assert user['balance'] == 10.0
+    assert missing is None
+
+
+def test_user_data_p99_under_concurrent_load(app, fake_db, monkeypatch):
+    fake_db.latency = 0.02
+    users = 200
+    for i in range(users):
+        fake_db.put('users', f'user-{i}', {'user_id': f'user-{i}', 'balance': 10.0})
+    repo = app.FirestoreRepository(app.FIRESTORE_MAX_WORKERS)
+    monkeypatch.setattr(app, 'db_repo', repo)
+
+    async def main():
+        transport = httpx.ASGITransport(app=app.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://app') as client:
+            async def request(i):
+                started = time.monotonic()
+                response = await client.get('/user-data', params={'user_id': f'user-{i}'})
+                assert response.status_code == 200
+                return time.monotonic() - started
+            return await asyncio.gather(*[request(i) for i in range(users)])
+
+    try:
+        latencies = sorted(asyncio.run(main()))
+    finally:
+        repo.shutdown()
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    # 3 чтения на запрос: на event loop это 200 * 3 * 20 мс = 12 с,
+    # в пуле из FIRESTORE_MAX_WORKERS потоков - около 0.75 с
+    serial = users * 3 * fake_db.latency
+    assert p99 < serial / 4
@@ -0,0 +1,19 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+
+
+def test_subscription_check_runs_at_startup(app, monkeypatch):
+    scheduler = AsyncIOScheduler()
+    monkeypatch.setattr(app, "scheduler", scheduler)
+
+    async def main():
+        app.start_subscription_checker()
+        job = scheduler.get_job('subscription_check')
+        next_run = job.next_run_time
+        scheduler.shutdown(wait=False)
+        return next_run
+
+    next_run = asyncio.run(main())
+    assert next_run.replace(tzinfo=None) <= datetime.now() + timedelta(seconds=1)
@@ -0,0 +1,65 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import httpx
+import pytest
+
+from tests.conftest import server_id_of
+
+
+@pytest.fixture
+def node_stats(app, monkeypatch):
+    stats = app.XrayNodeStats(180)
+    monkeypatch.setattr(app, "node_stats", stats)
+    return stats
+
+
+def assign(entitlements, count: int, server_id: str):
+    for index in range(count):
+        vless_uuid = f"{server_id}-{index}"
+        entitlements.assign(vless_uuid, [server_id])
+        entitlements.grant(vless_uuid, vless_uuid, datetime.now() + timedelta(days=1))
+
+
+def test_auto_uses_node_stats(app, node_stats, entitlements, stub_nodes):
+    users = {"London": 700, "Netherlands": 100}
+    stub_nodes.handler = lambda request: httpx.Response(200, json={"users": users[server_id_of(request)]})
+
+    asyncio.run(node_stats.poll())
+
+    assert app.resolve_server("auto") == "Netherlands"
+    assert {server["id"]: server["users_source"] for server in app.rank_servers()} == {
+        "London": "node", "Netherlands": "node"
+    }
+
+
+def test_nodes_without_stats_fall_back_to_assigned_subscriptions(app, node_stats, entitlements, stub_nodes):
+    stub_nodes.handler = lambda request: httpx.Response(404)
+    assign(entitlements, 3, "London")
+    assign(entitlements, 1, "Netherlands")
+
+    asyncio.run(node_stats.poll())
+    ranked = app.rank_servers()
+
+    assert [server["id"] for server in ranked] == ["Netherlands", "London"]
+    assert all(server["healthy"] for server in ranked)
+    assert {server["id"]: server["users"] for server in ranked} == {"London": 3, "Netherlands": 1}
+    assert app.resolve_server("auto") == "Netherlands"
+
+
+def test_node_with_open_breaker_is_ranked_last(app, node_stats, entitlements, stub_nodes):
+    stub_nodes.handler = lambda request: httpx.Response(404)
+    assign(entitlements, 5, "London")
+    breaker = app.xray_nodes.breakers["Netherlands"]
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()
+
+    ranked = app.rank_servers()
+
+    assert [server["id"] for server in ranked] == ["London", "Netherlands"]
+    assert not ranked[-1]["healthy"]
+
+
+def test_explicit_server_is_kept(app):
+    assert app.resolve_server("London") == "London"
+    assert app.resolve_server(None) is None
@@ -0,0 +1,142 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+import httpx
+
+
+def add_subscriber(fake_db, user_id: str, ends_in: timedelta) -> datetime:
+    subscription_end = datetime.now() + ends_in
+    fake_db.put('users', user_id, {
+        'user_id': user_id,
+        'has_subscription': True,
+        'subscription_end': subscription_end.isoformat(),
+        'vless_uuid': f"uuid-{user_id}"
+    })
+    fake_db.put('vless_keys', f"{user_id}_London", {'user_id': user_id, 'server_id': 'London', 'is_active': True})
+    return subscription_end
+
+
+def test_query_selects_only_expired(app, fake_db):
+    add_subscriber(fake_db, '1', timedelta(days=-1))
+    add_subscriber(fake_db, '2', timedelta(days=3))
+
+    docs = app.get_expired_subscriptions(datetime.now().isoformat())
+
+    assert [doc.id for doc in docs] == ['1']
+
+
+def test_expire_disables_user_and_keys(app, fake_db):
+    add_subscriber(fake_db, '1', timedelta(hours=-1))
+    docs = app.get_expired_subscriptions(datetime.now().isoformat())
+
+    expired = app.expire_subscriptions(docs)
+
+    assert [user['user_id'] for user in expired] == ['1']
+    assert fake_db.doc('users', '1')['has_subscription'] is False
+    assert fake_db.doc('vless_keys', '1_London')['is_active'] is False
+
+
+def test_renewal_after_query_is_not_overwritten(app, fake_db):
+    add_subscriber(fake_db, '1', timedelta(hours=-1))
+    add_subscriber(fake_db, '2', timedelta(hours=-1))
+    docs = app.get_expired_subscriptions(datetime.now().isoformat())
+
+    renewed_end = (datetime.now() + timedelta(days=30)).isoformat()
+    fake_db.collection('users').document('2').update({'subscription_end': renewed_end})
+
+    expired = app.expire_subscriptions(docs)
+
+    assert [user['user_id'] for user in expired] == ['1']
+    assert fake_db.doc('users', '2')['has_subscription'] is True
+    assert fake_db.doc('users', '2')['subscription_end'] == renewed_end
+    assert fake_db.doc('vless_keys', '2_London')['is_active'] is True
+
+
+def test_checker_revokes_and_removes_expired_only(app, fake_db, entitlements, stub_nodes):
+    stub_nodes.handler = lambda request: httpx.Response(200, json={"success": True})
+    entitlements.grant('uuid-1', '1', add_subscriber(fake_db, '1', timedelta(hours=-1)))
+    entitlements.grant('uuid-2', '2', add_subscriber(fake_db, '2', timedelta(days=5)))
+
+    expired = asyncio.run(app.check_all_subscriptions())
+
+    assert expired == ['1']
+    assert entitlements.owner('uuid-1') is None
+    assert entitlements.owner('uuid-2') == '2'
+    removed = {request.url.path for request in stub_nodes.requests if request.method == 'DELETE'}
+    assert removed == {'/user/uuid-1'}
+
+
+def test_renewal_after_expiry_keeps_index_and_node(app, fake_db, entitlements, stub_nodes, monkeypatch):
+    stub_nodes.handler = lambda request: httpx.Response(200, json={"success": True})
+    old_end = add_subscriber(fake_db, '1', timedelta(hours=-1))
+    entitlements.grant('uuid-1', '1', old_end)
+    expire_subscriptions = app.expire_subscriptions
+
+    def expire_then_renew(docs):
+        expired = expire_subscriptions(docs)
+        # Продление проходит между записью и отзывом из индекса
+        entitlements.grant('uuid-1', '1', datetime.now() + timedelta(days=30))
+        return expired
+
+    monkeypatch.setattr(app, "expire_subscriptions", expire_then_renew)
+    expired = asyncio.run(app.check_all_subscriptions())
+
+    assert expired == ['1']
+    assert entitlements.owner('uuid-1') == '1'
+    assert not [request for request in stub_nodes.requests if request.method == 'DELETE']
+
+
+def test_saved_keys_are_listed_on_the_user(app, fake_db):
+    fake_db.put('users', '1', {'user_id': '1', 'has_subscription': True})
+    assert app.save_vless_key_to_db('1', 'London', 'vless://a', {})
+    assert app.save_vless_key_to_db('1', 'Netherlands', 'vless://b', {})
+    assert app.save_vless_key_to_db('1', 'London', 'vless://c', {})
+    # Ключ пользователя без документа сохраняется без индекса
+    assert app.save_vless_key_to_db('ghost', 'London', 'vless://d', {})
+
+    assert fake_db.doc('users', '1')['vless_key_ids'] == ['1_London', '1_Netherlands']
+    assert fake_db.doc('vless_keys', 'ghost_London')['vless_key'] == 'vless://d'
+    assert fake_db.doc('users', 'ghost') is None
+
+
+def test_backfill_lists_existing_keys(app, fake_db):
+    add_subscriber(fake_db, '1', timedelta(days=3))
+    add_subscriber(fake_db, '2', timedelta(days=3))
+    fake_db.data['vless_keys'].pop('2_London')
+
+    assert app.migrate_vless_key_ids() == 2
+    assert fake_db.doc('users', '1')['vless_key_ids'] == ['1_London']
+    assert fake_db.doc('users', '2')['vless_key_ids'] == []
+    assert app.migrate_vless_key_ids() == 0
+
+
+def test_expiry_at_scale_needs_no_key_queries(app, fake_db):
+    """Бенчмарк: 100k истекших подписок - один запрос и только пакетные записи"""
+    users = 100_000
+    ended = (datetime.now() - timedelta(hours=1)).isoformat()
+    writes = []
+    for i in range(users):
+        user_id = str(i)
+        writes.append(('set', fake_db.collection('users').document(user_id), {
+            'user_id': user_id,
+            'has_subscription': True,
+            'subscription_end': ended,
+            'vless_key_ids': [f"{user_id}_London"],
+        }, False))
+        writes.append(('set', fake_db.collection('vless_keys').document(f"{user_id}_London"), {
+            'user_id': user_id, 'server_id': 'London', 'is_active': True
+        }, False))
+    fake_db.commit(writes)
+    fake_db.queries = fake_db.commits = 0
+
+    started = time.monotonic()
+    expired = app.expire_subscriptions(app.get_expired_subscriptions(datetime.now().isoformat()))
+    elapsed = time.monotonic() - started
+
+    assert len(expired) == users
+    # Без vless_key_ids это был бы еще users / FIRESTORE_IN_LIMIT = 10 000 запросов
+    assert fake_db.queries == 1
+    assert fake_db.commits == 2 * users // app.FIRESTORE_BATCH_LIMIT
+    assert not any(key['is_active'] for key in fake_db.data['vless_keys'].values())
+    assert elapsed < 30
@@ -0,0 +1,38 @@
+from datetime import datetime, timedelta
+
+
+def test_legacy_counter_is_converted(app, fake_db):
+    last_check = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    fake_db.put('users', '1', {
+        'has_subscription': True,
+        'subscription_days': 10,
+        'last_subscription_check': last_check.isoformat()
+    })
+
+    assert app.migrate_subscription_end() == 1
+
+    user = fake_db.doc('users', '1')
+    assert 'last_subscription_check' not in user
+    assert user['subscription_end'] == (last_check + timedelta(days=10)).isoformat()
+
+
+def test_days_without_dates_count_from_now(app, fake_db):
+    fake_db.put('users', '1', {'has_subscription': True, 'subscription_days': 5})
+
+    assert app.migrate_subscription_end() == 1
+
+    subscription_end = datetime.fromisoformat(fake_db.doc('users', '1')['subscription_end'])
+    assert timedelta(days=4, hours=23) < subscription_end - datetime.now() <= timedelta(days=5)
+
+
+def test_subscription_without_end_or_days_is_skipped(app, fake_db):
+    fake_db.put('users', '1', {'has_subscription': True, 'subscription_days': 0})
+
+    assert app.migrate_subscription_end() == 0
+    assert 'subscription_end' not in fake_db.doc('users', '1')
+
+
+def test_migrated_documents_are_left_alone(app, fake_db):
+    fake_db.put('users', '1', {'has_subscription': True, 'subscription_end': '2030-01-01T00:00:00'})
+
+    assert app.migrate_subscription_end() == 0
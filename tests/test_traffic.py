@@ -0,0 +1,106 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import httpx
+from fastapi.testclient import TestClient
+from google.api_core import exceptions as google_exceptions
+
+from tests.conftest import server_id_of
+
+
+def traffic_handler(traffic_by_node):
+    def handler(request):
+        assert request.url.path == "/traffic"
+        assert request.url.params["reset"] == "true"
+        return httpx.Response(200, json={"users": traffic_by_node.get(server_id_of(request), {})})
+    return handler
+
+
+def test_collect_writes_rollups(app, fake_db, entitlements, stub_nodes):
+    entitlements.grant("uuid-1", "1", datetime.now() + timedelta(days=1))
+    fake_db.put('users', '1', {'user_id': '1'})
+    stub_nodes.handler = traffic_handler({
+        "London": {"uuid-1": {"uplink": 100, "downlink": 200}},
+        "Netherlands": {"uuid-1": {"uplink": 1, "downlink": 2}, "unknown": {"uplink": 5, "downlink": 0}},
+    })
+    collector = app.TrafficCollector(3600, 10 ** 9, 100)
+
+    asyncio.run(collector.collect())
+
+    assert fake_db.doc('users', '1')['traffic_uplink'] == 101
+    assert fake_db.doc('users', '1')['traffic_downlink'] == 202
+    owners = sorted(doc['owner'] for doc in fake_db.data['traffic_usage'].values())
+    assert owners == ['1', 'unknown']
+    assert collector.stats()['pending_buckets'] == 0
+
+
+def test_buckets_are_dropped_without_database(app, monkeypatch, entitlements, stub_nodes):
+    monkeypatch.setattr(app, "db", None)
+    stub_nodes.handler = traffic_handler({"London": {"uuid-1": {"uplink": 1, "downlink": 1}}})
+    collector = app.TrafficCollector(3600, 10 ** 9, 100)
+
+    asyncio.run(collector.collect())
+
+    assert collector.stats()['pending_buckets'] == 0
+    assert collector.dropped_buckets == 1
+
+
+def test_failed_writes_keep_at_most_max_pending_buckets(app, fake_db):
+    collector = app.TrafficCollector(3600, 10 ** 9, 3)
+    collector._buckets = {("1", index * 3600): [1, 10, True] for index in range(5)}
+    fake_db.fail_next_commits = 1
+
+    asyncio.run(collector.flush())
+
+    assert sorted(collector._buckets) == [("1", 7200), ("1", 10800), ("1", 14400)]
+    assert collector.dropped_buckets == 2
+
+    # Трафик отброшенных окон не попадает и в счетчики пользователя
+    asyncio.run(collector.flush())
+    assert fake_db.doc('users', '1')['traffic_uplink'] == 3
+    assert fake_db.doc('users', '1')['traffic_downlink'] == 30
+
+
+def test_failure_on_second_batch_requeues_only_unwritten_buckets(app, fake_db, monkeypatch):
+    # Два окна (и счетчики их пользователя) на пачку
+    monkeypatch.setattr(app, "FIRESTORE_BATCH_LIMIT", 4)
+    collector = app.TrafficCollector(3600, 10 ** 9, 100)
+    collector._buckets = {("1", index * 3600): [10, 100, True] for index in range(3)}
+    collector._buckets[("unknown", 0)] = [5, 5, False]
+
+    commit = fake_db.commit
+    commits = []
+
+    def fail_second_commit(writes):
+        commits.append(len(writes))
+        if len(commits) == 2:
+            raise google_exceptions.ServiceUnavailable("commit failed")
+        commit(writes)
+
+    monkeypatch.setattr(fake_db, "commit", fail_second_commit)
+    asyncio.run(collector.flush())
+
+    assert sorted(collector._buckets) == [("1", 7200), ("unknown", 0)]
+    assert fake_db.doc('users', '1')['traffic_uplink'] == 20
+    assert collector.last_error
+
+    asyncio.run(collector.flush())
+
+    assert collector._buckets == {}
+    assert fake_db.doc('users', '1')['traffic_uplink'] == 30
+    assert fake_db.doc('users', '1')['traffic_downlink'] == 300
+    assert sum(doc['uplink'] for doc in fake_db.data['traffic_usage'].values()) == 35
+
+
+def test_health_shows_heavy_users_only_to_admin(app, monkeypatch):
+    monkeypatch.setattr(app, "ADMIN_API_KEY", "secret")
+    monkeypatch.setattr(app.traffic_collector, "heavy_users", [{"owner": "1", "bytes": 10 ** 10}])
+    client = TestClient(app.app)
+
+    public = client.get("/health").json()["traffic"]
+    wrong_key = client.get("/health", headers={"X-Admin-Key": "guess"}).json()["traffic"]
+    admin = client.get("/health", headers={"X-Admin-Key": "secret"}).json()["traffic"]
+
+    assert "heavy_users" not in public and "heavy_users" not in wrong_key
+    assert public["heavy_users_count"] == 1
+    assert admin["heavy_users"] == [{"owner": "1", "bytes": 10 ** 10}]
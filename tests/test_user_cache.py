@@ -0,0 +1,42 @@
+import time
+
+
+def test_invalidate_unknown_keys_keeps_no_state(app):
+    cache = app.TTLCache(10, 60)
+    for key in range(1000):
+        cache.invalidate(str(key))
+    assert cache._versions == {}
+    assert cache._loading == {}
+
+
+def test_stale_load_is_not_cached_after_invalidation(app):
+    cache = app.TTLCache(10, 60)
+    version = cache.begin_load('42')
+    cache.invalidate('42')
+    cache.set('42', {'balance': 0}, version)
+    cache.end_load('42')
+    assert cache.get('42') is None
+    assert cache._versions == {}
+
+
+def test_ttl_and_lru_eviction(app):
+    cache = app.TTLCache(2, 0.05)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.set('c', 3)
+    assert cache.get('a') is None
+    assert cache.get('c') == 3
+    time.sleep(0.06)
+    assert cache.get('c') is None
+
+
+def test_balance_update_invalidates_cached_user(app, fake_db):
+    fake_db.put('users', '42', {'user_id': '42', 'balance': 10.0})
+    assert app.get_user('42')['balance'] == 10.0
+    assert app.get_user('42')['balance'] == 10.0
+    reads = app.user_cache.stats()
+
+    assert app.update_user_balance('42', 5.0)
+    assert app.get_user('42')['balance'] == 15.0
+    assert reads['hits'] == 1
+    assert app.user_cache._versions == {}
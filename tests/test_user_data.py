@@ -0,0 +1,122 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+import httpx
+
+
+def get_user_data(app, params: dict, ticks: list = None):
+    """GET /user-data через ASGI. ticks получает интервалы между тиками event loop"""
+    async def ticker():
+        last = time.monotonic()
+        while True:
+            await asyncio.sleep(0.005)
+            now = time.monotonic()
+            ticks.append(now - last)
+            last = now
+
+    async def main():
+        transport = httpx.ASGITransport(app=app.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://app") as client:
+            task = asyncio.create_task(ticker()) if ticks is not None else None
+            started = time.monotonic()
+            response = await client.get("/user-data", params=params)
+            elapsed = time.monotonic() - started
+            if task:
+                task.cancel()
+            return response, elapsed
+
+    return asyncio.run(main())
+
+
+def test_reads_fan_out_off_the_event_loop(app, fake_db):
+    fake_db.put("users", "user-1", {"user_id": "user-1", "balance": 10.0})
+    fake_db.latency = 0.1
+    ticks = []
+
+    response, elapsed = get_user_data(app, {"user_id": "user-1"}, ticks)
+
+    assert response.status_code == 200
+    # Пользователь, ключи и рефералы читаются параллельно: ~1 round trip, а не 3
+    assert elapsed < 2 * fake_db.latency
+    # Пока чтения спят в пуле потоков, event loop продолжает тикать
+    assert len(ticks) >= 5
+    assert max(ticks) < fake_db.latency / 2
+
+
+def user_with_referrals(fake_db):
+    fake_db.put("users", "user-1", {
+        "user_id": "user-1",
+        "balance": 25.0,
+        "has_subscription": True,
+        "subscription_end": datetime.now() + timedelta(days=10),
+        "vless_uuid": "uuid-1",
+    })
+    fake_db.put("vless_keys", "key-1", {"user_id": "user-1", "server_id": "London"})
+    fake_db.put("referrals", "ref-1", {"referrer_id": "user-1", "referred_id": "user-2", "referrer_bonus": 50})
+
+
+def test_parse_fields(app):
+    assert app.parse_fields(None) is None
+    assert app.parse_fields("") is None
+    assert app.parse_fields(" balance, ,referral_stats ,") == {"balance", "referral_stats"}
+
+
+def test_project_fields_keeps_user_id_and_skips_unknown(app):
+    data = {"user_id": "user-1", "balance": 1.0, "vless_uuid": "uuid-1"}
+    assert app.project_fields(data, None) is data
+    assert app.project_fields(data, {"balance", "no_such_field"}) == {"user_id": "user-1", "balance": 1.0}
+
+
+def test_bot_cabinet_fields(app, fake_db):
+    user_with_referrals(fake_db)
+    fields = "balance,has_subscription,subscription_days,referral_stats"
+
+    response, _ = get_user_data(app, {"user_id": "user-1", "fields": fields})
+
+    assert response.status_code == 200
+    data = response.json()
+    assert set(data) == {"user_id", "balance", "has_subscription", "subscription_days", "referral_stats"}
+    assert data["balance"] == 25.0
+    assert data["has_subscription"] is True
+    assert data["referral_stats"]["total_referrals"] == 1
+    assert data["referral_stats"]["total_bonus_money"] == 50
+    # Ключи не запрошены: их запрос не выполняется
+    assert fake_db.queried == ["referrals"]
+
+
+def test_referrals_are_read_only_when_requested(app, fake_db):
+    user_with_referrals(fake_db)
+
+    response, _ = get_user_data(app, {"user_id": "user-1", "fields": "balance,subscription_days"})
+
+    assert set(response.json()) == {"user_id", "balance", "subscription_days"}
+    assert fake_db.queried == []
+
+
+def test_unknown_fields_are_ignored(app, fake_db):
+    user_with_referrals(fake_db)
+
+    response, _ = get_user_data(app, {"user_id": "user-1", "fields": "balance,password,referral_stats.total"})
+
+    assert response.status_code == 200
+    assert response.json() == {"user_id": "user-1", "balance": 25.0}
+    assert fake_db.queried == []
+
+
+def test_all_fields_without_projection(app, fake_db):
+    user_with_referrals(fake_db)
+
+    response, _ = get_user_data(app, {"user_id": "user-1"})
+
+    data = response.json()
+    assert {"balance", "vless_keys", "referral_stats", "traffic", "available_servers"} <= set(data)
+    assert len(data["vless_keys"]) == 1
+    assert sorted(fake_db.queried) == ["referrals", "vless_keys"]
+
+
+def test_projection_applies_to_unknown_user(app, fake_db):
+    response, _ = get_user_data(app, {"user_id": "user-9", "fields": "balance,referral_stats"})
+
+    assert response.json() == {"user_id": "user-9", "balance": 0}
+    assert fake_db.queried == ["referrals"]
@@ -0,0 +1,63 @@
+import asyncio
+import json
+import os
+import stat
+
+import pytest
+
+import xray_manager
+
+
+def make_fake_xray(tmp_path, body: str) -> str:
+    """Создает исполняемый стаб `xray` с заданным телом shell-скрипта"""
+    path = tmp_path / "xray"
+    path.write_text("#!/bin/sh\n" + body)
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    return str(path)
+
+
+@pytest.fixture
+def manager(tmp_path):
+    manager = xray_manager.XrayManager()
+    manager.api_server = "127.0.0.1:1"
+    return manager
+
+
+def test_api_add_users_passes_request_file(tmp_path, manager):
+    log_path = tmp_path / "calls.log"
+    manager.xray_bin = make_fake_xray(tmp_path, f'echo "$@" >> {log_path}\ncat "$4" >> {log_path}\n')
+
+    inbound = {"tag": "inbound-1", "port": 2053, "protocol": "vless"}
+    clients = [{"id": "uuid-1", "email": "user-1", "flow": ""}]
+    assert asyncio.run(manager.api_add_users(inbound, clients))
+
+    args, request = log_path.read_text().split("\n", 1)
+    assert args.startswith("api adu --server=127.0.0.1:1 ")
+    assert json.loads(request)["inbounds"][0]["settings"]["clients"] == clients
+
+
+def test_api_failure_returns_none(tmp_path, manager):
+    manager.xray_bin = make_fake_xray(tmp_path, 'echo "rpc error" >&2\nexit 1\n')
+    assert asyncio.run(manager._run_api("rmu", "-tag=inbound-1", "user-1")) is None
+
+
+def test_traffic_query_is_parsed(tmp_path, manager):
+    stats = {"stat": [
+        {"name": "user>>>user-1>>>traffic>>>uplink", "value": "10"},
+        {"name": "user>>>user-1>>>traffic>>>downlink", "value": "20"},
+        {"name": "inbound>>>inbound-1>>>traffic>>>uplink", "value": "99"},
+    ]}
+    manager.xray_bin = make_fake_xray(tmp_path, f"echo '{json.dumps(stats)}'\n")
+    assert asyncio.run(manager.query_user_traffic()) == {"user-1": {"uplink": 10, "downlink": 20}}
+
+
+def test_timed_out_api_call_kills_process(tmp_path, manager, monkeypatch):
+    pid_path = tmp_path / "pid"
+    manager.xray_bin = make_fake_xray(tmp_path, f"echo $$ > {pid_path}\nexec sleep 30\n")
+    monkeypatch.setattr(xray_manager, "XRAY_API_TIMEOUT", 0.5)
+
+    assert asyncio.run(manager._run_api("statsquery")) is None
+
+    pid = int(pid_path.read_text())
+    with pytest.raises(ProcessLookupError):
+        os.kill(pid, 0)
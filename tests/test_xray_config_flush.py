@@ -0,0 +1,98 @@
+import asyncio
+import json
+import os
+import time
+
+import pytest
+
+import xray_manager
+
+
+@pytest.fixture
+def manager(tmp_path):
+    config_path = tmp_path / "config.json"
+    config_path.write_text(json.dumps({"inbounds": [{
+        "tag": "inbound-1",
+        "port": 2053,
+        "protocol": "vless",
+        "settings": {"clients": [], "decryption": "none"}
+    }]}))
+
+    manager = xray_manager.XrayManager(debounce=0.05)
+    manager.config_path = str(config_path)
+
+    async def api_ok(*args):
+        return True
+
+    async def no_restart():
+        manager.stats["restarts"] += 1
+
+    manager.api_add_users = api_ok
+    manager.api_remove_users = api_ok
+    manager.restart_xray = no_restart
+    return manager
+
+
+def saved_clients(manager) -> list:
+    with open(manager.config_path) as f:
+        return json.load(f)["inbounds"][0]["settings"]["clients"]
+
+
+def test_failed_write_keeps_changes_and_retries(manager, monkeypatch):
+    write_config = manager._write_config
+    failures = []
+
+    def flaky_write(data):
+        if not failures:
+            failures.append(data)
+            raise OSError("disk full")
+        write_config(data)
+
+    monkeypatch.setattr(manager, "_write_config", flaky_write)
+
+    async def main():
+        await manager.add_user_direct("user-1", "uuid-1")
+        await asyncio.sleep(0.2)
+
+    asyncio.run(main())
+
+    assert manager.stats["flush_errors"] == 1
+    assert manager.stats["flushes"] == 1
+    assert [client["id"] for client in saved_clients(manager)] == ["uuid-1"]
+
+
+def test_synchronous_flush_error_keeps_changes(manager, monkeypatch):
+    manager.write_behind = False
+
+    def broken_write(data):
+        raise OSError("read-only file system")
+
+    monkeypatch.setattr(manager, "_write_config", broken_write)
+    added, _ = asyncio.run(manager.add_user_direct("user-1", "uuid-1"))
+    assert not added
+    assert saved_clients(manager) == []
+
+    monkeypatch.undo()
+    asyncio.run(manager.flush())
+    assert [client["id"] for client in saved_clients(manager)] == ["uuid-1"]
+
+
+def test_many_adds_under_debounce_write_once(manager):
+    """Бенчмарк: 2000 добавлений в окне debounce дают одну запись конфига"""
+    count = 2000
+
+    async def main():
+        started = time.perf_counter()
+        for index in range(count):
+            await manager.add_user_direct(f"user-{index}", f"uuid-{index}")
+        enqueue_elapsed = time.perf_counter() - started
+        await asyncio.sleep(manager.debounce * 3)
+        return enqueue_elapsed
+
+    enqueue_elapsed = asyncio.run(main())
+
+    assert manager.stats["flushes"] == 1
+    assert manager.stats["bytes_written"] == os.path.getsize(manager.config_path)
+    assert len(saved_clients(manager)) == count
+    # Добавление только меняет индекс в памяти: ~0.1 мс на пользователя
+    assert enqueue_elapsed < count * 0.001
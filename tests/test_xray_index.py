@@ -0,0 +1,105 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+import xray_manager
+
+
+@pytest.fixture
+def manager(tmp_path):
+    config_path = tmp_path / "config.json"
+    config_path.write_text(json.dumps({"inbounds": [{
+        "tag": "inbound-1",
+        "port": 2053,
+        "protocol": "vless",
+        "settings": {"clients": [
+            {"id": "uuid-1", "email": "user-1"},
+            {"id": "uuid-2", "email": "user-2"},
+            {"id": "uuid-1b", "email": "user-1"},
+        ]}
+    }]}))
+
+    manager = xray_manager.XrayManager(write_behind=False)
+    manager.config_path = str(config_path)
+
+    async def api_ok(*args):
+        return True
+
+    manager.api_add_users = api_ok
+    manager.api_remove_users = api_ok
+    return manager
+
+
+def test_duplicates_collapse_on_load(manager):
+    assert sorted(client["id"] for client in manager.get_clients()) == ["uuid-1b", "uuid-2"]
+    assert manager.user_exists(uuid_str="uuid-1b")
+    assert not manager.user_exists(uuid_str="uuid-1")
+
+
+def test_lookup_by_email_and_uuid(manager):
+    assert manager.user_exists(email="user-2")
+    assert manager.user_exists(uuid_str="uuid-2")
+    assert not manager.user_exists(email="user-3", uuid_str="uuid-3")
+
+
+def test_new_uuid_replaces_client_with_same_email(manager):
+    added, _ = asyncio.run(manager.add_user_direct("user-2", "uuid-2b"))
+    assert added
+    assert manager.user_exists(uuid_str="uuid-2b")
+    assert not manager.user_exists(uuid_str="uuid-2")
+    assert len(manager.get_clients()) == 2
+
+
+def test_remove_updates_both_indexes(manager):
+    assert asyncio.run(manager.remove_user("user-2"))
+    assert not manager.user_exists(email="user-2")
+    assert not manager.user_exists(uuid_str="uuid-2")
+
+
+def test_bulk_add_skips_known_uuids_and_saves_once(manager):
+    added = asyncio.run(manager.add_users_bulk([("user-2", "uuid-2"), ("user-3", "uuid-3"), ("user-4", "uuid-4")]))
+    assert added == [("user-3", "uuid-3"), ("user-4", "uuid-4")]
+    assert manager.stats["flushes"] == 1
+
+    with open(manager.config_path) as f:
+        saved = json.load(f)["inbounds"][0]["settings"]["clients"]
+    assert sorted(client["id"] for client in saved) == ["uuid-1b", "uuid-2", "uuid-3", "uuid-4"]
+
+
+def linear_user_exists(config: dict, email: str = None, uuid_str: str = None) -> bool:
+    """Поиск перебором списка clients, как до индекса"""
+    clients = config["inbounds"][0]["settings"]["clients"]
+    return any(client.get("email") == email or client.get("id") == uuid_str for client in clients)
+
+
+@pytest.mark.parametrize("size", [10_000, 100_000])
+def test_indexed_lookup_benchmark(tmp_path, size):
+    """Бенчмарк: поиск по индексу не зависит от числа клиентов, перебор - линейно"""
+    config_path = tmp_path / "config.json"
+    config_path.write_text(json.dumps({"inbounds": [{
+        "tag": "inbound-1",
+        "protocol": "vless",
+        "settings": {"clients": [{"id": f"uuid-{i}", "email": f"user-{i}"} for i in range(size)]}
+    }]}))
+    manager = xray_manager.XrayManager(write_behind=False)
+    manager.config_path = str(config_path)
+    config = manager._load_config()
+
+    # Худший случай для перебора - отсутствующий клиент
+    lookups = 1000
+    started = time.perf_counter()
+    for i in range(lookups):
+        assert not manager.user_exists(email=f"missing-{i}", uuid_str=f"missing-{i}")
+    indexed = (time.perf_counter() - started) / lookups
+
+    scans = 10
+    started = time.perf_counter()
+    for i in range(scans):
+        assert not linear_user_exists(config, email=f"missing-{i}", uuid_str=f"missing-{i}")
+    linear = (time.perf_counter() - started) / scans
+
+    assert manager.user_exists(email=f"user-{size - 1}")
+    assert indexed < 20e-6
+    assert indexed * 100 < linear
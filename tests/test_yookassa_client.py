@@ -0,0 +1,104 @@
+import asyncio
+
+import httpx
+import pytest
+
+import yookassa_client
+
+
+def make_client(monkeypatch, handler, max_retries: int = 3):
+    """Клиент поверх MockTransport. Задержки повторов записываются вместо ожидания"""
+    delays = []
+
+    async def sleep(delay):
+        delays.append(delay)
+
+    monkeypatch.setattr(yookassa_client.asyncio, "sleep", sleep)
+    client = yookassa_client.YooKassaClient("shop", "secret", base_url="https://gateway.test", max_retries=max_retries)
+    client._client = httpx.AsyncClient(base_url="https://gateway.test", transport=httpx.MockTransport(handler))
+    return client, delays
+
+
+def test_server_errors_are_retried_with_the_same_idempotence_key(monkeypatch):
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        if len(requests) < 3:
+            return httpx.Response(503)
+        return httpx.Response(200, json={"id": "yk-1", "status": "pending"})
+
+    client, delays = make_client(monkeypatch, handler)
+    response = asyncio.run(client.create_payment({"amount": {"value": "150.00"}}, "pay-1"))
+
+    assert response.status_code == 200
+    assert [request.headers["Idempotence-Key"] for request in requests] == ["pay-1"] * 3
+    assert len(delays) == 2
+    # Экспоненциальная задержка с jitter: [delay / 2, delay]
+    assert 0.25 <= delays[0] <= 0.5
+    assert 0.5 <= delays[1] <= 1.0
+    stats = client.stats()
+    assert (stats["requests"], stats["retries"], stats["errors"]) == (3, 2, 0)
+    assert stats["latency"]["create_payment"]["count"] == 3
+
+
+def test_client_errors_are_not_retried(monkeypatch):
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(404, json={"code": "not_found"})
+
+    client, delays = make_client(monkeypatch, handler)
+    response = asyncio.run(client.get_payment("yk-missing"))
+
+    assert response.status_code == 404
+    assert len(calls) == 1
+    assert delays == []
+    assert client.stats()["errors"] == 0
+
+
+def test_persistent_server_error_returns_last_response(monkeypatch):
+    client, delays = make_client(monkeypatch, lambda request: httpx.Response(502), max_retries=2)
+    response = asyncio.run(client.get_payment("yk-1"))
+
+    assert response.status_code == 502
+    assert len(delays) == 2
+    assert (client.requests, client.retries, client.errors) == (3, 2, 1)
+
+
+def test_timeouts_are_retried_then_raised(monkeypatch):
+    def handler(request):
+        raise httpx.ReadTimeout("timed out", request=request)
+
+    client, delays = make_client(monkeypatch, handler, max_retries=2)
+    with pytest.raises(httpx.ReadTimeout):
+        asyncio.run(client.get_payment("yk-1"))
+
+    assert len(delays) == 2
+    assert (client.requests, client.retries, client.errors) == (3, 2, 1)
+    assert client.stats()["latency"]["get_payment"]["count"] == 3
+
+
+def test_retry_delay_is_capped(monkeypatch):
+    client, delays = make_client(monkeypatch, lambda request: httpx.Response(500), max_retries=6)
+    asyncio.run(client.get_payment("yk-1"))
+
+    assert max(delays) <= yookassa_client.YOOKASSA_RETRY_MAX_DELAY
+    assert delays[-1] >= yookassa_client.YOOKASSA_RETRY_MAX_DELAY / 2
+
+
+def test_latency_histogram_buckets():
+    histogram = yookassa_client.LatencyHistogram(buckets=(50, 100, 250))
+    for elapsed_ms in (10, 50, 51, 100, 240, 1000):
+        histogram.observe(elapsed_ms)
+
+    snapshot = histogram.snapshot()
+    assert snapshot["buckets"] == {"le_50": 2, "le_100": 2, "le_250": 1, "inf": 1}
+    assert snapshot["count"] == 6
+    assert snapshot["avg_ms"] == round(1451 / 6, 1)
+    assert yookassa_client.LatencyHistogram().snapshot() == {
+        "count": 0,
+        "avg_ms": None,
+        "buckets": {**{f"le_{bound}": 0 for bound in yookassa_client.LATENCY_BUCKETS_MS}, "inf": 0},
+    }
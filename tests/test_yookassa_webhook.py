@@ -0,0 +1,83 @@
+import httpx
+from fastapi.testclient import TestClient
+
+YOOKASSA_ADDRESS = "185.71.76.5"
+
+
+def top_up(fake_db, payment_id: str = "pay-1", amount: float = 300):
+    fake_db.put("users", "user-1", {"user_id": "user-1", "balance": 0})
+    fake_db.put("payments", payment_id, {
+        "payment_id": payment_id,
+        "user_id": "user-1",
+        "amount": amount,
+        "tariff": "balance",
+        "status": "pending",
+        "payment_type": "balance",
+        "payment_method": "yookassa",
+        "yookassa_id": f"yk-{payment_id}",
+    })
+
+
+def notification(payment_id: str = "pay-1", event: str = "payment.succeeded") -> dict:
+    return {
+        "event": event,
+        "object": {
+            "id": f"yk-{payment_id}",
+            "status": event.split(".")[1],
+            "metadata": {"payment_id": payment_id},
+        },
+    }
+
+
+def send(app, body: dict, forwarded_for: str = YOOKASSA_ADDRESS):
+    client = TestClient(app.app)
+    return client.post("/yookassa/webhook", json=body, headers={"X-Forwarded-For": forwarded_for})
+
+
+def test_spoofed_leftmost_forwarded_address_is_rejected(app, fake_db, gateway):
+    top_up(fake_db)
+    gateway.payments["yk-pay-1"] = {"id": "yk-pay-1", "status": "succeeded"}
+
+    response = send(app, notification(), forwarded_for=f"{YOOKASSA_ADDRESS}, 203.0.113.7")
+
+    assert response.status_code == 403
+    assert gateway.requests == []
+    assert fake_db.doc("users", "user-1")["balance"] == 0
+
+
+def test_notification_status_is_not_trusted(app, fake_db, gateway):
+    top_up(fake_db)
+    # Уведомление утверждает succeeded, API ЮKassa - что платеж еще ожидает оплаты
+    gateway.payments["yk-pay-1"] = {"id": "yk-pay-1", "status": "pending"}
+
+    response = send(app, notification(), forwarded_for=f"203.0.113.7, {YOOKASSA_ADDRESS}")
+
+    assert response.status_code == 200
+    assert [request.url.path for request in gateway.requests] == ["/payments/yk-pay-1"]
+    assert fake_db.doc("payments", "pay-1")["status"] == "pending"
+    assert fake_db.doc("users", "user-1")["balance"] == 0
+
+
+def test_confirmed_payment_is_credited_once(app, fake_db, gateway):
+    top_up(fake_db)
+    gateway.payments["yk-pay-1"] = {"id": "yk-pay-1", "status": "succeeded"}
+
+    first = send(app, notification())
+    repeated = send(app, notification())
+
+    assert first.json() == {"success": True, "status": "succeeded"}
+    assert repeated.json() == {"success": True, "status": "succeeded"}
+    assert fake_db.doc("users", "user-1")["balance"] == 300
+    assert fake_db.doc("payments", "pay-1")["fulfilled"] is True
+
+
+def test_gateway_failure_asks_yookassa_to_retry(app, fake_db, gateway):
+    top_up(fake_db)
+    gateway.handler = lambda request: httpx.Response(503)
+
+    response = send(app, notification())
+
+    assert response.status_code == 502
+    assert len(gateway.requests) == app.yookassa.max_retries + 1
+    assert fake_db.doc("payments", "pay-1")["status"] == "pending"
+    assert fake_db.doc("users", "user-1")["balance"] == 0
@@ -1,6 +1,48 @@
+import asyncio
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import uuid
+
+logger = logging.getLogger(__name__)
+
+XRAY_BIN = os.getenv("XRAY_BIN", "/usr/local/bin/xray")
+XRAY_CONFIG_PATH = os.getenv("XRAY_CONFIG_PATH", "/usr/local/etc/xray/config.json")
+# Адрес API inbound Xray (HandlerService), см. секцию "api" в config.json
+XRAY_API_SERVER = os.getenv("XRAY_API_SERVER", "127.0.0.1:10085")
+XRAY_API_TIMEOUT = 10.0
+# Окно, в течение которого изменения копятся в памяти перед записью конфига
+XRAY_FLUSH_DEBOUNCE = float(os.getenv("XRAY_FLUSH_DEBOUNCE", "1.0"))
+
+
 class XrayManager:
-    def __init__(self):
+    def __init__(self, live: bool = True, inbound_tag: str = "inbound-1",
+                 write_behind: bool = True, debounce: float = XRAY_FLUSH_DEBOUNCE):
         self.script_path = "/usr/local/bin/add_vpn_user"
+        self.config_path = XRAY_CONFIG_PATH
+        self.xray_bin = XRAY_BIN
+        self.api_server = XRAY_API_SERVER
+        self.inbound_tag = inbound_tag
+        # live: пользователи добавляются/удаляются через API Xray без перезапуска,
+        # конфиг сохраняется только как снимок для следующего старта
+        self.live = live
+        # write_behind: конфиг держится в памяти и сбрасывается на диск не чаще
+        # одного раза за debounce секунд, с одним перезапуском на сброс
+        self.write_behind = write_behind
+        self.debounce = debounce
+        self.stats = {"flushes": 0, "flush_errors": 0, "restarts": 0, "bytes_written": 0}
+        self._config = None
+        # Индексы клиентов по тегу inbound: email -> client и uuid -> email
+        self._clients = {}
+        self._uuid_index = {}
+        # Номер последнего изменения и номер изменения, сохраненного на диск
+        self._version = 0
+        self._flushed_version = 0
+        self._restart_pending = False
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
         
     async def add_user(self, email: str, uuid_str: str = None) -> bool:
         """Добавляет пользователя через скрипт"""
@@ -14,6 +56,250 @@ class XrayManager:
             logger.error(f"❌ Error adding user via script: {e}")
             return False
     
+    def _load_config(self) -> dict:
+        if self._config is None:
+            with open(self.config_path, 'r') as f:
+                self._config = json.load(f)
+            self._build_index()
+        return self._config
+    
+    def _build_index(self):
+        """Строит индексы клиентов по email и uuid, дубликаты схлопываются"""
+        self._clients = {}
+        self._uuid_index = {}
+        for inbound in self._config['inbounds']:
+            clients = inbound.get('settings', {}).get('clients')
+            if clients is None:
+                continue
+            by_email = {}
+            by_uuid = {}
+            for client in clients:
+                key = client.get('email') or client.get('id')
+                previous = by_email.get(key)
+                if previous is not None:
+                    by_uuid.pop(previous.get('id'), None)
+                by_email[key] = client
+                by_uuid[client.get('id')] = key
+            self._clients[inbound.get('tag')] = by_email
+            self._uuid_index[inbound.get('tag')] = by_uuid
+    
+    def _sync_clients(self):
+        """Переносит индексы обратно в списки clients перед записью конфига"""
+        for inbound in self._config['inbounds']:
+            by_email = self._clients.get(inbound.get('tag'))
+            if by_email is not None:
+                inbound['settings']['clients'] = list(by_email.values())
+    
+    def _put_client(self, client: dict):
+        """Добавляет клиента в индекс за O(1).
+        
+        Возвращает (добавлен ли клиент, email замененного клиента с другим uuid или None).
+        """
+        by_email = self._clients.setdefault(self.inbound_tag, {})
+        by_uuid = self._uuid_index.setdefault(self.inbound_tag, {})
+        email = client['email']
+        
+        if client['id'] in by_uuid:
+            return False, None
+        
+        replaced = None
+        previous = by_email.get(email)
+        if previous is not None:
+            by_uuid.pop(previous.get('id'), None)
+            replaced = email
+        
+        by_email[email] = client
+        by_uuid[client['id']] = email
+        return True, replaced
+    
+    def _pop_client(self, email: str):
+        """Удаляет клиента из индекса за O(1) и возвращает его"""
+        client = self._clients.get(self.inbound_tag, {}).pop(email, None)
+        if client is not None:
+            self._uuid_index.get(self.inbound_tag, {}).pop(client.get('id'), None)
+        return client
+    
+    def user_exists(self, email: str = None, uuid_str: str = None) -> bool:
+        """Проверяет наличие клиента по email или uuid за O(1)"""
+        self._load_config()
+        if email is not None and email in self._clients.get(self.inbound_tag, {}):
+            return True
+        return uuid_str is not None and uuid_str in self._uuid_index.get(self.inbound_tag, {})
+    
+    def get_clients(self) -> list:
+        """Возвращает текущий список клиентов inbound"""
+        self._load_config()
+        return list(self._clients.get(self.inbound_tag, {}).values())
+    
+    def _write_config(self, data: str):
+        """Атомарно записывает конфиг: временный файл + fsync + rename"""
+        directory = os.path.dirname(self.config_path) or "."
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".config-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.config_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    
+    async def flush(self):
+        """Сбрасывает накопленные изменения на диск и при необходимости перезапускает Xray"""
+        async with self._flush_lock:
+            if self._version != self._flushed_version:
+                version = self._version
+                # Снимок сериализуем в event loop, пишем в отдельном потоке
+                self._sync_clients()
+                data = json.dumps(self._config, separators=(',', ':'))
+                await asyncio.to_thread(self._write_config, data)
+                # Изменения, пришедшие во время записи, остаются несохраненными
+                self._flushed_version = version
+                self.stats["flushes"] += 1
+                self.stats["bytes_written"] += len(data)
+            
+            # Перезапуск читает конфиг с диска, поэтому только после успешной записи
+            if self._restart_pending:
+                self._restart_pending = False
+                await self.restart_xray()
+    
+    async def _flush_later(self):
+        await asyncio.sleep(self.debounce)
+        self._flush_task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            # Изменения остаются в памяти, запись повторяется через debounce
+            self.stats["flush_errors"] += 1
+            logger.error(f"❌ Error writing Xray config, retrying: {e}")
+            if self._flush_task is None:
+                self._flush_task = asyncio.create_task(self._flush_later())
+    
+    async def _commit(self, needs_restart: bool):
+        """Отмечает конфиг измененным и планирует сброс на диск"""
+        self._version += 1
+        if needs_restart:
+            self._restart_pending = True
+        
+        if not self.write_behind:
+            await self.flush()
+        elif self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+    
+    def _find_inbound(self, config: dict) -> dict:
+        for inbound in config['inbounds']:
+            if inbound.get('tag') == self.inbound_tag:
+                return inbound
+        return config['inbounds'][0]
+    
+    async def _run_api(self, *args):
+        """Вызывает `xray api ...` (gRPC HandlerService/StatsService). Возвращает stdout или None при ошибке"""
+        process = None
+        try:
+            process = await asyncio.create_subprocess_exec(
+                self.xray_bin, "api", args[0], f"--server={self.api_server}", *args[1:],
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=XRAY_API_TIMEOUT)
+            
+            if process.returncode != 0:
+                logger.error(f"❌ Xray API {args[0]} failed: {stderr.decode(errors='replace').strip()}")
+                return None
+            return stdout.decode(errors='replace')
+            
+        except asyncio.TimeoutError:
+            logger.error(f"❌ Xray API {args[0]} timed out after {XRAY_API_TIMEOUT} s")
+            # Зависший процесс не должен пережить вызов
+            if process is not None and process.returncode is None:
+                process.kill()
+                await process.wait()
+            return None
+        except Exception as e:
+            logger.error(f"❌ Error calling Xray API {args[0]}: {e}")
+            return None
+    
+    async def api_add_users(self, inbound: dict, clients: list) -> bool:
+        """Добавляет клиентов в работающий inbound через AlterInbound (xray api adu)"""
+        if not clients:
+            return True
+        
+        request_config = {
+            "inbounds": [{
+                "tag": inbound.get('tag', self.inbound_tag),
+                "port": inbound.get('port'),
+                "protocol": inbound.get('protocol', 'vless'),
+                "settings": {
+                    "clients": clients,
+                    "decryption": "none"
+                }
+            }]
+        }
+        
+        fd, request_path = tempfile.mkstemp(suffix=".json", prefix="xray-adu-")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(request_config, f)
+            return await self._run_api("adu", request_path) is not None
+        finally:
+            os.unlink(request_path)
+    
+    async def api_remove_users(self, emails: list) -> bool:
+        """Удаляет клиентов из работающего inbound через AlterInbound (xray api rmu)"""
+        if not emails:
+            return True
+        return await self._run_api("rmu", f"-tag={self.inbound_tag}", *emails) is not None
+    
+    async def query_user_traffic(self, reset: bool = True) -> dict:
+        """Возвращает трафик по пользователям из StatsService: {email: {"uplink": n, "downlink": n}}.
+        
+        При reset=True счетчики обнуляются, поэтому каждый вызов возвращает прирост.
+        """
+        args = ["statsquery", "-pattern", "user>>>"]
+        if reset:
+            args.append("-reset")
+        
+        output = await self._run_api(*args)
+        if not output:
+            return {}
+        
+        traffic = {}
+        try:
+            for stat in json.loads(output).get("stat", []):
+                # Имя счетчика: user>>>{email}>>>traffic>>>uplink
+                parts = stat.get("name", "").split(">>>")
+                if len(parts) != 4 or parts[0] != "user":
+                    continue
+                email, direction = parts[1], parts[3]
+                traffic.setdefault(email, {"uplink": 0, "downlink": 0})[direction] = int(stat.get("value", 0))
+        except Exception as e:
+            logger.error(f"❌ Error parsing Xray stats: {e}")
+        
+        return traffic
+    
+    async def _apply(self, add_clients: list = None, remove_emails: list = None, inbound: dict = None):
+        """Применяет изменения к работающему Xray: через API в live режиме, иначе перезапуском.
+        
+        Конфиг сохраняется через _commit: сразу или отложенно в write-behind режиме.
+        """
+        needs_restart = True
+        if self.live:
+            removed = await self.api_remove_users(remove_emails or [])
+            added = await self.api_add_users(inbound or {}, add_clients or [])
+            needs_restart = not (removed and added)
+            if needs_restart:
+                logger.warning("⚠️ Xray API unavailable, falling back to restart")
+        
+        await self._commit(needs_restart)
+    
     async def add_user_direct(self, email: str, uuid_str: str = None) -> bool:
         """Добавляет пользователя напрямую в конфиг"""
         try:
@@ -22,11 +308,8 @@ class XrayManager:
             if not uuid_str:
                 uuid_str = str(uuid.uuid4())
             
-            config_path = "/usr/local/etc/xray/config.json"
-            
             # Читаем конфиг
-            with open(config_path, 'r') as f:
-                config = json.load(f)
+            config = self._load_config()
             
             new_user = {
                 "id": uuid_str,
@@ -34,15 +317,17 @@ class XrayManager:
                 "flow": ""
             }
             
-            # Добавляем пользователя в первый inbound
-            config['inbounds'][0]['settings']['clients'].append(new_user)
-            
-            # Сохраняем конфиг
-            with open(config_path, 'w') as f:
-                json.dump(config, f, indent=2)
+            added, replaced = self._put_client(new_user)
+            if not added:
+                logger.info(f"ℹ️ User {email} already present in config")
+                return True, uuid_str
             
-            # На Railway перезапускаем Xray через pkill + запуск в фоне
-            await self.restart_xray()
+            # В live режиме добавляем через API без перезапуска, иначе pkill + запуск в фоне
+            await self._apply(
+                add_clients=[new_user],
+                remove_emails=[replaced] if replaced else None,
+                inbound=self._find_inbound(config)
+            )
             
             logger.info(f"✅ User {email} successfully added directly to config")
             return True, uuid_str
@@ -51,6 +336,48 @@ class XrayManager:
             logger.error(f"❌ Error adding user directly: {e}")
             return False, None
     
+    async def add_users_bulk(self, users: list) -> list:
+        """Добавляет пачку пользователей одной перезаписью конфига и одним применением.
+        
+        users - список пар (email, uuid). Возвращает список добавленных пар.
+        """
+        try:
+            logger.info(f"🔄 Adding {len(users)} users to config in bulk")
+            
+            config = self._load_config()
+            
+            added = []
+            new_clients = []
+            replaced_emails = []
+            for email, uuid_str in users:
+                uuid_str = uuid_str or str(uuid.uuid4())
+                new_user = {
+                    "id": uuid_str,
+                    "email": email,
+                    "flow": ""
+                }
+                is_added, replaced = self._put_client(new_user)
+                if not is_added:
+                    continue
+                if replaced:
+                    replaced_emails.append(replaced)
+                new_clients.append(new_user)
+                added.append((email, uuid_str))
+            
+            if added:
+                await self._apply(
+                    add_clients=new_clients,
+                    remove_emails=replaced_emails,
+                    inbound=self._find_inbound(config)
+                )
+            
+            logger.info(f"✅ Bulk add finished: {len(added)} new users, {len(users) - len(added)} already present")
+            return added
+            
+        except Exception as e:
+            logger.error(f"❌ Error adding users in bulk: {e}")
+            return []
+    
     async def restart_xray(self):
         """Перезапускает Xray на Railway"""
         try:
@@ -62,9 +389,10 @@ class XrayManager:
             
             # Запускаем Xray в фоне
             subprocess.Popen([
-                "/usr/local/bin/xray", "run", "-config", "/usr/local/etc/xray/config.json"
+                self.xray_bin, "run", "-config", self.config_path
             ])
             
+            self.stats["restarts"] += 1
             logger.info("✅ Xray restarted")
             
         except Exception as e:
@@ -75,32 +403,16 @@ class XrayManager:
         try:
             logger.info(f"🔄 Removing user from config: {email}")
             
-            config_path = "/usr/local/etc/xray/config.json"
-            
             # Читаем конфиг
-            with open(config_path, 'r') as f:
-                config = json.load(f)
+            self._load_config()
             
             # Удаляем пользователя
-            for inbound in config['inbounds']:
-                if inbound.get('tag') == 'inbound-1':
-                    original_count = len(inbound['settings']['clients'])
-                    inbound['settings']['clients'] = [
-                        client for client in inbound['settings']['clients'] 
-                        if client.get('email') != email
-                    ]
-                    new_count = len(inbound['settings']['clients'])
-                    
-                    if new_count < original_count:
-                        logger.info(f"✅ Removed user {email} from config")
-                    break
-            
-            # Сохраняем конфиг
-            with open(config_path, 'w') as f:
-                json.dump(config, f, indent=2)
-            
-            # Перезапускаем Xray
-            await self.restart_xray()
+            removed = self._pop_client(email) is not None
+            
+            if removed:
+                logger.info(f"✅ Removed user {email} from config")
+                # В live режиме удаляем через API без перезапуска
+                await self._apply(remove_emails=[email])
             
             return True
             
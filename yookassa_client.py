@@ -0,0 +1,139 @@
+import asyncio
+import bisect
+import logging
+import os
+import random
+import time
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+YOOKASSA_API_URL = os.getenv("YOOKASSA_API_URL", "https://api.yookassa.ru/v3").rstrip("/")
+YOOKASSA_TIMEOUT = float(os.getenv("YOOKASSA_TIMEOUT", "30"))
+YOOKASSA_MAX_RETRIES = int(os.getenv("YOOKASSA_MAX_RETRIES", "3"))
+YOOKASSA_RETRY_BASE_DELAY = 0.5  # секунды, удваивается с каждой попыткой
+YOOKASSA_RETRY_MAX_DELAY = 8.0
+YOOKASSA_MAX_CONNECTIONS = int(os.getenv("YOOKASSA_MAX_CONNECTIONS", "20"))
+YOOKASSA_MAX_KEEPALIVE = int(os.getenv("YOOKASSA_MAX_KEEPALIVE", "10"))
+# Верхние границы корзин гистограммы задержек, мс
+LATENCY_BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class LatencyHistogram:
+    """Гистограмма задержек запросов с фиксированными корзинами"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+
+    def observe(self, elapsed_ms: float):
+        self.counts[bisect.bisect_left(self.buckets, elapsed_ms)] += 1
+        self.count += 1
+        self.total_ms += elapsed_ms
+
+    def snapshot(self) -> dict:
+        buckets = {f"le_{bound}": count for bound, count in zip(self.buckets, self.counts)}
+        buckets["inf"] = self.counts[-1]
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total_ms / self.count, 1) if self.count else None,
+            "buckets": buckets
+        }
+
+
+class YooKassaClient:
+    """Клиент API ЮKassa с общим пулом keep-alive соединений.
+
+    Таймауты, сетевые ошибки и ответы 5xx повторяются с экспоненциальной задержкой
+    и jitter. Повтор создания платежа отправляется с тем же Idempotence-Key,
+    поэтому ЮKassa не создаст второй платеж.
+    """
+
+    def __init__(self, shop_id: str, api_key: str, base_url: str = YOOKASSA_API_URL,
+                 timeout: float = YOOKASSA_TIMEOUT, max_retries: int = YOOKASSA_MAX_RETRIES):
+        self.shop_id = shop_id
+        self.api_key = api_key
+        self.base_url = base_url
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.requests = 0
+        self.retries = 0
+        self.errors = 0
+        self.latency = {}
+        self._client = None
+
+    @property
+    def configured(self) -> bool:
+        return bool(self.shop_id and self.api_key)
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                auth=(self.shop_id, self.api_key),
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=YOOKASSA_MAX_CONNECTIONS,
+                    max_keepalive_connections=YOOKASSA_MAX_KEEPALIVE
+                )
+            )
+        return self._client
+
+    async def shutdown(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _observe(self, operation: str, started: float):
+        histogram = self.latency.setdefault(operation, LatencyHistogram())
+        histogram.observe((time.monotonic() - started) * 1000)
+
+    async def request(self, operation: str, method: str, path: str,
+                      idempotence_key: str = None, json: dict = None) -> httpx.Response:
+        """Выполняет запрос с повторами. Возвращает последний ответ или
+        пробрасывает последнюю сетевую ошибку"""
+        headers = {"Idempotence-Key": idempotence_key} if idempotence_key else {}
+
+        for attempt in range(self.max_retries + 1):
+            self.requests += 1
+            started = time.monotonic()
+            try:
+                response = await self._get_client().request(method, path, headers=headers, json=json)
+            except (httpx.TimeoutException, httpx.TransportError) as e:
+                self._observe(operation, started)
+                if attempt == self.max_retries:
+                    self.errors += 1
+                    raise
+                logger.warning(f"⚠️ YooKassa {operation} failed: {e!r}, retrying")
+            else:
+                self._observe(operation, started)
+                if response.status_code < 500 or attempt == self.max_retries:
+                    if response.status_code >= 500:
+                        self.errors += 1
+                    return response
+                logger.warning(f"⚠️ YooKassa {operation} returned {response.status_code}, retrying")
+
+            self.retries += 1
+            delay = min(YOOKASSA_RETRY_MAX_DELAY, YOOKASSA_RETRY_BASE_DELAY * 2 ** attempt)
+            await asyncio.sleep(random.uniform(delay / 2, delay))
+
+    async def create_payment(self, data: dict, idempotence_key: str) -> httpx.Response:
+        return await self.request("create_payment", "POST", "/payments", idempotence_key, data)
+
+    async def get_payment(self, yookassa_id: str) -> httpx.Response:
+        return await self.request("get_payment", "GET", f"/payments/{yookassa_id}")
+
+    def stats(self) -> dict:
+        return {
+            "configured": self.configured,
+            "requests": self.requests,
+            "retries": self.retries,
+            "errors": self.errors,
+            "latency": {operation: histogram.snapshot() for operation, histogram in self.latency.items()}
+        }
+
+
+yookassa = YooKassaClient(os.getenv("SHOP_ID"), os.getenv("API_KEY"))